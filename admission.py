@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+from fastapi.responses import JSONResponse
+
+# AI请求准入控制：每个用户一个令牌桶限制请求速率；每个服务商一个加权公平队列限制并发上游请求，
+# 排队时按用户轮流放行，某个用户的批量请求不会把其他用户挤在后面
+AI_USER_RATE_PER_MINUTE = float(os.getenv("AI_USER_RATE_PER_MINUTE", "30"))  # 0表示不限速
+AI_USER_BURST = float(os.getenv("AI_USER_BURST", "10"))
+AI_QUEUE_MAX_DEPTH = int(os.getenv("AI_QUEUE_MAX_DEPTH", "100"))  # 每个服务商最多排队的请求数
+AI_QUEUE_MAX_PER_USER = int(os.getenv("AI_QUEUE_MAX_PER_USER", "20"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))  # 秒，排队超过此时间返回429
+# 批量/后台请求的权重（交互请求为1），权重越低在队列中越靠后
+AI_BACKGROUND_WEIGHT = float(os.getenv("AI_BACKGROUND_WEIGHT", "0.25"))
+MAX_TRACKED_USERS = 10000
+WAIT_SAMPLES = 200
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝，retry_after 为建议的重试等待秒数（对应429和Retry-After响应头）"""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+        self.reason = reason
+
+
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    """AI请求超出限速或排队已满时返回429，并告知客户端多久后重试（main 和 app_minimal 共用）"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # 每秒补充的令牌数
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FairQueue:
+    """
+    单个服务商的并发上限和排队
+
+    有空闲名额且没有人排队时直接放行；否则按启动时间公平排队（SFQ）：每个请求的虚拟开始时间取
+    队列当前虚拟时间与同一用户上一个请求虚拟结束时间的较大值，结束时间再加上 代价/权重，
+    按开始时间依次放行，同一用户连续提交的请求会被其他用户的请求穿插
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.finish_tags: Dict[str, float] = {}
+        self.waiting: List[list] = []  # [开始时间, 序号, 用户, future]
+        self.queued_by_flow: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self.peak_queued = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.service_time: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(self.queued_by_flow.values())
+
+    def _estimated_wait(self, ahead: int) -> float:
+        # 排在前面的请求按平均占用时间、以并发上限为批次依次完成
+        return (ahead // max(self.limit, 1) + 1) * (self.service_time or 1.0)
+
+    async def acquire(self, flow: str, cost: float, weight: float, timeout: float = AI_QUEUE_TIMEOUT):
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            self.admitted += 1
+            self.waits.append(0.0)
+            return
+
+        queued = self.queued
+        if queued >= AI_QUEUE_MAX_DEPTH or self.queued_by_flow.get(flow, 0) >= AI_QUEUE_MAX_PER_USER:
+            self.rejected["queue_full"] += 1
+            raise AdmissionRejected(f"AI请求排队已满（{self.name}），请稍后重试", self._estimated_wait(queued), "queue_full")
+
+        start = max(self.virtual_time, self.finish_tags.get(flow, 0.0))
+        self.finish_tags[flow] = start + cost / weight
+        future = asyncio.get_running_loop().create_future()
+        entry = [start, next(self._seq), flow, future]
+        heapq.heappush(self.waiting, entry)
+        self.queued_by_flow[flow] = self.queued_by_flow.get(flow, 0) + 1
+        self.queued_total += 1
+        self.peak_queued = max(self.peak_queued, queued + 1)
+
+        began = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 名额已经分配给了这个请求，归还给下一个
+                self.release()
+            else:
+                future.cancel()
+                self._leave(flow)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected["timeout"] += 1
+                raise AdmissionRejected(f"AI请求排队超时（{self.name}），请稍后重试", self._estimated_wait(self.queued), "timeout")
+            raise
+        self.waits.append(time.monotonic() - began)
+
+    def _leave(self, flow: str):
+        count = self.queued_by_flow.get(flow, 0) - 1
+        if count > 0:
+            self.queued_by_flow[flow] = count
+        else:
+            self.queued_by_flow.pop(flow, None)
+
+    def release(self, held: Optional[float] = None):
+        if held is not None:
+            self.service_time = held if self.service_time is None else EWMA_ALPHA * held + (1 - EWMA_ALPHA) * self.service_time
+        self.in_flight -= 1
+        while self.waiting and self.in_flight < self.limit:
+            start, _, flow, future = heapq.heappop(self.waiting)
+            if future.cancelled():
+                continue
+            self._leave(flow)
+            self.virtual_time = max(self.virtual_time, start)
+            self.in_flight += 1
+            self.admitted += 1
+            future.set_result(None)
+        if len(self.finish_tags) > MAX_TRACKED_USERS:
+            # 结束时间早于虚拟时间的用户与新用户等价，不必记录
+            self.finish_tags = {flow: tag for flow, tag in self.finish_tags.items() if tag > self.virtual_time}
+
+    def snapshot(self) -> Dict:
+        ordered = sorted(self.waits)
+        pick = lambda fraction: round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000) if ordered else None
+        return {
+            "provider": self.name,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_users": len(self.queued_by_flow),
+            "peak_queued": self.peak_queued,
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected": dict(self.rejected),
+            "wait_ms": {"p50": pick(0.5), "p95": pick(0.95)},
+        }
+
+
+class AdmissionController:
+    """
+    admit 在请求进入时按用户扣令牌（超限直接拒绝，后台请求则等待令牌）；
+    slot 在调用服务商期间占用该服务商的一个并发名额
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self.queues = {name: FairQueue(name, limit) for name, limit in limits.items()}
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.rate_limited = 0
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(AI_USER_RATE_PER_MINUTE / 60, AI_USER_BURST)
+            if len(self.buckets) > MAX_TRACKED_USERS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(user_id)
+        return bucket
+
+    async def admit(self, user_id: Optional[str], background: bool = False):
+        # 没有用户的内部调用（如对话摘要）不限速
+        if user_id is None or AI_USER_RATE_PER_MINUTE <= 0:
+            return
+        bucket = self._bucket(user_id)
+        wait = bucket.take()
+        deadline = time.monotonic() + AI_QUEUE_TIMEOUT
+        while wait and background and time.monotonic() + wait <= deadline:
+            # 批量任务等令牌补充，只占用这个用户自己的额度
+            await asyncio.sleep(wait)
+            wait = bucket.take()
+        if not wait:
+            return
+        self.rate_limited += 1
+        raise AdmissionRejected("AI请求过于频繁，请稍后重试", wait, "rate_limited")
+
+    def check(self, user_id: Optional[str], provider: str):
+        """
+        预检（不消耗令牌）：用户已被限速或服务商队列已满时抛出 AdmissionRejected，
+        供接口在写入数据之前尽早返回429
+        """
+        if user_id is not None and AI_USER_RATE_PER_MINUTE > 0:
+            bucket = self._bucket(user_id)
+            bucket.refill()
+            if bucket.tokens < 1:
+                self.rate_limited += 1
+                raise AdmissionRejected("AI请求过于频繁，请稍后重试", (1 - bucket.tokens) / bucket.rate, "rate_limited")
+        queue = self.queues[provider]
+        queued = queue.queued
+        if queued >= AI_QUEUE_MAX_DEPTH or queue.queued_by_flow.get(user_id or "", 0) >= AI_QUEUE_MAX_PER_USER:
+            queue.rejected["queue_full"] += 1
+            raise AdmissionRejected(f"AI请求排队已满（{provider}），请稍后重试", queue._estimated_wait(queued), "queue_full")
+
+    @asynccontextmanager
+    async def slot(self, provider: str, user_id: Optional[str], cost: float, background: bool = False):
+        queue = self.queues[provider]
+        await queue.acquire(user_id or "", cost, AI_BACKGROUND_WEIGHT if background else 1.0)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            queue.release(time.monotonic() - start)
+
+    def snapshot(self) -> Dict:
+        return {
+            "providers": [queue.snapshot() for queue in self.queues.values()],
+            "rate_limited": self.rate_limited,
+            "tracked_users": len(self.buckets),
+            "user_rate_per_minute": AI_USER_RATE_PER_MINUTE,
+            "user_burst": AI_USER_BURST,
+        }
@@ -1,21 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 import json
 import os
 from datetime import datetime, timedelta
 import re
-from typing import Optional
+from typing import List, Optional
 
 from database import get_db
-from models import User, Category
+from models import User, Category, Folder, Note, Tag
 from schemas import (
     AIPolishRequest, AIPolishResponse,
     AIAnalyzeNoteRequest, AIAnalyzeNoteResponse,
+    AIBatchAnalyzeNotesRequest,
     AIParseTaskRequest, AIParseTaskResponse,
     PriorityEnum
 )
-from auth import get_current_user
+from auth import get_current_user, get_current_super_user
 from ai_service import ai_service
+from admission import AdmissionRejected
+from usage_ledger import usage_day, usage_ledger, usage_rows
+from note_classifier import note_classifier
+from sse import format_sse, SSE_HEADERS
 
 router = APIRouter()
 
@@ -23,20 +29,54 @@ router = APIRouter()
 async def polish_text(request: AIPolishRequest, current_user: User = Depends(get_current_user)):
     """AI文本润色"""
     try:
-        polished_text = await ai_service.enhance_text(request.text, request.style)
+        polished_text = await ai_service.enhance_text(request.text, request.style, current_user.id)
         return AIPolishResponse(polished_text=polished_text)
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文本润色失败: {str(e)}")
 
+class NoteLabels:
+    """用户现有的分类、文件夹和标签名称，用于把本地分类器推荐的ID换成名称"""
+
+    def __init__(self, db: Session, user_id: str):
+        self.categories = dict(db.query(Category.id, Category.name).filter(Category.user_id == user_id).all())
+        self.folders = {row.id: row for row in db.query(Folder.id, Folder.name, Folder.category_id).filter(Folder.user_id == user_id).all()}
+        self.tags = dict(db.query(Tag.id, Tag.name).filter(Tag.user_id == user_id).all())
+        self.folder_categories = {folder_id: row.category_id for folder_id, row in self.folders.items()}
+
+    def describe(self, suggestion) -> Optional[dict]:
+        """推荐的ID换成名称；其中有已不存在的分类/文件夹/标签时视为没有把握，返回None"""
+        if suggestion is None:
+            return None
+        category = self.categories.get(suggestion.category_id)
+        folder = self.folders.get(suggestion.folder_id)
+        if category is None or folder is None or any(tag_id not in self.tags for tag_id in suggestion.tag_ids):
+            return None
+        return {"category": category, "folder": folder.name, "tags": [self.tags[tag_id] for tag_id in suggestion.tag_ids]}
+
+async def local_note_analysis(db: Session, user_id: str, labels: NoteLabels, notes: List[tuple]) -> List[Optional[dict]]:
+    """
+    notes 为 [(标题, 正文, 排除的笔记ID)]；本地分类器有把握的返回 {category, folder, tags}，
+    否则为None交给模型。训练、校准和推荐都在线程中进行，不阻塞事件循环
+    """
+    model = await note_classifier.ensure_async(db, user_id)
+    suggestions = await note_classifier.suggest_async(model, notes, labels.folder_categories, labels.tags)
+    return [labels.describe(suggestion) for suggestion in suggestions]
+
 @router.post("/analyze-note", response_model=AIAnalyzeNoteResponse)
 async def analyze_note(request: AIAnalyzeNoteRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """AI分析笔记内容并推荐分类"""
+    """AI分析笔记内容并推荐分类（用户已有足够多的笔记时先用本地分类器，没把握才调用模型）"""
     try:
         # 获取用户的分类
         categories = db.query(Category).filter(Category.user_id == current_user.id).all()
         category_names = [cat.name for cat in categories]
         
-        result = await ai_service.categorize_note(request.title, request.content)
+        local = (await local_note_analysis(db, current_user.id, NoteLabels(db, current_user.id), [(request.title, request.content, None)]))[0]
+        if local is not None:
+            return AIAnalyzeNoteResponse(**local)
+        
+        result = await ai_service.categorize_note(request.title, request.content, current_user.id)
         
         # 验证分类是否存在
         if result["category"] not in category_names:
@@ -47,6 +87,8 @@ async def analyze_note(request: AIAnalyzeNoteRequest, current_user: User = Depen
             folder=result["folder"],
             tags=result["tags"]
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         # 如果出错，返回默认值
         categories = db.query(Category).filter(Category.user_id == current_user.id).all()
@@ -57,6 +99,70 @@ async def analyze_note(request: AIAnalyzeNoteRequest, current_user: User = Depen
             tags=["笔记"]
         )
 
+@router.post("/analyze-notes/batch")
+async def analyze_notes_batch(request: AIBatchAnalyzeNotesRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """批量AI分析笔记 - 以SSE逐条返回分类建议和进度"""
+    query = db.query(Note.id, Note.title, Note.content).filter(Note.user_id == current_user.id)
+    if request.note_ids:
+        query = query.filter(Note.id.in_(request.note_ids))
+    if request.folder_id:
+        folder = db.query(Folder).filter(Folder.id == request.folder_id, Folder.user_id == current_user.id).first()
+        if not folder:
+            raise HTTPException(status_code=404, detail="文件夹不存在")
+        query = query.filter(Note.folder_id == request.folder_id)
+    notes = [{"id": row.id, "title": row.title, "content": row.content} for row in query.all()]
+    
+    categories = db.query(Category.name).filter(Category.user_id == current_user.id).all()
+    category_names = [row.name for row in categories]
+    default_category = category_names[0] if category_names else "工作"
+    
+    # 本地分类器有把握的笔记直接给出结果（不使用笔记自身的训练数据），其余交给模型批量分析
+    labels = NoteLabels(db, current_user.id)
+    local_results = []
+    pending_notes = []
+    analyses = await local_note_analysis(db, current_user.id, labels, [(note["title"], note["content"], note["id"]) for note in notes])
+    for note, local in zip(notes, analyses):
+        if local is not None:
+            local_results.append({"id": note["id"], **local})
+        else:
+            pending_notes.append(note)
+    
+    batch_size = min(max(request.batch_size or ai_service.batch_size, 1), 20)
+    concurrency = min(max(request.concurrency or ai_service.batch_concurrency, 1), 8)
+    
+    async def event_stream():
+        total = len(notes)
+        completed = 0
+        yield format_sse("start", {"total": total})
+        try:
+            async def batches():
+                if local_results:
+                    yield local_results
+                async for results in ai_service.categorize_notes_batch(pending_notes, batch_size, concurrency, current_user.id):
+                    yield results
+            
+            async for results in batches():
+                for result in results:
+                    # 验证分类是否存在
+                    category = result["category"] if result["category"] in category_names else default_category
+                    yield format_sse("result", {
+                        "note_id": result["id"],
+                        "category": category,
+                        "folder": result["folder"],
+                        "tags": result["tags"]
+                    })
+                completed += len(results)
+                yield format_sse("progress", {"completed": completed, "total": total})
+        except AdmissionRejected as e:
+            yield format_sse("error", {"detail": str(e), "retry_after": e.retry_after})
+            return
+        except Exception as e:
+            yield format_sse("error", {"detail": f"批量分析失败: {str(e)}"})
+            return
+        yield format_sse("done", {"completed": completed, "total": total})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @router.post("/parse-task", response_model=AIParseTaskResponse)
 async def parse_task(request: AIParseTaskRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """AI解析自然语言任务"""
@@ -71,7 +177,7 @@ async def parse_task(request: AIParseTaskRequest, current_user: User = Depends(g
             'context': request.context or {}
         }
         
-        result = await ai_service.parse_task(task_input)
+        result = await ai_service.parse_task(task_input, current_user.id)
         
         # 处理返回的任务列表
         tasks = result.get("tasks", [])
@@ -126,6 +232,8 @@ async def parse_task(request: AIParseTaskRequest, current_user: User = Depends(g
         
         return AIParseTaskResponse(tasks=processed_tasks)
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         # 如果解析失败，返回基于规则的解析结果
         title = request.text[:100] if len(request.text) > 100 else request.text
@@ -155,12 +263,58 @@ def get_available_models():
     ]
     return {"models": models, "default": ai_service.default_ai_model, "chat_default": ai_service.default_chat_model}
 
+@router.get("/cache/stats")
+def get_cache_stats(current_user: User = Depends(get_current_user)):
+    """获取AI响应缓存命中统计"""
+    if ai_service.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **ai_service.cache.stats()}
+
+@router.get("/providers")
+def get_provider_status(current_user: User = Depends(get_current_user)):
+    """获取各AI服务商的熔断状态、延迟、错误率和最近一次健康探测结果"""
+    return ai_service.router.snapshot()
+
+@router.get("/admission")
+def get_admission_stats(current_user: User = Depends(get_current_user)):
+    """获取AI请求准入控制指标：各服务商的并发、排队深度、等待时间和拒绝次数"""
+    return ai_service.admission.snapshot()
+
+@router.get("/usage")
+async def get_usage(days: int = Query(7, ge=1, le=366), current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """获取当前用户最近几天按天、模型和调用来源汇总的AI用量，以及今日配额使用情况"""
+    # 先写入缓冲中的记录，保证刚发生的调用也能查到
+    await usage_ledger.flush()
+    end = usage_day()
+    rows = usage_rows(db, end - timedelta(days=days - 1), end, user_id=current_user.id)
+    totals = {key: sum(row[key] for row in rows) for key in ("requests", "errors", "prompt_tokens", "completion_tokens", "total_tokens")}
+    return {"days": days, "rows": rows, "totals": totals, "quota": await usage_ledger.quota_status(current_user.id)}
+
+@router.get("/usage/all")
+async def get_all_usage(days: int = Query(7, ge=1, le=366), current_user: User = Depends(get_current_super_user), db: Session = Depends(get_db)):
+    """获取全体用户最近几天按用户和模型汇总的AI用量（仅超级用户），按token数从高到低排列"""
+    await usage_ledger.flush()
+    end = usage_day()
+    rows = usage_rows(db, end - timedelta(days=days - 1), end, by_user=True)
+    usernames = dict(db.query(User.id, User.username).filter(User.id.in_({row["user_id"] for row in rows})).all())
+    for row in rows:
+        row["username"] = usernames.get(row["user_id"]) if row["user_id"] else None
+    return {"days": days, "rows": rows, "ledger": usage_ledger.stats()}
+
+@router.delete("/cache")
+def clear_cache(current_user: User = Depends(get_current_super_user)):
+    """清空AI响应缓存（仅超级用户）"""
+    if ai_service.cache is not None:
+        ai_service.cache.clear()
+    return {"message": "AI响应缓存已清空"}
+
 @router.post("/test-connection")
 async def test_ai_connection():
     """测试AI服务连接"""
     try:
         response = await ai_service.chat_completion(
-            messages=[{"role": "user", "content": "Hello, please respond with 'AI service is working correctly.'"}]
+            messages=[{"role": "user", "content": "Hello, please respond with 'AI service is working correctly.'"}],
+            feature="test"
         )
         return {"status": "success", "response": response}
     except Exception as e:
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+# 二级缓存命中后攒够这么多条 last_access 再批量写回
+TOUCH_BATCH_SIZE = 100
+
+
+class AIResponseCache:
+    """
+    AI响应缓存 - 以 模型 + 提示词 + 输入 的哈希为键
+
+    两级结构：进程内LRU（一级） + 可选的SQLite持久化（二级，带TTL和容量淘汰）
+
+    SQLite的读写都交给单线程执行器串行执行，不阻塞事件循环；二级命中时的 last_access
+    先记在内存中，攒够一批或下次写入时再批量更新
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 86400,
+        db_path: Optional[str] = None,
+        db_max_entries: int = 20000
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._touched: Dict[str, float] = {}
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.db_path:
+            self._init_db()
+
+    def _init_db(self):
+        """初始化SQLite二级缓存"""
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai-cache")
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ai_response_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ai_response_cache_last_access ON ai_response_cache (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(namespace: str, model: str, messages: List[Dict]) -> str:
+        """根据命名空间、模型和完整消息生成内容寻址的缓存键"""
+        payload = json.dumps(
+            {"namespace": namespace, "model": model, "messages": messages},
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _run_db(self, fn, *args):
+        """在SQLite执行器中运行，等待结果时不占用事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """读取缓存，未命中或已过期返回None（过期的二级条目在下次写入时统一清理）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, serialized = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return json.loads(serialized)
+                del self._memory[key]
+
+        if self._conn is not None:
+            row = await self._run_db(self._db_get, key)
+            if row is not None and row[1] > now:
+                with self._lock:
+                    self._remember(key, row[1], row[0])
+                    self._touched[key] = now
+                    flush = len(self._touched) >= TOUCH_BATCH_SIZE
+                    self.hits += 1
+                    self.db_hits += 1
+                if flush:
+                    self._executor.submit(self._flush_touched)
+                return json.loads(row[0])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """写入缓存（值需可JSON序列化，读取时返回副本，调用方修改不会污染缓存）"""
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, expires_at, serialized)
+        if self._conn is not None:
+            await self._run_db(self._db_set, key, serialized, expires_at, now)
+
+    # 以下 _db_* / _flush_touched / _evict_db 只在SQLite执行器线程中调用
+
+    def _db_get(self, key: str):
+        return self._conn.execute(
+            "SELECT value, expires_at FROM ai_response_cache WHERE key = ?",
+            (key,)
+        ).fetchone()
+
+    def _db_set(self, key: str, serialized: str, expires_at: float, now: float):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO ai_response_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, serialized, expires_at, now)
+        )
+        # 淘汰按 last_access 排序，先写回攒下的访问时间
+        self._flush_touched(commit=False)
+        self._evict_db(now)
+        self._conn.commit()
+
+    def _flush_touched(self, commit: bool = True):
+        """批量更新二级命中条目的 last_access"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        self._conn.executemany(
+            "UPDATE ai_response_cache SET last_access = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in touched.items()]
+        )
+        if commit:
+            self._conn.commit()
+
+    def _remember(self, key: str, expires_at: float, serialized: str):
+        """写入一级LRU，超出容量时淘汰最久未使用的条目"""
+        self._memory[key] = (expires_at, serialized)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_db(self, now: float):
+        """清理二级缓存中的过期条目，并按最近访问时间淘汰超出容量的部分"""
+        self._conn.execute("DELETE FROM ai_response_cache WHERE expires_at <= ?", (now,))
+        count = self._conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0]
+        overflow = count - self.db_max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM ai_response_cache WHERE key IN "
+                "(SELECT key FROM ai_response_cache ORDER BY last_access LIMIT ?)",
+                (overflow,)
+            )
+            with self._lock:
+                self.evictions += overflow
+
+    def _db_clear(self):
+        self._conn.execute("DELETE FROM ai_response_cache")
+        self._conn.commit()
+
+    def _db_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0]
+
+    def clear(self):
+        """清空所有缓存（同步接口，在线程池中调用）"""
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+        if self._conn is not None:
+            self._executor.submit(self._db_clear).result()
+
+    def stats(self) -> Dict:
+        """缓存命中统计（同步接口，在线程池中调用）"""
+        db_entries = None
+        if self._conn is not None:
+            db_entries = self._executor.submit(self._db_count).result()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total * 100, 2) if total > 0 else 0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "db_entries": db_entries
+            }
+
+
+def create_cache_from_env() -> Optional[AIResponseCache]:
+    """根据环境变量创建缓存实例，AI_CACHE_ENABLED=false 时禁用"""
+    if os.getenv("AI_CACHE_ENABLED", "true").lower() in ("false", "0", "no"):
+        return None
+    return AIResponseCache(
+        max_entries=int(os.getenv("AI_CACHE_MAX_ENTRIES", "1024")),
+        ttl=float(os.getenv("AI_CACHE_TTL", "86400")),
+        db_path=os.getenv("AI_CACHE_DB_PATH") or None,
+        db_max_entries=int(os.getenv("AI_CACHE_DB_MAX_ENTRIES", "20000"))
+    )
@@ -1,7 +1,58 @@
 import os
-import requests
-from typing import Dict, List, Optional
+import copy
+import json
+import asyncio
+import hashlib
+import time
+import httpx
+from typing import AsyncIterator, Dict, List, Optional
 from fastapi import HTTPException
+from datetime import datetime
+
+from ai_cache import create_cache_from_env
+from tokenizer import estimate_tokens
+from task_parser import LOCAL_PARSE_CONFIDENCE, parse_task_text
+from provider_router import ProviderError, ProviderRouter
+from admission import AdmissionController, AdmissionRejected
+from usage_ledger import usage_ledger
+
+# 笔记归档系统提示（单条与批量共用）
+CATEGORIZE_SYSTEM_PROMPT = """你是一个智能笔记分类助手。根据笔记的标题和内容，推荐合适的分类、文件夹和标签。
+
+分类指导：
+- 工作：工作任务、会议记录、项目计划、业务相关内容
+- 学习：学习笔记、课程内容、知识总结、技能提升
+- 生活：日常生活、饮食、购物、娱乐、旅行、个人感受
+- 健康：运动、健身、医疗、养生、心理健康
+- 财务：理财、投资、预算、消费记录
+- 灵感：创意想法、随想、计划、目标设定
+
+示例：
+- "我要吃烤鸭" → 分类：生活，文件夹：日常/用餐计划，标签：[今日伙食, 烤鸭, 用餐计划]
+- "项目进度汇报" → 分类：工作，文件夹：项目管理，标签：[项目, 进度, 汇报]
+- "学习Python" → 分类：学习，文件夹：编程学习，标签：[Python, 编程, 学习笔记]
+
+请根据内容准确分类，返回JSON格式：{"category": "分类名", "folder": "文件夹名", "tags": ["标签1", "标签2"]}"""
+
+DEFAULT_CATEGORIZATION = {
+    "category": "未分类",
+    "folder": "默认",
+    "tags": ["笔记"]
+}
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """估算消息列表的提示token数（每条消息另计4个token的角色与分隔开销）"""
+    return sum(estimate_tokens(message.get("content") or "") + 4 for message in messages)
+
+def client_now(context: Dict) -> datetime:
+    """
+    客户端上下文中的当前时间（ISO格式），本地解析与模型提示词使用同一个时钟；
+    带时区的值去掉时区按原样的钟点使用，与提示词中的时间一致。未提供或无法解析时使用服务器时间
+    """
+    try:
+        return datetime.fromisoformat(context['current_time']).replace(tzinfo=None)
+    except (KeyError, TypeError, ValueError):
+        return datetime.now()
 
 class AIService:
     def __init__(self):
@@ -20,23 +71,139 @@ class AIService:
         self.default_chat_model = os.getenv("DEFAULT_CHAT_MODEL", "kimi-k2-latest")
 
         # 支持的模型列表 - Kimi K2作为首选
+        # context_window：模型上下文长度；max_output：单次回复的最大token数；
+        # history_tokens：对话历史（含滚动摘要）的token预算，未设置时使用 CHAT_HISTORY_TOKENS
         self.supported_models = {
-            "kimi-k2-latest": "Kimi K2 (最新版 - 推荐)",
-            "moonshot-v1-8k": "Kimi (Moonshot V1 8K)",
-            "openai/gpt-5": "GPT-5",
-            "openai/gpt-4o": "GPT-4o",
-            "deepseek/deepseek-chat-v3.1": "DeepSeek Chat V3.1",
-            "google/gemini-2.5-flash": "Gemini 2.5 Flash",
-            "google/gemini-2.5-pro": "Gemini 2.5 Pro",
-            "anthropic/claude-sonnet-4": "Claude Sonnet 4"
+            "kimi-k2-latest": {"name": "Kimi K2 (最新版 - 推荐)", "context_window": 131072, "max_output": 8000},
+            "moonshot-v1-8k": {"name": "Kimi (Moonshot V1 8K)", "context_window": 8192, "max_output": 2000, "history_tokens": 3000},
+            "openai/gpt-5": {"name": "GPT-5", "context_window": 400000, "max_output": 4000},
+            "openai/gpt-4o": {"name": "GPT-4o", "context_window": 128000, "max_output": 2000},
+            "deepseek/deepseek-chat-v3.1": {"name": "DeepSeek Chat V3.1", "context_window": 128000, "max_output": 2000},
+            "google/gemini-2.5-flash": {"name": "Gemini 2.5 Flash", "context_window": 1048576, "max_output": 2000},
+            "google/gemini-2.5-pro": {"name": "Gemini 2.5 Pro", "context_window": 1048576, "max_output": 2000},
+            "anthropic/claude-sonnet-4": {"name": "Claude Sonnet 4", "context_window": 200000, "max_output": 2000}
         }
+        self.default_history_tokens = int(os.getenv("CHAT_HISTORY_TOKENS", "6000"))
+        # 估算token数与实际分词的误差余量，以及自适应max_tokens的下限
+        self.context_margin_tokens = int(os.getenv("AI_CONTEXT_MARGIN_TOKENS", "256"))
+        self.min_output_tokens = int(os.getenv("AI_MIN_OUTPUT_TOKENS", "256"))
+
+        # HTTP连接池配置 - 所有请求共享长连接，避免阻塞事件循环
+        self.openrouter_timeout = float(os.getenv("OPENROUTER_TIMEOUT", "60"))  # 增加超时时间以适应GPT-5
+        self.kimi_timeout = float(os.getenv("KIMI_TIMEOUT", "30"))
+        self.connect_timeout = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+        self.openrouter_max_connections = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "50"))
+        self.kimi_max_connections = int(os.getenv("KIMI_MAX_CONNECTIONS", "50"))
+        self.max_keepalive_connections = int(os.getenv("AI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("AI_KEEPALIVE_EXPIRY", "30"))
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+        # 确定性AI辅助功能（润色、归档、任务解析）的响应缓存
+        self.cache = create_cache_from_env()
+
+        # 进行中的相同请求合并（single-flight）
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.coalesced_requests = 0
+
+        # 批量归档：每次请求包含的笔记数与并行请求数
+        self.batch_size = int(os.getenv("AI_BATCH_SIZE", "10"))
+        self.batch_concurrency = int(os.getenv("AI_BATCH_CONCURRENCY", "4"))
+
+        # 服务商路由：熔断、降级与健康探测
+        self.router = ProviderRouter(["kimi", "openrouter"], self._provider_for, self.probe_provider, self._provider_configured)
+
+        # 准入控制：按用户限速，按服务商限制并发上游请求并公平排队
+        self.admission = AdmissionController({
+            "kimi": int(os.getenv("AI_KIMI_CONCURRENCY", str(self.kimi_max_connections))),
+            "openrouter": int(os.getenv("AI_OPENROUTER_CONCURRENCY", str(self.openrouter_max_connections))),
+        })
         
         print(f"AI服务初始化完成 - 默认模型: {self.default_ai_model}")
         print(f"OpenRouter API密钥已配置: {self.openrouter_api_key[:20]}...")
 
-    async def chat_completion(self, messages: List[Dict], model: str = None, stream: bool = False) -> Dict:
+    def _get_client(self, provider: str) -> httpx.AsyncClient:
+        """
+        获取指定服务商的共享异步HTTP客户端（懒加载，按服务商独立连接池）
+        """
+        client = self._clients.get(provider)
+        if client is not None and not client.is_closed:
+            return client
+
+        if provider == "kimi":
+            base_url = self.kimi_base_url
+            read_timeout = self.kimi_timeout
+            max_connections = self.kimi_max_connections
+        else:
+            base_url = self.openrouter_base_url
+            read_timeout = self.openrouter_timeout
+            max_connections = self.openrouter_max_connections
+
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=min(self.max_keepalive_connections, max_connections),
+                keepalive_expiry=self.keepalive_expiry
+            )
+        )
+        self._clients[provider] = client
+        return client
+
+    async def aclose(self):
+        """
+        关闭所有HTTP客户端（应用关闭时调用）
+        """
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    async def _cache_lookup(self, namespace: str, model: str, messages: List[Dict]):
+        """
+        查询响应缓存，返回 (缓存键, 缓存值)；缓存未启用时均为None
+        """
+        if self.cache is None:
+            return None, None
+        key = self.cache.make_key(namespace, model, messages)
+        return key, await self.cache.get(key)
+
+    async def _cache_store(self, key: Optional[str], value):
+        if self.cache is not None and key is not None:
+            await self.cache.set(key, value)
+
+    def model_config(self, model: str) -> Dict:
+        return self.supported_models.get(model) or self.supported_models[self.default_chat_model]
+
+    def history_budget(self, model: str) -> int:
+        """对话历史（含滚动摘要）可使用的token数"""
+        return self.model_config(model).get("history_tokens", self.default_history_tokens)
+
+    def output_budget(self, model: str, messages: List[Dict], requested: Optional[int] = None) -> int:
+        """
+        自适应max_tokens：不超过模型的单次输出上限（或调用方要求的值），
+        且与估算的提示token数之和不超过上下文长度
+        """
+        config = self.model_config(model)
+        limit = min(requested or config["max_output"], config["max_output"])
+        available = config["context_window"] - count_message_tokens(messages) - self.context_margin_tokens
+        return max(min(limit, available), min(limit, self.min_output_tokens))
+
+    async def chat_completion(
+        self,
+        messages: List[Dict],
+        model: str = None,
+        stream: bool = False,
+        max_tokens: Optional[int] = None,
+        user_id: Optional[str] = None,
+        background: bool = False,
+        feature: str = "chat"
+    ) -> Dict:
         """
         AI对话完成
+
+        max_tokens 为回复长度上限，实际值按提示长度自适应调整（见 output_budget）；
+        user_id 用于按用户限速、公平排队和配额，background 表示批量/后台请求（等待限速令牌、排队权重较低），
+        超出限制时抛出 AdmissionRejected；每次上游请求按 feature（调用来源）记入用量流水
         """
         # 如果没有指定模型，使用默认聊天模型
         if model is None:
@@ -46,15 +213,234 @@ class AIService:
         if model not in self.supported_models:
             raise Exception(f"不支持的模型: {model}")
 
-        # Kimi模型统一处理
-        if model.startswith("kimi-") or model == "moonshot-v1-8k":
-            return await self._kimi_chat(messages, model)
+        max_tokens = self.output_budget(model, messages, max_tokens)
+
+        # 流式请求在服务端拼接完整结果后返回
+        if stream:
+            return await self._collect_stream(messages, model, max_tokens, user_id, background, feature)
+
+        await usage_ledger.check_quota(user_id)
+        await self.admission.admit(user_id, background)
+
+        # 相同的请求正在进行时，后到的调用直接等待同一个上游结果
+        key = self._request_key(model, messages, max_tokens)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._dispatch(messages, model, max_tokens, user_id, background, feature))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._finish_inflight(key, t))
+        else:
+            self.coalesced_requests += 1
+
+        # shield：某个调用方被取消（如客户端断开）时不影响其他等待者
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+
+    async def check_admission(self, user_id: Optional[str], model: Optional[str] = None):
+        """请求模型之前预检配额和准入（不消耗额度），超限时抛出 AdmissionRejected"""
+        await usage_ledger.check_quota(user_id)
+        self.admission.check(user_id, self._provider_for(model or self.default_chat_model))
+
+    def _admission_gate(self, messages: List[Dict], max_tokens: int, user_id: Optional[str], background: bool):
+        """调用服务商期间占用一个并发名额，排队代价按提示和回复的token数计（千token）"""
+        cost = (count_message_tokens(messages) + max_tokens) / 1000
+        return lambda provider: self.admission.slot(provider, user_id, cost, background)
+
+    async def _dispatch(
+        self,
+        messages: List[Dict],
+        model: str,
+        max_tokens: Optional[int] = None,
+        user_id: Optional[str] = None,
+        background: bool = False,
+        feature: str = "chat"
+    ) -> Dict:
+        async def call(candidate: str) -> Dict:
+            # 降级到其他模型时按该模型的上下文和输出上限重新计算max_tokens
+            tokens = max_tokens if candidate == model else self.output_budget(candidate, messages, max_tokens)
+            provider = self._provider_for(candidate)
+            start = time.monotonic()
+            try:
+                # Kimi模型统一处理
+                if provider == "kimi":
+                    result = await self._kimi_chat(messages, candidate, tokens)
+                else:
+                    result = await self._openrouter_chat(messages, candidate, tokens)
+            except Exception:
+                usage_ledger.record(user_id, candidate, provider, feature, None, time.monotonic() - start, success=False)
+                raise
+            usage_ledger.record(user_id, candidate, provider, feature, result.get("usage"), time.monotonic() - start)
+            return result
+
+        gate = self._admission_gate(messages, max_tokens or self.output_budget(model, messages), user_id, background)
+        return await self.router.run(model, call, gate)
+
+    def _request_key(self, model: str, messages: List[Dict], max_tokens: Optional[int] = None) -> str:
+        payload = json.dumps({"model": model, "messages": messages, "max_tokens": max_tokens}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _finish_inflight(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已取消时，避免出现"异常未被获取"的警告
+        if not task.cancelled():
+            task.exception()
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict],
+        model: str = None,
+        max_tokens: Optional[int] = None,
+        user_id: Optional[str] = None,
+        background: bool = False,
+        feature: str = "chat"
+    ) -> AsyncIterator[Dict]:
+        """
+        流式AI对话，逐块产出服务商返回的增量内容
+
+        产出 {"type": "delta", "content": "..."}，结束时产出
+        {"type": "done", "model": ..., "finish_reason": ..., "usage": {...}}；
+        user_id、background、feature 的含义同 chat_completion，整个流式响应期间占用服务商的并发名额
+        """
+        if model is None:
+            model = self.default_chat_model
+
+        if model not in self.supported_models:
+            raise Exception(f"不支持的模型: {model}")
+
+        await usage_ledger.check_quota(user_id)
+        await self.admission.admit(user_id, background)
+
+        async def open_stream(candidate: str) -> AsyncIterator[Dict]:
+            tokens = self.output_budget(candidate, messages, max_tokens)
+            provider = self._provider_for(candidate)
+            start = time.monotonic()
+            try:
+                async for event in self._stream_provider(messages, candidate, tokens):
+                    if event["type"] == "done":
+                        usage_ledger.record(user_id, candidate, provider, feature, event["usage"], time.monotonic() - start)
+                    yield event
+            except Exception:
+                usage_ledger.record(user_id, candidate, provider, feature, None, time.monotonic() - start, success=False)
+                raise
+
+        gate = self._admission_gate(messages, self.output_budget(model, messages, max_tokens), user_id, background)
+        async for event in self.router.stream(model, open_stream, gate):
+            yield event
+
+    async def _stream_provider(self, messages: List[Dict], model: str, max_tokens: int) -> AsyncIterator[Dict]:
+        """向模型所属的服务商发起一次流式请求"""
+        provider = self._provider_for(model)
+        if provider == "kimi":
+            headers, data = self._kimi_request(messages, model, stream=True, max_tokens=max_tokens)
         else:
-            return await self._openrouter_chat(messages, model, stream)
+            headers, data = self._openrouter_request(messages, model, stream=True, max_tokens=max_tokens)
+
+        finish_reason = "stop"
+        usage = {}
+        completion_tokens = 0
+        try:
+            async with self._get_client(provider).stream(
+                "POST",
+                "/chat/completions",
+                headers=headers,
+                json=data
+            ) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    provider_name = "Kimi" if provider == "kimi" else "OpenRouter"
+                    raise ProviderError(provider, f"{provider_name} API错误: {response.status_code} - {body}", response.status_code)
+
+                async for line in response.aiter_lines():
+                    # SSE格式：data: {...}，以 data: [DONE] 结束
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                    except json.JSONDecodeError:
+                        continue
 
-    async def _openrouter_chat(self, messages: List[Dict], model: str, stream: bool = False) -> Dict:
+                    # OpenRouter在末尾块返回usage，Kimi放在choice中
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    choice = choices[0]
+                    if choice.get("usage"):
+                        usage = choice["usage"]
+                    if choice.get("finish_reason"):
+                        finish_reason = choice["finish_reason"]
+
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        completion_tokens += estimate_tokens(content)
+                        yield {"type": "delta", "content": content}
+
+        except httpx.TimeoutException:
+            raise ProviderError(provider, "AI服务请求超时，请稍后重试")
+        except httpx.RequestError as e:
+            raise ProviderError(provider, f"网络请求错误: {str(e)}")
+
+        if not usage:
+            # 部分服务商的流式响应不返回用量，按估算值补齐
+            prompt_tokens = count_message_tokens(messages)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        yield {"type": "done", "model": model, "finish_reason": finish_reason, "usage": usage}
+
+    async def _collect_stream(
+        self,
+        messages: List[Dict],
+        model: str,
+        max_tokens: Optional[int] = None,
+        user_id: Optional[str] = None,
+        background: bool = False,
+        feature: str = "chat"
+    ) -> Dict:
         """
-        使用OpenRouter API进行对话 - 优化GPT-5使用
+        消费流式响应并拼接为与非流式调用相同的结果格式（model为实际应答的模型，发生降级时为备用模型）
+        """
+        parts = []
+        result = {"content": "", "model": model, "usage": {}, "finish_reason": "stop"}
+        async for event in self.stream_chat_completion(messages, model, max_tokens, user_id, background, feature):
+            if event["type"] == "delta":
+                parts.append(event["content"])
+            else:
+                result.update(model=event["model"], finish_reason=event["finish_reason"], usage=event["usage"])
+        result["content"] = "".join(parts)
+        return result
+
+    def _is_kimi_model(self, model: str) -> bool:
+        return model.startswith("kimi-") or model == "moonshot-v1-8k"
+
+    def _provider_for(self, model: str) -> str:
+        return "kimi" if self._is_kimi_model(model) else "openrouter"
+
+    def _provider_configured(self, provider: str) -> bool:
+        if provider == "kimi":
+            return bool(self.kimi_api_key)
+        return self.openrouter_api_key != "demo_key"
+
+    async def probe_provider(self, provider: str):
+        """
+        健康探测：请求服务商的模型列表接口（不产生token费用），失败时抛出异常
+        """
+        api_key = self.kimi_api_key if provider == "kimi" else self.openrouter_api_key
+        try:
+            response = await self._get_client(provider).get("/models", headers={"Authorization": f"Bearer {api_key}"})
+        except httpx.TimeoutException:
+            raise ProviderError(provider, "健康探测超时")
+        except httpx.RequestError as e:
+            raise ProviderError(provider, f"网络请求错误: {str(e)}")
+        if response.status_code != 200:
+            raise ProviderError(provider, f"健康探测失败: {response.status_code} - {response.text[:200]}", response.status_code)
+
+    def _openrouter_request(self, messages: List[Dict], model: str, stream: bool = False, max_tokens: Optional[int] = None):
+        """
+        构建OpenRouter请求头和请求体
         """
         headers = {
             "Authorization": f"Bearer {self.openrouter_api_key}",
@@ -83,13 +469,55 @@ class AIService:
                 "temperature": 0.7,
                 "max_tokens": 2000
             }
+        if max_tokens:
+            data["max_tokens"] = max_tokens
+        return headers, data
+
+    def _kimi_request(self, messages: List[Dict], model: str, stream: bool = False, max_tokens: Optional[int] = None):
+        """
+        构建Kimi请求头和请求体
+        """
+        headers = {
+            "Authorization": f"Bearer {self.kimi_api_key}",
+            "Content-Type": "application/json"
+        }
+
+        # Kimi K2模型配置优化
+        if model == "kimi-k2-latest":
+            data = {
+                "model": "kimi-latest",  # 使用最新的K2模型
+                "messages": messages,
+                "temperature": 0.8,     # K2模型适合更高的温度值
+                "max_tokens": 8000,     # K2支持更长的输出
+                "top_p": 0.95,
+                "frequency_penalty": 0.1,
+                "presence_penalty": 0.1
+            }
+        else:
+            # 兼容旧版Kimi模型
+            data = {
+                "model": model,
+                "messages": messages,
+                "temperature": 0.7,
+                "max_tokens": 2000
+            }
+        if max_tokens:
+            data["max_tokens"] = max_tokens
+        if stream:
+            data["stream"] = True
+        return headers, data
+
+    async def _openrouter_chat(self, messages: List[Dict], model: str, max_tokens: Optional[int] = None) -> Dict:
+        """
+        使用OpenRouter API进行对话 - 优化GPT-5使用
+        """
+        headers, data = self._openrouter_request(messages, model, max_tokens=max_tokens)
         
         try:
-            response = requests.post(
-                f"{self.openrouter_base_url}/chat/completions",
+            response = await self._get_client("openrouter").post(
+                "/chat/completions",
                 headers=headers,
-                json=data,
-                timeout=60  # 增加超时时间以适应GPT-5
+                json=data
             )
             
             if response.status_code != 200:
@@ -100,7 +528,7 @@ class AIService:
                         error_detail += f" - {error_json['error'].get('message', response.text)}"
                 except:
                     error_detail += f" - {response.text}"
-                raise Exception(error_detail)
+                raise ProviderError("openrouter", error_detail, response.status_code)
             
             result = response.json()
             
@@ -116,51 +544,34 @@ class AIService:
                 "finish_reason": result["choices"][0].get("finish_reason", "stop")
             }
             
-        except requests.exceptions.Timeout:
-            raise Exception("AI服务请求超时，请稍后重试")
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"网络请求错误: {str(e)}")
+        except httpx.TimeoutException:
+            raise ProviderError("openrouter", "AI服务请求超时，请稍后重试")
+        except httpx.RequestError as e:
+            raise ProviderError("openrouter", f"网络请求错误: {str(e)}")
+        except ProviderError:
+            raise
         except Exception as e:
             raise Exception(f"OpenRouter服务错误: {str(e)}")
 
-    async def _kimi_chat(self, messages: List[Dict], model: str = "kimi-k2-latest") -> Dict:
+    async def _kimi_chat(self, messages: List[Dict], model: str = "kimi-k2-latest", max_tokens: Optional[int] = None) -> Dict:
         """
         使用Kimi API进行对话 - 支持K2模型
         """
-        headers = {
-            "Authorization": f"Bearer {self.kimi_api_key}",
-            "Content-Type": "application/json"
-        }
-
-        # Kimi K2模型配置优化
-        if model == "kimi-k2-latest":
-            data = {
-                "model": "kimi-latest",  # 使用最新的K2模型
-                "messages": messages,
-                "temperature": 0.8,     # K2模型适合更高的温度值
-                "max_tokens": 8000,     # K2支持更长的输出
-                "top_p": 0.95,
-                "frequency_penalty": 0.1,
-                "presence_penalty": 0.1
-            }
-        else:
-            # 兼容旧版Kimi模型
-            data = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
+        headers, data = self._kimi_request(messages, model, max_tokens=max_tokens)
         
-        response = requests.post(
-            f"{self.kimi_base_url}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        try:
+            response = await self._get_client("kimi").post(
+                "/chat/completions",
+                headers=headers,
+                json=data
+            )
+        except httpx.TimeoutException:
+            raise ProviderError("kimi", "AI服务请求超时，请稍后重试")
+        except httpx.RequestError as e:
+            raise ProviderError("kimi", f"网络请求错误: {str(e)}")
         
         if response.status_code != 200:
-            raise Exception(f"Kimi API错误: {response.status_code} - {response.text}")
+            raise ProviderError("kimi", f"Kimi API错误: {response.status_code} - {response.text}", response.status_code)
         
         result = response.json()
 
@@ -171,7 +582,7 @@ class AIService:
             "finish_reason": result["choices"][0].get("finish_reason", "stop")
         }
 
-    async def enhance_text(self, text: str, style: str = "professional") -> str:
+    async def enhance_text(self, text: str, style: str = "professional", user_id: Optional[str] = None) -> str:
         """
         AI文本润色
         """
@@ -197,55 +608,137 @@ class AIService:
             }
         ]
         
-        result = await self.chat_completion(messages, self.default_ai_model)
+        cache_key, cached = await self._cache_lookup("enhance_text", self.default_ai_model, messages)
+        if cached is not None:
+            return cached
+        
+        result = await self.chat_completion(messages, self.default_ai_model, user_id=user_id, feature="polish")
+        await self._cache_store(cache_key, result["content"])
         return result["content"]
 
-    async def categorize_note(self, title: str, content: str) -> Dict:
-        """
-        AI智能归档笔记
-        """
-        messages = [
+    def _categorize_messages(self, title: str, content: str) -> List[Dict]:
+        return [
             {
                 "role": "system",
-                "content": """你是一个智能笔记分类助手。根据笔记的标题和内容，推荐合适的分类、文件夹和标签。
-
-分类指导：
-- 工作：工作任务、会议记录、项目计划、业务相关内容
-- 学习：学习笔记、课程内容、知识总结、技能提升
-- 生活：日常生活、饮食、购物、娱乐、旅行、个人感受
-- 健康：运动、健身、医疗、养生、心理健康
-- 财务：理财、投资、预算、消费记录
-- 灵感：创意想法、随想、计划、目标设定
-
-示例：
-- "我要吃烤鸭" → 分类：生活，文件夹：日常/用餐计划，标签：[今日伙食, 烤鸭, 用餐计划]
-- "项目进度汇报" → 分类：工作，文件夹：项目管理，标签：[项目, 进度, 汇报]
-- "学习Python" → 分类：学习，文件夹：编程学习，标签：[Python, 编程, 学习笔记]
-
-请根据内容准确分类，返回JSON格式：{"category": "分类名", "folder": "文件夹名", "tags": ["标签1", "标签2"]}"""
+                "content": CATEGORIZE_SYSTEM_PROMPT
             },
             {
                 "role": "user",
-                "content": f"标题：{title}\n内容：{content[:500]}..."
+                "content": f"标题：{title}\n内容：{(content or '')[:500]}..."
             }
         ]
+
+    async def categorize_note(self, title: str, content: str, user_id: Optional[str] = None) -> Dict:
+        """
+        AI智能归档笔记
+        """
+        messages = self._categorize_messages(title, content)
         
-        result = await self.chat_completion(messages, self.default_ai_model)
+        cache_key, cached = await self._cache_lookup("categorize_note", self.default_ai_model, messages)
+        if cached is not None:
+            return cached
+        
+        result = await self.chat_completion(messages, self.default_ai_model, user_id=user_id, feature="categorize")
         
         try:
             import json
-            return json.loads(result["content"])
+            categorized = json.loads(result["content"])
+            await self._cache_store(cache_key, categorized)
+            return categorized
         except:
-            return {
-                "category": "未分类",
-                "folder": "默认",
-                "tags": ["笔记"]
+            return dict(DEFAULT_CATEGORIZATION)
+
+    async def categorize_notes_batch(
+        self,
+        notes: List[Dict],
+        batch_size: int = None,
+        concurrency: int = None,
+        user_id: Optional[str] = None
+    ) -> AsyncIterator[List[Dict]]:
+        """
+        批量AI归档笔记
+
+        notes 为 [{"id", "title", "content"}]。已缓存的笔记直接返回，其余每 batch_size 条
+        合并为一次模型请求，最多 concurrency 个请求并行；按完成顺序逐批产出
+        [{"id", "category", "folder", "tags"}]。模型请求按后台请求排队，不挤占其他用户的交互请求
+        """
+        batch_size = batch_size or self.batch_size
+        concurrency = concurrency or self.batch_concurrency
+
+        # 先命中单条归档的缓存，避免重复计费
+        cached_results = []
+        pending = []
+        for note in notes:
+            messages = self._categorize_messages(note["title"], note["content"])
+            cache_key, cached = await self._cache_lookup("categorize_note", self.default_ai_model, messages)
+            if cached is not None:
+                cached_results.append({"id": note["id"], **cached})
+            else:
+                pending.append((note, cache_key))
+        if cached_results:
+            yield cached_results
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_batch(batch):
+            async with semaphore:
+                return await self._categorize_batch(batch, user_id)
+
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        for future in asyncio.as_completed([run_batch(batch) for batch in batches]):
+            yield await future
+
+    async def _categorize_batch(self, batch: List[tuple], user_id: Optional[str] = None) -> List[Dict]:
+        """
+        一次模型请求归档多条笔记，以序号对应结果；解析失败的笔记使用默认分类
+        """
+        note_blocks = []
+        for index, (note, _) in enumerate(batch, start=1):
+            note_blocks.append(f"[{index}]\n标题：{note['title']}\n内容：{(note['content'] or '')[:500]}...")
+
+        messages = [
+            {
+                "role": "system",
+                "content": CATEGORIZE_SYSTEM_PROMPT + """
+
+批量模式：用户会一次提供多条笔记，每条以[序号]开头。请逐条分类，返回JSON格式：
+{"results": [{"index": 序号, "category": "分类名", "folder": "文件夹名", "tags": ["标签1", "标签2"]}]}"""
+            },
+            {
+                "role": "user",
+                "content": "\n\n".join(note_blocks)
             }
+        ]
 
-    async def parse_task(self, task_input) -> Dict:
+        by_index = {}
+        try:
+            result = await self.chat_completion(messages, self.default_ai_model, user_id=user_id, background=True, feature="categorize_batch")
+            for item in json.loads(result["content"]).get("results", []):
+                by_index[int(item["index"])] = {
+                    "category": item["category"],
+                    "folder": item["folder"],
+                    "tags": item.get("tags", [])
+                }
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            print(f"批量归档失败，使用默认分类: {e}")
+
+        results = []
+        for index, (note, cache_key) in enumerate(batch, start=1):
+            categorized = by_index.get(index)
+            if categorized is not None:
+                await self._cache_store(cache_key, categorized)
+            else:
+                categorized = dict(DEFAULT_CATEGORIZATION)
+            results.append({"id": note["id"], **categorized})
+        return results
+
+    async def parse_task(self, task_input, user_id: Optional[str] = None) -> Dict:
         """
         AI解析任务描述，支持智能任务拆分，如果AI不可用则使用基于规则的解析
         """
+        now = None
         try:
             # 处理输入参数
             if isinstance(task_input, str):
@@ -256,6 +749,12 @@ class AIService:
                 description = task_input.get('text', '')
                 context = task_input.get('context', {})
                 split_tasks = context.get('split_tasks', False)
+            now = client_now(context)
+            
+            # 本地解析器对常见的时间、优先级和列表表达有足够把握时直接返回，不调用模型
+            local = parse_task_text(description, now)
+            if local.confidence >= LOCAL_PARSE_CONFIDENCE:
+                return {"tasks": local.tasks}
             
             # 构建系统提示词
             system_prompt = """你是一个智能任务解析助手。根据用户的自然语言描述，解析出任务的详细信息。
@@ -343,7 +842,14 @@ class AIService:
                 }
             ]
             
-            result = await self.chat_completion(messages, self.default_ai_model)
+            # 相对日期（明天、下周）依赖客户端当天的日期，按日期划分缓存；提示词中的当前时间精确到毫秒，
+            # 不参与缓存键，键只由描述、日期和可用项目决定
+            cache_input = [{"description": description, "projects": [p['name'] for p in context.get('projects') or []]}]
+            cache_key, cached = await self._cache_lookup(f"parse_task:{now.date().isoformat()}", self.default_ai_model, cache_input)
+            if cached is not None:
+                return cached
+            
+            result = await self.chat_completion(messages, self.default_ai_model, user_id=user_id, feature="parse_task")
             
             import json
             parsed_result = json.loads(result["content"])
@@ -352,102 +858,41 @@ class AIService:
             if "tasks" not in parsed_result and "title" in parsed_result:
                 parsed_result = {"tasks": [parsed_result]}
             
+            await self._cache_store(cache_key, parsed_result)
             return parsed_result
             
+        except AdmissionRejected:
+            raise
         except Exception as e:
             print(f"AI解析失败，使用基于规则的解析: {e}")
             # 降级到基于规则的解析
-            return {"tasks": [self._rule_based_parse_task(description if isinstance(task_input, str) else task_input.get('text', ''))]}
+            return {"tasks": self._rule_based_parse_task(description if isinstance(task_input, str) else task_input.get('text', ''), now)}
     
-    def _rule_based_parse_task(self, description: str) -> Dict:
+    def _rule_based_parse_task(self, description: str, now: Optional[datetime] = None) -> List[Dict]:
         """
-        基于规则的任务解析（AI不可用时的降级方案）
+        基于规则的任务解析（AI不可用时的降级方案）：采用本地解析器的结果，不论置信度高低
         """
-        import re
-        from datetime import datetime, timedelta
-        
-        # 提取标题（取前50个字符或第一句话）
-        title = description.split('。')[0][:50] if '。' in description else description[:50]
-        
-        # 检测优先级关键词
-        priority = "medium"
-        if any(word in description for word in ["紧急", "重要", "高优先级", "urgent", "important"]):
-            priority = "high"
-        elif any(word in description for word in ["低优先级", "不急", "可选", "low"]):
-            priority = "low"
-        
-        # 检测时间相关信息
-        due_date = None
-        time_patterns = [
-            r"明天",
-            r"后天", 
-            r"下周",
-            r"本周",
-            r"(\d+)天后",
-            r"(\d+)周后"
-        ]
-        
-        for pattern in time_patterns:
-            if re.search(pattern, description):
-                if "明天" in description:
-                    due_date = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-                elif "后天" in description:
-                    due_date = (datetime.now() + timedelta(days=2)).strftime("%Y-%m-%d")
-                elif "下周" in description:
-                    due_date = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
-                break
-        
-        # 检测子任务（包含"包括"、"需要"等关键词）
-        subtasks = []
-        if "包括" in description:
-            parts = description.split("包括")[1] if "包括" in description else ""
-            if parts:
-                subtasks = [task.strip() for task in re.split(r'[，,、和]', parts) if task.strip()]
-        elif "需要" in description:
-            parts = description.split("需要")[1] if "需要" in description else ""
-            if parts:
-                subtasks = [task.strip() for task in re.split(r'[，,、和]', parts) if task.strip()]
-        
-        # 检测开始和结束时间
-        start_time = None
-        end_time = None
-        
-        # 简单的时间解析
-        if "明天" in description:
-            from datetime import datetime, timedelta
-            tomorrow = datetime.now() + timedelta(days=1)
-            if "上午" in description:
-                start_time = tomorrow.replace(hour=9, minute=0, second=0).isoformat()
-            elif "下午" in description:
-                start_time = tomorrow.replace(hour=14, minute=0, second=0).isoformat()
-            elif "晚上" in description:
-                start_time = tomorrow.replace(hour=19, minute=0, second=0).isoformat()
-        
-        # 确定时间范围类型
-        time_range = "flexible"  # 默认灵活时间
-        if start_time and end_time:
-            time_range = "specific"
-        elif due_date:
-            time_range = "deadline"
-        
-        return {
-            "title": title,
+        tasks = parse_task_text(description, now).tasks
+        if tasks:
+            return tasks
+        return [{
+            "title": description[:30],
             "description": description,
-            "priority": priority,
-            "start_time": start_time,
-            "end_time": end_time,
-            "due_date": due_date,
+            "priority": "medium",
+            "start_time": None,
+            "end_time": None,
+            "due_date": None,
             "category": "工作",  # 默认分类
             "tags": [],
-            "subtasks": subtasks[:3],  # 最多3个子任务
-            "time_range": time_range
-        }
+            "subtasks": [],
+            "time_range": "flexible"
+        }]
 
     def get_available_models(self) -> Dict[str, str]:
         """
-        获取可用的AI模型列表
+        获取可用的AI模型列表（模型ID → 显示名称）
         """
-        return self.supported_models
+        return {model: config["name"] for model, config in self.supported_models.items()}
 
 # 全局AI服务实例
 ai_service = AIService()
@@ -4,9 +4,12 @@ import os
 from dotenv import load_dotenv
 
 # 新增导入：数据库与路由模块
-from database import get_db, engine, Base
-import notes, tasks, chat, chat_test, pomodoro, auth, ai, users
+from database import get_db, engine, run_migrations, dispose_async_engines
+import notes, tasks, chat, chat_test, pomodoro, auth, ai, users, search
 from auth import create_super_user
+from ai_service import ai_service
+from admission import AdmissionRejected, admission_rejected_handler
+from usage_ledger import usage_ledger
 
 # 加载环境变量
 load_dotenv()
@@ -25,19 +28,40 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 前端需要读取分页游标、笔记树ETag和限流后的重试等待时间
+    expose_headers=["X-Next-Cursor", "ETag", "Retry-After"],
 )
 
+# AI请求超出限速或排队已满时返回429和Retry-After
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+
 # 在应用启动时初始化数据库和超级用户
 @app.on_event("startup")
 async def startup_event():
-    # 创建数据库表（若不存在）
-    Base.metadata.create_all(bind=engine)
+    # 创建/升级数据库表（Alembic迁移）
+    run_migrations(engine)
     # 创建默认超级用户
     db = next(get_db())
     try:
+        # 创建全文检索索引（首次创建时回填已有数据）
+        if search.init_search_index(engine):
+            search.rebuild_index(db)
+            db.commit()
         create_super_user(db)
     finally:
         db.close()
+    # 定期探测处于熔断状态的AI服务商，恢复后自动关闭熔断
+    ai_service.router.start_prober()
+    # 后台批量写入AI用量流水
+    usage_ledger.start()
+
+# 应用关闭时停止健康探测、写入剩余的AI用量，释放AI服务的HTTP连接池和异步数据库连接池
+@app.on_event("shutdown")
+async def shutdown_event():
+    await ai_service.router.stop_prober()
+    await usage_ledger.stop()
+    await ai_service.aclose()
+    await dispose_async_engines()
 
 # 根路由
 @app.get("/")
@@ -65,7 +89,8 @@ app.include_router(notes.router, prefix="/api/notes", tags=["笔记"])
 app.include_router(tasks.router, prefix="/api/tasks", tags=["任务"]) 
 app.include_router(chat_test.router, prefix="/api/chat", tags=["对话"]) 
 app.include_router(pomodoro.router, prefix="/api/pomodoro", tags=["番茄钟"]) 
-app.include_router(ai.router, prefix="/api/ai", tags=["AI服务"]) 
+app.include_router(ai.router, prefix="/api/ai", tags=["AI服务"])
+app.include_router(search.router, prefix="/api/search", tags=["全文检索"]) 
 
 # 本地直接运行（Render 会忽略此分支，由 uvicorn/gunicorn 启动）
 if __name__ == "__main__":
@@ -1,16 +1,36 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, get_async_db
 from models import User, Category, Folder
 from schemas import Token, UserLogin
+from principal_cache import principal_cache
 
-# 密码加密上下文
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 密码加密上下文：bcrypt代价固定为 BCRYPT_ROUNDS，其他代价的旧哈希在登录成功时自动重新哈希
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+
+# 密码哈希/校验专用线程池：bcrypt每次耗时数百毫秒，放到事件循环之外执行，
+# 线程数有上限，登录高峰时多出的请求排队而不是占满CPU
+password_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    thread_name_prefix="password-hash"
+)
 
 # JWT配置
 SECRET_KEY = "cortex-ai-workspace-secret-key-2025"
@@ -28,6 +48,14 @@ def get_password_hash(password):
     """获取密码哈希"""
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password):
+    """在密码线程池中验证密码"""
+    return await asyncio.get_running_loop().run_in_executor(password_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    """在密码线程池中计算密码哈希"""
+    return await asyncio.get_running_loop().run_in_executor(password_executor, get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """创建访问令牌"""
     to_encode = data.copy()
@@ -39,30 +67,59 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """验证JWT令牌"""
+def decode_token(token: str) -> dict:
+    """解码并校验JWT令牌，返回载荷"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("sub") is None:
             raise credentials_exception
-        return username
+        return payload
     except JWTError:
         raise credentials_exception
 
-def get_current_user(username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    """获取当前用户"""
-    user = db.query(User).filter(User.username == username).first()
+def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """验证JWT令牌"""
+    return decode_token(credentials.credentials)["sub"]
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    """获取当前用户（重复请求命中认证缓存时不解码令牌、不查询数据库）"""
+    token = credentials.credentials
+    snapshot = principal_cache.get(token)
+    if snapshot is not None:
+        return db.merge(snapshot, load=False)
+    
+    generation = principal_cache.generation()
+    payload = decode_token(token)
+    user = db.query(User).filter(User.username == payload["sub"]).first()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
+    principal_cache.put(token, generation, user, payload.get("exp"))
+    return user
+
+async def get_current_user_async(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)):
+    """获取当前用户（异步会话版本，供使用 get_async_db 的路由使用）"""
+    token = credentials.credentials
+    snapshot = principal_cache.get(token)
+    if snapshot is not None:
+        return await db.merge(snapshot, load=False)
+    
+    generation = principal_cache.generation()
+    payload = decode_token(token)
+    user = (await db.execute(select(User).where(User.username == payload["sub"]))).scalar_one_or_none()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    principal_cache.put(token, generation, user, payload.get("exp"))
     return user
 
 def get_current_active_user(current_user: User = Depends(get_current_user)):
@@ -89,6 +146,27 @@ def authenticate_user(db: Session, username: str, password: str):
         return False
     return user
 
+async def authenticate_user_async(db: Session, username: str, password: str):
+    """
+    认证用户（密码校验在线程池中执行，不阻塞事件循环）
+
+    哈希的bcrypt代价与当前配置不一致时，用本次的明文密码重新哈希并由调用方随事务提交
+    """
+    user = db.query(User).filter(User.username == username).first()
+    if not user:
+        return False
+    hashed_password = user.hashed_password
+    # 结束只读事务，排队等待哈希期间不占用连接池中的连接
+    db.commit()
+    valid, new_hash = await asyncio.get_running_loop().run_in_executor(
+        password_executor, pwd_context.verify_and_update, password, hashed_password
+    )
+    if not valid:
+        return False
+    if new_hash:
+        user.hashed_password = new_hash
+    return user
+
 def create_super_user(db: Session):
     """创建超级用户"""
     # 检查是否已存在超级用户
@@ -185,13 +263,17 @@ router = APIRouter()
 @router.post("/login", response_model=Token)
 async def login(user_login: UserLogin, db: Session = Depends(get_db)):
     """用户登录"""
-    user = authenticate_user(db, user_login.username, user_login.password)
+    user = await authenticate_user_async(db, user_login.username, user_login.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if db.is_modified(user):
+        # 登录时重新哈希了密码
+        db.commit()
+        principal_cache.invalidate_user(user.id)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
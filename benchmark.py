@@ -0,0 +1,1184 @@
+#!/usr/bin/env python3
+"""
+性能基准测试脚本
+用法：python benchmark.py [场景 ...]，不指定场景时运行全部场景
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+# 添加当前目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+import models
+
+
+class BenchDatabase:
+    """临时SQLite数据库，结束时自动删除"""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="cortex-bench-")
+        self.url = f"sqlite:///{os.path.join(self.directory, 'bench.db')}"
+        self.engine = create_engine(self.url, connect_args={"check_same_thread": False})
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+
+    def close(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QueryCounter:
+    """统计代码块内执行的SQL语句数"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+def measure(func, repeat: int = 5) -> float:
+    """返回多次执行的耗时中位数（毫秒）"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def create_bench_user(db, username: str = "bench") -> models.User:
+    user = models.User(username=username, email=f"{username}@bench.local", hashed_password="x")
+    db.add(user)
+    db.commit()
+    return user
+
+
+def seed_notes(db, user: models.User, categories: int, folders_per_category: int, notes_per_folder: int):
+    """批量生成分类/文件夹/笔记，笔记内容约2KB以模拟真实正文"""
+    content = "笔记正文内容。" * 300
+    now = datetime.utcnow()
+    for c in range(categories):
+        category = models.Category(name=f"分类{c}", user_id=user.id)
+        db.add(category)
+        db.flush()
+        for f in range(folders_per_category):
+            folder = models.Folder(name=f"文件夹{c}-{f}", category_id=category.id, user_id=user.id)
+            db.add(folder)
+            db.flush()
+            db.add_all([
+                models.Note(
+                    title=f"笔记{c}-{f}-{n}",
+                    content=content,
+                    folder_id=folder.id,
+                    user_id=user.id,
+                    created_at=now - timedelta(minutes=n),
+                    updated_at=now - timedelta(minutes=n)
+                )
+                for n in range(notes_per_folder)
+            ])
+    db.commit()
+
+
+def legacy_notes_tree(db, user_id: str):
+    """旧版实现（逐分类、逐文件夹查询），仅用于对比"""
+    tree = []
+    for category in db.query(models.Category).filter(models.Category.user_id == user_id).all():
+        category_item = {"id": category.id, "name": category.name, "children": []}
+        for folder in db.query(models.Folder).filter(models.Folder.category_id == category.id).all():
+            folder_item = {"id": folder.id, "name": folder.name, "children": []}
+            for note in db.query(models.Note).filter(models.Note.folder_id == folder.id).all():
+                folder_item["children"].append({"id": note.id, "name": note.title})
+            category_item["children"].append(folder_item)
+        tree.append(category_item)
+    return tree
+
+
+def bench_notes_tree():
+    """笔记树：查询次数与耗时随文件夹/笔记数量的变化"""
+    from notes import build_notes_tree
+
+    print("🌲 笔记树 GET /api/notes/tree")
+    print(f"{'文件夹':>8} {'笔记':>8} {'旧版查询':>8} {'旧版ms':>10} {'新版查询':>8} {'新版ms':>10}")
+    for categories, folders_per_category, notes_per_folder in [(5, 4, 10), (10, 10, 10), (20, 10, 20), (20, 25, 20)]:
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            seed_notes(db, user, categories, folders_per_category, notes_per_folder)
+
+            with QueryCounter(bench.engine) as legacy_counter:
+                legacy_notes_tree(db, user.id)
+            legacy_ms = measure(lambda: legacy_notes_tree(db, user.id), repeat=3)
+
+            with QueryCounter(bench.engine) as counter:
+                build_notes_tree(db, user.id)
+            new_ms = measure(lambda: build_notes_tree(db, user.id))
+            db.close()
+
+        folders = categories * folders_per_category
+        print(f"{folders:>8} {folders * notes_per_folder:>8} {legacy_counter.count:>8} {legacy_ms:>10.1f} {counter.count:>8} {new_ms:>10.1f}")
+    print()
+
+
+def seed_tasks(db, user: models.User, count: int, categories: int = 5):
+    """
+    批量生成分布在最近两年的任务：一个月之前创建的大多已完成，
+    近期任务的状态/优先级/分类轮换，截止时间为创建后三天
+    """
+    from task_stats import rebuild_task_counters
+
+    category_ids = []
+    for c in range(categories):
+        category = models.Category(name=f"任务分类{c}", user_id=user.id)
+        db.add(category)
+        db.flush()
+        category_ids.append(category.id)
+    statuses, priorities = list(models.StatusEnum), list(models.PriorityEnum)
+    now = datetime.utcnow()
+    tasks = []
+    for n in range(count):
+        created_at = now - timedelta(hours=n * 2 * 365 * 24 / count)
+        recent = now - created_at < timedelta(days=30)
+        tasks.append(models.Task(
+            title=f"任务{n}",
+            user_id=user.id,
+            status=statuses[n % len(statuses)] if recent or n % 20 == 0 else models.StatusEnum.done,
+            priority=priorities[n % len(priorities)],
+            category_id=category_ids[n % categories],
+            created_at=created_at,
+            end_time=created_at + timedelta(days=3)
+        ))
+    db.add_all(tasks)
+    # 批量插入绕过了任务写入路径，按迁移回填的方式汇总计数
+    rebuild_task_counters(db, user.id)
+    db.commit()
+
+
+def legacy_task_stats(db, user_id: str):
+    """旧版实现（每项统计一次COUNT），仅用于对比"""
+    Task = models.Task
+    base = db.query(Task).filter(Task.user_id == user_id)
+    total = base.count()
+    counts = {status: base.filter(Task.status == status).count() for status in models.StatusEnum}
+    high = base.filter(Task.priority == models.PriorityEnum.high).count()
+    return total, counts, high
+
+
+def bench_task_stats():
+    """任务统计：旧版五次COUNT与计数表（含分类/逾期/每周趋势）对比"""
+    from task_stats import compute_task_stats
+
+    print("📊 任务统计 GET /api/tasks/stats/summary")
+    print(f"{'任务数':>8} {'旧版查询':>8} {'旧版ms':>10} {'新版查询':>8} {'新版ms':>10}")
+    for count in [100, 1000, 10000, 50000]:
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            seed_tasks(db, user, count)
+
+            with QueryCounter(bench.engine) as legacy_counter:
+                legacy_task_stats(db, user.id)
+            legacy_ms = measure(lambda: legacy_task_stats(db, user.id))
+
+            with QueryCounter(bench.engine) as counter:
+                compute_task_stats(db, user.id)
+            new_ms = measure(lambda: compute_task_stats(db, user.id))
+            db.close()
+
+        print(f"{count:>8} {legacy_counter.count:>8} {legacy_ms:>10.1f} {counter.count:>8} {new_ms:>10.1f}")
+    print()
+
+
+def seed_calendar_tasks(db, user: models.User, count: int, years: int = 3):
+    """生成分布在years年内的日程：大多为一小时内的安排，少数为多日、数周和数月的长任务"""
+    import random
+
+    rng = random.Random(count)
+    durations = [(0.70, timedelta(hours=1)), (0.85, timedelta(hours=8)), (0.95, timedelta(days=4)), (0.99, timedelta(days=21)), (1.0, timedelta(days=120))]
+    origin = datetime(2024, 1, 1)
+    tasks = []
+    for n in range(count):
+        start_time = origin + timedelta(minutes=rng.randrange(years * 365 * 24 * 60))
+        draw = rng.random()
+        duration = next(duration for threshold, duration in durations if draw <= threshold)
+        tasks.append(models.Task(title=f"日程{n}", user_id=user.id, start_time=start_time, end_time=start_time + duration))
+    db.add_all(tasks)
+    db.commit()
+
+
+def legacy_calendar_events(db, user_id: str, window_start: datetime, window_end: datetime):
+    """旧版实现：只返回完全落在区间内的任务，循环内重建颜色表，仅用于对比"""
+    Task = models.Task
+    events = []
+    for task in db.query(Task).filter(Task.user_id == user_id, Task.start_time >= window_start, Task.end_time <= window_end).all():
+        color_map = {"high": "#ff4757", "medium": "#ffa502", "low": "#2ed573"}
+        events.append({"id": task.id, "title": task.title, "backgroundColor": color_map.get(task.priority.value, "#3742fa")})
+    return events
+
+
+def bench_calendar():
+    """日历：月视图的事件查询（旧版包含判断 vs 按跨度分级的重叠查询）与每日计数概览"""
+    from sqlalchemy import select
+    from task_calendar import window_bounds, overlap_filter, calendar_event, day_counts
+
+    print("📅 日历 GET /api/tasks/calendar/events 与 /calendar/month（三年日程中的一个月）")
+    print(f"{'任务数':>8} {'旧版条数':>8} {'旧版ms':>8} {'新版条数':>8} {'新版ms':>8} {'月概览ms':>8}")
+    month_start, month_end = datetime(2025, 6, 1).date(), datetime(2025, 6, 30).date()
+    window_start, window_end = window_bounds(month_start, month_end)
+    for count in [1000, 10000, 50000]:
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            seed_calendar_tasks(db, user, count)
+
+            def events():
+                tasks = db.scalars(select(models.Task).where(overlap_filter(user.id, window_start, window_end)).order_by(models.Task.start_time))
+                return [calendar_event(task) for task in tasks]
+
+            def month():
+                intervals = db.execute(select(models.Task.start_time, models.Task.end_time).where(overlap_filter(user.id, window_start, window_end))).all()
+                return day_counts(intervals, month_start, month_end)
+
+            legacy_rows = len(legacy_calendar_events(db, user.id, window_start, window_end))
+            legacy_ms = measure(lambda: legacy_calendar_events(db, user.id, window_start, window_end))
+            rows = len(events())
+            new_ms = measure(events)
+            month_ms = measure(month)
+            db.close()
+
+        print(f"{count:>8} {legacy_rows:>8} {legacy_ms:>8.1f} {rows:>8} {new_ms:>8.1f} {month_ms:>8.1f}")
+    print()
+
+
+def seed_pomodoro_history(db, user: models.User, days: int, per_day: int = 8, tasks: int = 20):
+    """生成days天的番茄钟历史，每天per_day条，每两周换一个任务（共tasks个轮换），并汇总到按天汇总表"""
+    from pomodoro_stats import rebuild_pomodoro_rollups
+
+    task_rows = [models.Task(title=f"番茄任务{n}", user_id=user.id) for n in range(tasks)]
+    db.add_all(task_rows)
+    db.flush()
+    now = datetime.utcnow()
+    db.add_all([
+        models.PomodoroLog(
+            user_id=user.id,
+            task_id=task_rows[(d // 14) % tasks].id,
+            duration=25,
+            completed_at=now - timedelta(days=d, minutes=n * 30)
+        )
+        for d in range(days)
+        for n in range(per_day)
+    ])
+    rebuild_pomodoro_rollups(db, user.id)
+    db.commit()
+    return task_rows
+
+
+def legacy_pomodoro_stats(db, user_id: str, task_id: str):
+    """旧版实现：当日/本周逐条加载记录、按任务逐个查询标题，单任务统计加载全部记录"""
+    Log = models.PomodoroLog
+    today = datetime.utcnow().date()
+    day_start = datetime.combine(today, datetime.min.time())
+    logs = db.query(Log).filter(Log.user_id == user_id, Log.completed_at >= day_start).all()
+    titles = {}
+    for log in logs:
+        if log.task_id and log.task_id not in titles:
+            titles[log.task_id] = db.query(models.Task).filter(models.Task.id == log.task_id).first()
+    week_start = day_start - timedelta(days=today.weekday())
+    sum(log.duration for log in db.query(Log).filter(Log.user_id == user_id, Log.completed_at >= week_start).all())
+    task_logs = db.query(Log).filter(Log.task_id == task_id, Log.user_id == user_id).order_by(Log.completed_at).all()
+    return sum(log.duration for log in task_logs)
+
+
+def bench_pomodoro_stats():
+    """番茄钟统计：日/周/单任务统计随历史长度的变化（旧版逐条加载 vs 按天汇总表）"""
+    from pomodoro import get_daily_stats, get_weekly_stats, get_task_pomodoro_stats
+
+    print("🍅 番茄钟统计 GET /api/pomodoro/stats/{daily,weekly,task}")
+    print(f"{'历史天数':>8} {'记录数':>8} {'旧版查询':>8} {'旧版ms':>10} {'新版查询':>8} {'新版ms':>10}")
+    for days in [30, 365, 1095]:
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            task_id = seed_pomodoro_history(db, user, days)[0].id
+
+            def rollup_stats():
+                get_daily_stats(None, current_user=user, db=db)
+                get_weekly_stats(None, current_user=user, db=db)
+                get_task_pomodoro_stats(task_id, current_user=user, db=db)
+
+            with QueryCounter(bench.engine) as legacy_counter:
+                legacy_pomodoro_stats(db, user.id, task_id)
+            legacy_ms = measure(lambda: legacy_pomodoro_stats(db, user.id, task_id))
+
+            with QueryCounter(bench.engine) as counter:
+                rollup_stats()
+            new_ms = measure(rollup_stats)
+            db.close()
+
+        print(f"{days:>8} {days * 8:>8} {legacy_counter.count:>8} {legacy_ms:>10.1f} {counter.count:>8} {new_ms:>10.1f}")
+    print()
+
+
+def bench_principal_cache():
+    """认证：每个请求的 get_current_user 耗时（JWT解码+用户查询 vs 认证缓存命中）"""
+    from fastapi.security import HTTPAuthorizationCredentials
+    from auth import create_access_token, get_current_user
+    from principal_cache import principal_cache
+
+    print("🔐 认证 get_current_user（1000次请求）")
+    with BenchDatabase() as bench:
+        setup = bench.Session()
+        user = create_bench_user(setup)
+        token = create_access_token({"sub": user.username}, timedelta(minutes=30))
+        setup.close()
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+        def requests():
+            for _ in range(1000):
+                db = bench.Session()
+                get_current_user(credentials, db)
+                db.close()
+
+        ttl = principal_cache.ttl
+        try:
+            for label, cache_ttl in [("无缓存", 0), ("缓存", 300)]:
+                principal_cache.ttl = cache_ttl
+                principal_cache.clear()
+                with QueryCounter(bench.engine) as counter:
+                    requests()
+                print(f"  {label}: {measure(requests, repeat=3):8.1f} ms，{counter.count} 条SQL")
+        finally:
+            principal_cache.ttl = ttl
+            principal_cache.clear()
+    print()
+
+
+def bench_login():
+    """登录：并发登录时的总耗时，以及同时到达的轻量请求被阻塞的时间（同步bcrypt vs 密码线程池）"""
+    import asyncio
+    import httpx
+    from fastapi import FastAPI, Depends
+    from database import get_db
+    from auth import authenticate_user, get_password_hash
+    import auth
+
+    # 并发登录数不超过默认连接池上限（5+10），旧版同步实现在此之上会耗尽连接池
+    logins = 12
+    print(f"🔑 登录 POST /api/auth/login（{logins}个并发登录，期间持续发送轻量请求，bcrypt代价{auth.BCRYPT_ROUNDS}）")
+    with BenchDatabase() as bench:
+        setup = bench.Session()
+        setup.add(models.User(username="login", email="login@bench.local", hashed_password=get_password_hash("pw")))
+        setup.commit()
+        setup.close()
+
+        def bench_db():
+            db = bench.Session()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(auth.router, prefix="/api/auth")
+        app.dependency_overrides[get_db] = bench_db
+
+        @app.post("/legacy/login")
+        async def legacy_login(body: dict, db=Depends(get_db)):
+            # 旧版：在事件循环中同步校验密码
+            return {"ok": bool(authenticate_user(db, body["username"], body["password"]))}
+
+        @app.get("/ping")
+        async def ping():
+            return {"ok": True}
+
+        async def run(path: str):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                async def timed(method, url, **kwargs):
+                    start = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    assert response.status_code == 200, response.text
+                    return (time.perf_counter() - start) * 1000
+
+                body = {"username": "login", "password": "pw"}
+                start = time.perf_counter()
+                login_burst = asyncio.gather(*[timed("POST", path, json=body) for _ in range(logins)])
+                # 登录进行期间每隔20ms发一个轻量请求；从计划发出到收到响应的时间反映事件循环被阻塞的时长
+                ping_timings = []
+                while not login_burst.done():
+                    scheduled = time.perf_counter() + 0.02
+                    await asyncio.sleep(0.02)
+                    await timed("GET", "/ping")
+                    ping_timings.append((time.perf_counter() - scheduled) * 1000)
+                await login_burst
+                return (time.perf_counter() - start) * 1000, statistics.median(ping_timings), max(ping_timings)
+
+        for label, path in [("同步校验", "/legacy/login"), ("线程池", "/api/auth/login")]:
+            total, ping_median, ping_max = asyncio.run(run(path))
+            print(f"  {label}: 全部登录 {total:8.1f} ms，轻量请求延迟中位数 {ping_median:8.1f} ms，最大 {ping_max:8.1f} ms")
+    print()
+
+
+def bench_task_bulk():
+    """批量任务操作：逐个请求创建任务/修改状态 vs 一次 POST /api/tasks/bulk"""
+    import asyncio
+    import httpx
+    from fastapi import FastAPI
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from database import get_async_db, create_async_session_factory, async_database_url
+    from auth import get_current_user_async
+    from search import init_search_index
+    import tasks
+
+    print("🗂️ 批量任务 POST /api/tasks/bulk（逐个请求 vs 单次批量，各自独立提交 vs 同一事务）")
+    print(f"{'任务数':>8} {'逐个创建ms':>10} {'批量创建ms':>10} {'逐个改状态ms':>12} {'批量改状态ms':>12}")
+    for count in [10, 50, 200]:
+        with BenchDatabase() as bench:
+            init_search_index(bench.engine)
+            setup = bench.Session()
+            user = create_bench_user(setup)
+            setup.refresh(user)
+            setup.expunge(user)
+            setup.close()
+
+            async def run():
+                async_engine = create_async_engine(async_database_url(bench.url))
+                session_factory = create_async_session_factory(async_engine, async_engine)
+
+                async def bench_db():
+                    async with session_factory() as db:
+                        yield db
+
+                async def bench_user():
+                    return user
+
+                app = FastAPI()
+                app.include_router(tasks.router, prefix="/api/tasks")
+                app.dependency_overrides[get_async_db] = bench_db
+                app.dependency_overrides[get_current_user_async] = bench_user
+
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                    async def timed(coro):
+                        start = time.perf_counter()
+                        result = await coro
+                        return (time.perf_counter() - start) * 1000, result
+
+                    async def create_one_by_one():
+                        return [(await client.post("/api/tasks/", json={"title": f"逐个{n}"})).json()["id"] for n in range(count)]
+
+                    single_create_ms, created = await timed(create_one_by_one())
+                    operations = [{"op": "create", "task": {"title": f"批量{n}"}} for n in range(count)]
+                    bulk_create_ms, _ = await timed(client.post("/api/tasks/bulk", json={"operations": operations}))
+
+                    async def status_one_by_one():
+                        for task_id in created:
+                            await client.patch(f"/api/tasks/{task_id}/status", params={"status": "doing"})
+
+                    single_status_ms, _ = await timed(status_one_by_one())
+                    operations = [{"op": "status", "id": task_id, "status": "done"} for task_id in created]
+                    bulk_status_ms, response = await timed(client.post("/api/tasks/bulk", json={"operations": operations}))
+                    assert response.json()["succeeded"] == count, response.text
+                await async_engine.dispose()
+                return single_create_ms, bulk_create_ms, single_status_ms, bulk_status_ms
+
+            single_create_ms, bulk_create_ms, single_status_ms, bulk_status_ms = asyncio.run(run())
+        print(f"{count:>8} {single_create_ms:>10.1f} {bulk_create_ms:>10.1f} {single_status_ms:>12.1f} {bulk_status_ms:>12.1f}")
+    print()
+
+
+def seed_chat_history(db, user: models.User, turns: int, words: int) -> str:
+    """生成一个有turns轮问答的会话，每条消息约words个字，返回会话ID"""
+    session = models.ChatSession(title="长会话", user_id=user.id)
+    db.add(session)
+    db.flush()
+    start = datetime.utcnow() - timedelta(minutes=turns * 2)
+    for turn in range(turns):
+        for offset, role in enumerate((models.RoleEnum.user, models.RoleEnum.ai)):
+            db.add(models.ChatMessage(
+                session_id=session.id,
+                role=role,
+                content=f"第{turn}轮：" + "项目进度与下周安排" * (words // 9),
+                created_at=start + timedelta(minutes=turn * 2 + offset)
+            ))
+    db.commit()
+    return session.id
+
+
+def bench_chat_context():
+    """对话上下文：旧版（取最近10条只用5条，消息不限长度）与按模型token预算组装的历史对比"""
+    import asyncio
+    from sqlalchemy import select
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from database import create_async_session_factory, async_database_url
+    from ai_service import ai_service, count_message_tokens
+    import chat_context
+
+    model = "moonshot-v1-8k"
+    print(f"💬 对话上下文（模型 {model}，历史预算 {ai_service.history_budget(model)} token，上下文 {ai_service.model_config(model)['context_window']}）")
+    print(f"{'轮数':>6} {'每条字数':>8} {'旧版token':>10} {'旧版ms':>8} {'新版token':>10} {'新版条数':>8} {'新版ms':>8} {'需摘要':>6}")
+    for turns, words in [(20, 100), (200, 100), (200, 2000)]:
+        with BenchDatabase() as bench:
+            setup = bench.Session()
+            session_id = seed_chat_history(setup, create_bench_user(setup), turns, words)
+            setup.close()
+
+            async def run():
+                async_engine = create_async_engine(async_database_url(bench.url))
+                session_factory = create_async_session_factory(async_engine, async_engine)
+                async with session_factory() as db:
+                    session = await db.get(models.ChatSession, session_id)
+
+                    async def legacy():
+                        recent = list((await db.execute(select(models.ChatMessage).where(
+                            models.ChatMessage.session_id == session_id
+                        ).order_by(models.ChatMessage.created_at.desc()).limit(10))).scalars())
+                        recent.reverse()
+                        return [{"role": chat_context.to_api_role(m.role), "content": m.content} for m in recent[-5:]]
+
+                    async def timed(build):
+                        timings = []
+                        for _ in range(5):
+                            started = time.perf_counter()
+                            result = await build()
+                            timings.append((time.perf_counter() - started) * 1000)
+                        return result, statistics.median(timings)
+
+                    legacy_messages, legacy_ms = await timed(legacy)
+                    context, context_ms = await timed(lambda: chat_context.build_chat_context(db, session, model))
+                await async_engine.dispose()
+                return count_message_tokens(legacy_messages), legacy_ms, context, context_ms
+
+            legacy_tokens, legacy_ms, context, context_ms = asyncio.run(run())
+        print(f"{turns:>6} {words:>8} {legacy_tokens:>10} {legacy_ms:>8.1f} {context.tokens:>10} {len(context.messages):>8} {context_ms:>8.1f} {'是' if context.summarize_before else '否':>6}")
+    print()
+
+
+def bench_retrieval():
+    """本地检索索引：加载用户索引、对话检索、相关笔记与单篇笔记增量更新的耗时"""
+    import random
+    from retrieval import RetrievalIndex, RetrievalDoc
+
+    topics = ["项目进度汇报", "Python装饰器", "周末购物清单", "健身计划", "读书笔记", "季度预算", "旅行攻略", "会议纪要"]
+    words = ["需要", "完成", "安排", "整理", "讨论", "总结", "目标", "下周", "问题", "方案", "deadline", "review"]
+    print("🔎 本地检索 BM25索引（笔记+任务，每篇约200字）")
+    print(f"{'文档数':>8} {'加载ms':>8} {'检索ms':>8} {'相关笔记ms':>10} {'增量更新ms':>10}")
+    for count in [1000, 5000, 20000]:
+        rng = random.Random(count)
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            category = models.Category(name="工作", user_id=user.id)
+            db.add(category)
+            db.flush()
+            folder = models.Folder(name="默认", category_id=category.id, user_id=user.id)
+            db.add(folder)
+            db.flush()
+            notes = []
+            for n in range(count):
+                topic = rng.choice(topics)
+                body = "。".join(topic + "".join(rng.choices(words, k=6)) for _ in range(5))
+                if n % 4 == 0:
+                    db.add(models.Task(title=f"{topic}{n}", description=body, user_id=user.id))
+                else:
+                    note = models.Note(title=f"{topic}{n}", content=body, folder_id=folder.id, user_id=user.id)
+                    db.add(note)
+                    notes.append(note)
+            db.commit()
+            note = notes[0]
+            index = RetrievalIndex()
+
+            def load():
+                index.invalidate(user.id)
+                return index.ensure(db, user.id)
+
+            load_ms = measure(load)
+            user_index = index.ensure(db, user.id)
+            search_ms = measure(lambda: index.search(user_index, "下周的项目进度汇报需要整理哪些问题", 3))
+            related_ms = measure(lambda: index.related(user_index, "note", note.id, 5))
+            update_ms = measure(lambda: index.apply([("upsert", user.id, RetrievalDoc("note", note.id, note.title, note.content + "补充", folder.id))]))
+            db.close()
+        print(f"{count:>8} {load_ms:>8.1f} {search_ms:>8.2f} {related_ms:>10.2f} {update_ms:>10.3f}")
+    print()
+
+
+NOTE_TOPICS = {
+    ("工作", "项目管理"): ["项目进度", "里程碑", "排期", "需求评审", "上线计划", "风险", "交付", "负责人"],
+    ("工作", "会议记录"): ["会议纪要", "参会人员", "讨论议题", "结论", "待办事项", "下次会议", "同步", "决议"],
+    ("学习", "编程"): ["Python", "装饰器", "函数", "异步", "数据库索引", "算法", "复杂度", "单元测试"],
+    ("学习", "读书笔记"): ["这本书", "作者", "章节", "观点", "摘抄", "启发", "人物", "情节"],
+    ("生活", "日常"): ["超市", "做饭", "周末", "打扫", "快递", "家里", "晚饭", "买菜"],
+    ("生活", "旅行"): ["机票", "酒店", "行程", "景点", "签证", "攻略", "美食", "路线"],
+    ("健康", "运动"): ["跑步", "配速", "健身房", "深蹲", "拉伸", "心率", "体重", "训练计划"],
+    ("财务", "记账"): ["预算", "支出", "收入", "信用卡", "理财", "基金", "账单", "储蓄"],
+}
+NOTE_FILLER = ["今天", "需要", "然后", "感觉", "一下", "还有", "比较", "可以", "问题", "记录", "明天", "继续"]
+
+
+def bench_note_classifier():
+    """本地笔记分类：训练耗时、单次推荐耗时、留出笔记上本地直接返回的比例与准确率"""
+    import random
+    from note_classifier import NoteClassifier, NOTE_CLASSIFIER_PRECISION
+
+    print(f"🗂️ 本地笔记分类 朴素贝叶斯（目标准确率 {NOTE_CLASSIFIER_PRECISION}，20%笔记留出评估）")
+    print(f"{'笔记数':>8} {'训练ms':>8} {'门槛':>6} {'推荐ms':>8} {'增量ms':>8} {'本地返回':>8} {'文件夹准确':>10} {'分类准确':>8}")
+    for count in [200, 1000, 5000]:
+        rng = random.Random(count)
+        with BenchDatabase() as bench:
+            db = bench.Session()
+            user = create_bench_user(db)
+            folders = {}
+            categories = {}
+            tags = {}
+            for category_name, folder_name in NOTE_TOPICS:
+                if category_name not in categories:
+                    categories[category_name] = models.Category(name=category_name, user_id=user.id)
+                    db.add(categories[category_name])
+                    db.flush()
+                folders[(category_name, folder_name)] = models.Folder(name=folder_name, category_id=categories[category_name].id, user_id=user.id)
+                tags[folder_name] = models.Tag(name=folder_name, user_id=user.id)
+                db.add_all([folders[(category_name, folder_name)], tags[folder_name]])
+            db.flush()
+
+            def compose(topic):
+                # 约三分之一是所属主题的词，其余是通用词和其他主题的词
+                words = [rng.choice(NOTE_TOPICS[topic]) if rng.random() < 0.35 else rng.choice(NOTE_FILLER + NOTE_TOPICS[rng.choice(list(NOTE_TOPICS))]) for _ in range(rng.randint(4, 30))]
+                return "".join(words[:3]), "，".join(words)
+
+            held_out = []
+            for n in range(count):
+                topic = rng.choice(list(NOTE_TOPICS))
+                title, content = compose(topic)
+                if n % 5 == 0:
+                    held_out.append((topic, title, content))
+                    continue
+                db.add(models.Note(title=title, content=content, folder_id=folders[topic].id, user_id=user.id, tags=[tags[topic[1]]]))
+            db.commit()
+
+            folder_categories = {folder.id: folder.category_id for folder in folders.values()}
+            tag_ids = [tag.id for tag in tags.values()]
+            classifier = NoteClassifier()
+
+            def train():
+                classifier.invalidate(user.id)
+                return classifier.ensure(db, user.id)
+
+            train_ms = measure(train, repeat=3)
+            model = classifier.ensure(db, user.id)
+            suggest_ms = measure(lambda: classifier.suggest(model, held_out[0][1], held_out[0][2], folder_categories, tag_ids), repeat=20)
+            update_ms = measure(lambda: model.upsert("bench-note", folders[held_out[0][0]].id, tag_ids[:1], held_out[0][1], held_out[0][2]), repeat=20)
+            model.remove("bench-note")
+
+            local = folder_correct = category_correct = 0
+            for topic, title, content in held_out:
+                suggestion = classifier.suggest(model, title, content, folder_categories, tag_ids)
+                if suggestion is None:
+                    continue
+                local += 1
+                folder_correct += suggestion.folder_id == folders[topic].id
+                category_correct += suggestion.category_id == categories[topic[0]].id
+            db.close()
+        print(f"{count:>8} {train_ms:>8.1f} {model.threshold:>6.3f} {suggest_ms:>8.3f} {update_ms:>8.3f} {local / len(held_out):>8.0%} {folder_correct / max(local, 1):>10.1%} {category_correct / max(local, 1):>8.1%}")
+    print()
+
+
+TASK_PARSER_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "task_parser_corpus.json")
+TASK_PARSER_FIELDS = ["title", "priority", "start_time", "end_time", "due_date", "category", "subtasks"]
+
+
+def bench_task_parser():
+    """任务解析：本地解析器在标注语料上的各字段准确率、本地直接返回的比例与单次耗时"""
+    import json
+    from task_parser import LOCAL_PARSE_CONFIDENCE, parse_task_text
+
+    with open(TASK_PARSER_CORPUS, encoding="utf-8") as f:
+        corpus = json.load(f)
+    now = datetime.fromisoformat(corpus["now"])
+    cases = corpus["cases"]
+
+    print(f"🗓️ 本地任务解析（标注语料 {len(cases)} 条，置信度阈值 {LOCAL_PARSE_CONFIDENCE}）")
+    timings = []
+    local = agreed = 0
+    correct = {field: 0 for field in TASK_PARSER_FIELDS}
+    compared = 0
+    mismatches = []
+    for case in cases:
+        start = time.perf_counter()
+        result = parse_task_text(case["text"], now)
+        timings.append((time.perf_counter() - start) * 1000)
+        handled = result.confidence >= LOCAL_PARSE_CONFIDENCE
+        local += handled
+        agreed += handled == case["local"]
+        if not handled:
+            continue
+        # 只统计本地直接返回（不经过模型）的结果，任务数不一致时整条计为全部字段错误
+        expected = case["tasks"]
+        compared += len(expected)
+        if len(result.tasks) != len(expected):
+            mismatches.append(f"{case['text']}：任务数 {len(result.tasks)}，应为 {len(expected)}")
+            continue
+        for parsed, label in zip(result.tasks, expected):
+            for field in TASK_PARSER_FIELDS:
+                if parsed.get(field) == label.get(field, [] if field == "subtasks" else None):
+                    correct[field] += 1
+                else:
+                    mismatches.append(f"{case['text']}：{field} = {parsed.get(field)!r}，应为 {label.get(field)!r}")
+
+    timings.sort()
+    print(f"  本地直接返回: {local}/{len(cases)}（与标注一致 {agreed}/{len(cases)}）")
+    print(f"  单次耗时: 平均 {statistics.mean(timings):.3f} ms，p95 {timings[int(len(timings) * 0.95)]:.3f} ms，最大 {timings[-1]:.3f} ms")
+    print("  字段准确率（本地返回的任务）: " + "，".join(f"{field} {correct[field] / max(compared, 1):.0%}" for field in TASK_PARSER_FIELDS))
+    for line in mismatches:
+        print(f"    ✗ {line}")
+    print()
+
+
+def bench_sqlite_concurrency():
+    """SQLite并发：多个线程同时读写时的吞吐量与 "database is locked" 错误数（默认配置 vs 生产配置）"""
+    import threading
+    from sqlalchemy.exc import OperationalError
+    from database import create_sqlite_engines, create_session_factory
+
+    writers, readers, operations = 8, 8, 150
+    print(f"🗄️ SQLite并发（{writers}个写线程 + {readers}个读线程，每线程{operations}次操作）")
+    print(f"{'配置':>12} {'总耗时ms':>10} {'写入/秒':>10} {'写p95ms':>10} {'读p95ms':>10} {'锁错误':>8}")
+    for profile in ["default", "production"]:
+        directory = tempfile.mkdtemp(prefix="cortex-bench-")
+        write_engine, read_engine = create_sqlite_engines(f"sqlite:///{os.path.join(directory, 'bench.db')}", profile)
+        models.Base.metadata.create_all(bind=write_engine)
+        Session = create_session_factory(write_engine, read_engine)
+
+        setup = Session()
+        user = create_bench_user(setup)
+        seed_notes(setup, user, categories=2, folders_per_category=5, notes_per_folder=20)
+        user_id = user.id
+        folder_ids = [folder.id for folder in setup.query(models.Folder).all()]
+        setup.close()
+
+        counts = {"write": 0, "read": 0, "locked": 0}
+        timings = {"write": [], "read": []}
+        lock = threading.Lock()
+
+        def record(key, started=None):
+            with lock:
+                counts[key] += 1
+                if started is not None:
+                    timings[key].append((time.perf_counter() - started) * 1000)
+
+        def write_worker(worker: int):
+            # 与创建笔记接口相同的形态：先查询文件夹，再插入笔记并提交
+            for n in range(operations):
+                started = time.perf_counter()
+                db = Session()
+                try:
+                    folder_id = folder_ids[(worker + n) % len(folder_ids)]
+                    db.query(models.Folder).filter(models.Folder.id == folder_id).first()
+                    db.add(models.Note(title=f"并发{worker}-{n}", content="内容" * 200, folder_id=folder_id, user_id=user_id))
+                    db.commit()
+                    record("write", started)
+                except OperationalError:
+                    db.rollback()
+                    record("locked")
+                finally:
+                    db.close()
+
+        def read_worker(worker: int):
+            for n in range(operations):
+                started = time.perf_counter()
+                db = Session()
+                try:
+                    db.query(models.Note).filter(models.Note.user_id == user_id).order_by(models.Note.created_at.desc()).limit(50).all()
+                    record("read", started)
+                except OperationalError:
+                    record("locked")
+                finally:
+                    db.close()
+
+        threads = [threading.Thread(target=write_worker, args=(i,)) for i in range(writers)]
+        threads += [threading.Thread(target=read_worker, args=(i,)) for i in range(readers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        write_engine.dispose()
+        read_engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+        p95 = {key: statistics.quantiles(values, n=20)[-1] if len(values) > 1 else 0.0 for key, values in timings.items()}
+        print(f"{profile:>12} {elapsed * 1000:>10.1f} {counts['write'] / elapsed:>10.1f} {p95['write']:>10.1f} {p95['read']:>10.1f} {counts['locked']:>8}")
+    print()
+
+
+def seed_explain_data(db, user: models.User):
+    """每个用户：笔记、不同状态/分类/时间的任务、番茄钟记录和对话消息"""
+    seed_notes(db, user, 2, 5, 10)
+    categories = db.query(models.Category).filter(models.Category.user_id == user.id).all()
+    statuses = list(models.StatusEnum)
+    now = datetime.utcnow()
+    tasks = [
+        models.Task(
+            title=f"任务{n}",
+            user_id=user.id,
+            status=statuses[n % len(statuses)],
+            category_id=categories[n % len(categories)].id,
+            start_time=now - timedelta(days=n),
+            end_time=now - timedelta(days=n) + timedelta(hours=1)
+        )
+        for n in range(100)
+    ]
+    db.add_all(tasks)
+    db.flush()
+    db.add_all([
+        models.PomodoroLog(user_id=user.id, task_id=tasks[n % 10].id, duration=25, completed_at=now - timedelta(hours=n))
+        for n in range(200)
+    ])
+    session = models.ChatSession(title="基准会话", user_id=user.id)
+    db.add(session)
+    db.flush()
+    db.add_all([
+        models.ChatMessage(session_id=session.id, role=models.RoleEnum.user, content=f"消息{n}")
+        for n in range(50)
+    ])
+    db.commit()
+
+
+def explain_queries(db, user_id: str, session_id: str, task_id: str):
+    """热点接口的查询形态（与路由中的过滤/排序条件一致）"""
+    from pagination import encode_cursor, keyset_paginate
+
+    now = datetime.utcnow()
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    Task, Note, PomodoroLog = models.Task, models.Note, models.PomodoroLog
+    return [
+        ("笔记列表分页", keyset_paginate(db.query(Note).filter(Note.user_id == user_id), Note.created_at, Note.id, None, 50)),
+        ("笔记列表翻页", keyset_paginate(db.query(Note).filter(Note.user_id == user_id), Note.created_at, Note.id, encode_cursor(now, "x"), 50)),
+        ("笔记树-笔记", db.query(Note.id, Note.title, Note.folder_id).filter(Note.user_id == user_id)),
+        ("笔记树-分类文件夹", db.query(models.Category.id, models.Folder.id).outerjoin(
+            models.Folder, models.Folder.category_id == models.Category.id).filter(models.Category.user_id == user_id)),
+        ("文件夹内笔记", db.query(Note.id).filter(Note.folder_id == "x", Note.user_id == user_id)),
+        ("任务按状态", db.query(Task).filter(Task.user_id == user_id, Task.status == models.StatusEnum.todo)),
+        ("任务按分类", db.query(Task).filter(Task.user_id == user_id, Task.category_id == "x")),
+        ("任务日历", db.query(Task).filter(Task.user_id == user_id, Task.start_time >= day_start, Task.start_time <= now)),
+        ("任务逾期统计", db.query(Task.category_id).filter(
+            Task.user_id == user_id, Task.status.in_([models.StatusEnum.todo, models.StatusEnum.doing]), Task.end_time < now)),
+        ("番茄钟日统计", db.query(PomodoroLog).filter(
+            PomodoroLog.user_id == user_id, PomodoroLog.completed_at >= day_start, PomodoroLog.completed_at <= now)),
+        ("番茄钟按任务", db.query(PomodoroLog).filter(
+            PomodoroLog.task_id == task_id, PomodoroLog.user_id == user_id).order_by(PomodoroLog.completed_at)),
+        ("会话消息分页", keyset_paginate(db.query(models.ChatMessage).filter(
+            models.ChatMessage.session_id == session_id), models.ChatMessage.created_at, models.ChatMessage.id, None, 200)),
+    ]
+
+
+def explain(db, query) -> str:
+    """返回查询计划文本：SQLite使用EXPLAIN QUERY PLAN，Postgres使用EXPLAIN"""
+    bind = db.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect, compile_kwargs={"literal_binds": True})
+    if bind.dialect.name == "sqlite":
+        rows = db.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+        return "; ".join(row[-1] for row in rows)
+    rows = db.execute(text(f"EXPLAIN {compiled}")).all()
+    return "; ".join(row[0].strip() for row in rows)
+
+
+def bench_explain():
+    """
+    查询计划：确认热点查询命中复合索引
+
+    默认在临时SQLite上运行；设置 BENCH_POSTGRES_URL 时同时在该Postgres库上运行
+    （须为空的测试库，结束后会删除建出的表）
+    """
+    print("🔎 查询计划 EXPLAIN")
+    targets = [("SQLite", None)]
+    if os.getenv("BENCH_POSTGRES_URL"):
+        targets.append(("Postgres", os.getenv("BENCH_POSTGRES_URL")))
+
+    for label, url in targets:
+        if url:
+            engine = create_engine(url)
+            models.Base.metadata.create_all(bind=engine)
+            Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        else:
+            bench = BenchDatabase()
+            engine, Session = bench.engine, bench.Session
+        try:
+            db = Session()
+            # 多个用户的数据，user_id条件才有选择性
+            users = [create_bench_user(db, f"bench{i}") for i in range(20)]
+            for user in users:
+                seed_explain_data(db, user)
+            user = users[0]
+            task = db.query(models.Task).filter(models.Task.user_id == user.id).first()
+            session = db.query(models.ChatSession).filter(models.ChatSession.user_id == user.id).first()
+            # 更新统计信息，让优化器按真实数据分布选择索引
+            db.execute(text("ANALYZE"))
+            print(f"— {label}")
+            for name, query in explain_queries(db, user.id, session.id, task.id):
+                plan = explain(db, query)
+                marker = "⚠️" if "SCAN" in plan.upper() and "INDEX" not in plan.upper() else "✅"
+                print(f"  {marker} {name}: {plan}")
+            db.close()
+        finally:
+            if url:
+                models.Base.metadata.drop_all(bind=engine)
+                engine.dispose()
+            else:
+                bench.close()
+    print()
+
+
+def bench_provider_failover():
+    """服务商降级：Kimi持续超时时，直接调用与经过熔断/降级路由的延迟和成功率"""
+    import asyncio
+    import json
+    import httpx
+    from ai_service import AIService
+
+    hang = 0.3  # 模拟的请求超时时间（秒）
+    requests = 60
+
+    async def kimi_down(request: httpx.Request):
+        await asyncio.sleep(hang)
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    async def openrouter_up(request: httpx.Request):
+        await asyncio.sleep(0.01)
+        body = {"choices": [{"message": {"content": "好的"}, "finish_reason": "stop"}], "usage": {"total_tokens": 10}}
+        return httpx.Response(200, content=json.dumps(body).encode())
+
+    def make_service() -> AIService:
+        service = AIService()
+        service.kimi_api_key = "bench-key"
+        service.openrouter_api_key = "bench-key"
+        service.cache = None
+        service._clients = {
+            "kimi": httpx.AsyncClient(base_url="http://kimi.bench", transport=httpx.MockTransport(kimi_down)),
+            "openrouter": httpx.AsyncClient(base_url="http://openrouter.bench", transport=httpx.MockTransport(openrouter_up)),
+        }
+        return service
+
+    async def run(call) -> tuple:
+        timings, ok = [], 0
+        for i in range(requests):
+            messages = [{"role": "user", "content": f"第{i}个问题"}]
+            start = time.perf_counter()
+            try:
+                await call(messages)
+                ok += 1
+            except Exception:
+                pass
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings, ok
+
+    async def scenario():
+        direct = make_service()
+        routed = make_service()
+        try:
+            # 改造前：按模型直接请求所属服务商，不降级、不熔断
+            legacy = await run(lambda messages: direct._kimi_chat(messages, "kimi-k2-latest"))
+            optimized = await run(lambda messages: routed.chat_completion(messages, model="kimi-k2-latest"))
+        finally:
+            await direct.aclose()
+            await routed.aclose()
+        return legacy, optimized, routed.router.snapshot()
+
+    legacy, optimized, snapshot = asyncio.run(scenario())
+    print(f"🔀 服务商降级（Kimi 每次请求 {hang * 1000:.0f} ms 后超时，{requests} 次请求 kimi-k2-latest）")
+    for label, (timings, ok) in (("直接调用", legacy), ("熔断+降级", optimized)):
+        timings.sort()
+        print(f"  {label}: 成功 {ok}/{requests}，平均 {statistics.mean(timings):.1f} ms，p95 {timings[int(len(timings) * 0.95)]:.1f} ms")
+    kimi = next(item for item in snapshot["providers"] if item["provider"] == "kimi")
+    print(f"  Kimi熔断状态: {kimi['circuit']}，失败 {kimi['failures']} 次，熔断期间跳过 {kimi['rejected']} 次，降级 {snapshot['fallbacks']} 次")
+    print()
+
+
+def bench_admission():
+    """准入控制：一个用户批量提交请求时，其他用户交互请求的等待时间（先进先出 vs 加权公平队列）"""
+    import asyncio
+    import json
+    import httpx
+    import admission
+    from ai_service import AIService
+
+    limit = 4
+    upstream = 0.05
+    batch_requests = 40
+    interactive_users = 10
+    # 只比较排队策略，关闭按用户限速
+    admission.AI_USER_RATE_PER_MINUTE = 0
+
+    async def kimi(request: httpx.Request):
+        await asyncio.sleep(upstream)
+        body = {"choices": [{"message": {"content": "好的"}, "finish_reason": "stop"}], "usage": {"total_tokens": 10}}
+        return httpx.Response(200, content=json.dumps(body).encode())
+
+    def make_service() -> AIService:
+        service = AIService()
+        service.kimi_api_key = "bench-key"
+        service.cache = None
+        service.admission = admission.AdmissionController({"kimi": limit, "openrouter": limit})
+        service._clients = {"kimi": httpx.AsyncClient(base_url="http://kimi.bench", transport=httpx.MockTransport(kimi))}
+        return service
+
+    async def scenario(call) -> tuple:
+        async def timed(user_id: str, index: int, background: bool):
+            messages = [{"role": "user", "content": f"{user_id} 第{index}个请求"}]
+            start = time.perf_counter()
+            try:
+                await call(messages, user_id, background)
+            except admission.AdmissionRejected:
+                return None
+            return (time.perf_counter() - start) * 1000
+
+        batch = [asyncio.ensure_future(timed("batch", i, True)) for i in range(batch_requests)]
+        await asyncio.sleep(0.005)
+        interactive = await asyncio.gather(*(timed(f"user{i}", 0, False) for i in range(interactive_users)))
+        batch = await asyncio.gather(*batch)
+        return [t for t in interactive if t is not None], [t for t in batch if t is not None]
+
+    async def run():
+        direct = make_service()
+        semaphore = asyncio.Semaphore(limit)
+
+        async def fifo(messages, user_id, background):
+            # 改造前：只有连接池限制并发，按到达顺序排队
+            async with semaphore:
+                return await direct._kimi_chat(messages, "kimi-k2-latest")
+
+        fair = make_service()
+
+        async def fair_queue(messages, user_id, background):
+            return await fair.chat_completion(messages, model="kimi-k2-latest", user_id=user_id, background=background)
+
+        try:
+            return await scenario(fifo), await scenario(fair_queue), fair.admission.snapshot()
+        finally:
+            await direct.aclose()
+            await fair.aclose()
+
+    legacy, optimized, snapshot = asyncio.run(run())
+    print(f"🚦 准入控制（并发上限 {limit}，上游耗时 {upstream * 1000:.0f} ms；1个用户批量提交 {batch_requests} 个请求，随后 {interactive_users} 个用户各发1个交互请求）")
+    for label, (interactive, batch) in (("先进先出", legacy), ("公平队列", optimized)):
+        print(f"  {label}: 交互请求 平均 {statistics.mean(interactive):.0f} ms，最大 {max(interactive):.0f} ms；"
+              f"批量请求完成 {len(batch)}/{batch_requests}，最慢 {max(batch):.0f} ms")
+    provider_stats = snapshot["providers"][0]
+    print(f"  公平队列: 排队峰值 {provider_stats['peak_queued']}，队满拒绝 {provider_stats['rejected']['queue_full']} 次（单用户排队上限 {admission.AI_QUEUE_MAX_PER_USER}）")
+    print()
+
+
+def bench_usage_ledger():
+    """AI用量流水：每次请求同步写库 vs 请求路径只追加内存、后台批量写入"""
+    from usage_ledger import AI_USAGE_BATCH_SIZE, UsageLedger, write_usage_batch
+    from database import increment_counter
+
+    count = 2000
+    models_ = ["kimi-k2-latest", "deepseek/deepseek-chat-v3.1", "openai/gpt-5"]
+    features = ["chat", "polish", "categorize", "parse_task"]
+    usage = {"prompt_tokens": 800, "completion_tokens": 200, "total_tokens": 1000}
+
+    with BenchDatabase() as bench:
+        users = [f"user-{i}" for i in range(20)]
+
+        # 改造前的写法：请求结束时同步插入一行流水并更新汇总，各自提交
+        db = bench.Session()
+        start = time.perf_counter()
+        for i in range(count):
+            record = models.AIUsageRecord(
+                user_id=users[i % len(users)], model=models_[i % 3], provider="kimi", feature=features[i % 4],
+                prompt_tokens=800, completion_tokens=200, total_tokens=1000, latency_ms=1200, success=True,
+                created_at=datetime.utcnow()
+            )
+            db.add(record)
+            increment_counter(db, models.AIUsageDailyRollup, dict(user_id=record.user_id, day=record.created_at.date(), model=record.model, feature=record.feature),
+                              dict(requests=1, errors=0, prompt_tokens=800, completion_tokens=200, total_tokens=1000, latency_ms=1200))
+            db.commit()
+        inline = (time.perf_counter() - start) * 1000
+        db.query(models.AIUsageRecord).delete()
+        db.query(models.AIUsageDailyRollup).delete()
+        db.commit()
+
+        # 请求路径：只追加到内存缓冲区
+        ledger = UsageLedger()
+        start = time.perf_counter()
+        for i in range(count):
+            ledger.record(users[i % len(users)], models_[i % 3], "kimi", features[i % 4], usage, 1.2)
+        append = (time.perf_counter() - start) * 1000
+
+        # 后台：按批写入
+        start = time.perf_counter()
+        for offset in range(0, count, AI_USAGE_BATCH_SIZE):
+            write_usage_batch(db, ledger.buffer[offset:offset + AI_USAGE_BATCH_SIZE])
+            db.commit()
+        batched = (time.perf_counter() - start) * 1000
+        rows = db.query(models.AIUsageRecord).count()
+        tokens = db.query(models.AIUsageDailyRollup.total_tokens).all()
+        db.close()
+
+    print(f"📊 AI用量流水（{count} 次请求，{len(users)} 个用户，批大小 {AI_USAGE_BATCH_SIZE}）")
+    print(f"  每次请求同步写库: 共 {inline:.0f} ms，每次请求 {inline / count:.3f} ms")
+    print(f"  请求路径追加内存: 共 {append:.1f} ms，每次请求 {append / count * 1000:.1f} µs")
+    print(f"  后台批量写入:     共 {batched:.0f} ms（{count / batched * 1000:.0f} 条/秒），流水 {rows} 行，汇总 {len(tokens)} 行合计 {sum(t for t, in tokens)} tokens")
+    print()
+
+
+SCENARIOS = {
+    "notes-tree": bench_notes_tree,
+    "explain": bench_explain,
+    "task-stats": bench_task_stats,
+    "calendar": bench_calendar,
+    "pomodoro-stats": bench_pomodoro_stats,
+    "auth": bench_principal_cache,
+    "login": bench_login,
+    "sqlite-concurrency": bench_sqlite_concurrency,
+    "task-bulk": bench_task_bulk,
+    "chat-context": bench_chat_context,
+    "retrieval": bench_retrieval,
+    "task-parser": bench_task_parser,
+    "note-classifier": bench_note_classifier,
+    "provider-failover": bench_provider_failover,
+    "admission": bench_admission,
+    "usage-ledger": bench_usage_ledger,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cortex AI Workspace 性能基准测试")
+    parser.add_argument("scenarios", nargs="*", help=f"要运行的场景：{', '.join(SCENARIOS)}")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知场景: {', '.join(unknown)}")
+
+    for name in args.scenarios or SCENARIOS:
+        SCENARIOS[name]()
+
+
+if __name__ == "__main__":
+    main()
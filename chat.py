@@ -1,91 +1,138 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 import json
+import os
 
-from database import get_db
-from models import User, ChatSession, ChatMessage, Note, Task, Category
+from database import get_async_db
+from models import User, ChatSession, ChatMessage, Note, Task, Category, Folder, RoleEnum
 from schemas import (
     ChatSession as ChatSessionSchema, ChatSessionCreate,
     ChatMessage as ChatMessageSchema, ChatMessageCreate,
     AIChatRequest, AIChatResponse
 )
-from auth import get_current_user
-from ai_service import ai_service
+from auth import get_current_user_async
+from ai_service import ai_service, count_message_tokens
+from admission import AdmissionRejected
+from chat_context import build_chat_context, retrieve_snippets, rolling_summarizer
+from tokenizer import truncate_to_tokens
+from tree_cache import notes_tree_cache
+from search import index_note, index_chat_message, remove_session_messages
+from pagination import keyset_paginate, finish_page
 
 router = APIRouter()
 
+# 对话中附带的当前笔记内容的token上限
+NOTE_CONTEXT_TOKENS = int(os.getenv("CHAT_NOTE_CONTEXT_TOKENS", "1500"))
+
+async def _get_user_session(db: AsyncSession, session_id: str, user_id: str) -> Optional[ChatSession]:
+    return (await db.execute(
+        select(ChatSession).where(ChatSession.id == session_id, ChatSession.user_id == user_id)
+    )).scalar_one_or_none()
+
 @router.get("/sessions", response_model=List[ChatSessionSchema])
-def get_chat_sessions(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取用户的所有对话会话"""
-    sessions = db.query(ChatSession).filter(ChatSession.user_id == current_user.id).order_by(ChatSession.created_at.desc()).all()
-    return sessions
+async def get_chat_sessions(
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取用户的对话会话（按创建时间倒序；下一页游标见响应头X-Next-Cursor）"""
+    query = select(ChatSession).where(ChatSession.user_id == current_user.id)
+    query = keyset_paginate(query, ChatSession.created_at, ChatSession.id, cursor, limit)
+    sessions = list((await db.execute(query)).scalars())
+    return finish_page(sessions, response, limit, "created_at")
 
 @router.post("/sessions", response_model=ChatSessionSchema)
-def create_chat_session(session: ChatSessionCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_chat_session(session: ChatSessionCreate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """创建新的对话会话"""
     db_session = ChatSession(
         title=session.title,
         user_id=current_user.id
     )
     db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    await db.commit()
+    await db.refresh(db_session)
     return db_session
 
 @router.get("/sessions/{session_id}/messages", response_model=List[ChatMessageSchema])
-def get_session_messages(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取会话的所有消息"""
+async def get_session_messages(
+    session_id: str,
+    response: Response,
+    limit: int = Query(200, ge=1, le=500),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    获取会话消息：每页返回最近的limit条，按时间正序排列；
+    响应头X-Next-Cursor为更早一页消息的游标
+    """
     # 验证会话属于当前用户
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
-    messages = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at).all()
+    query = select(ChatMessage).where(ChatMessage.session_id == session_id)
+    query = keyset_paginate(query, ChatMessage.created_at, ChatMessage.id, cursor, limit)
+    messages = finish_page(list((await db.execute(query)).scalars()), response, limit, "created_at")
+    messages.reverse()
     return messages
 
 @router.post("/command", response_model=AIChatResponse)
-async def chat_command(request: AIChatRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """核心对话接口 - AI大脑"""
+async def chat_command(request: AIChatRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """
+    核心对话接口 - AI大脑
+
+    对话历史按所选模型的token预算组装，超出预算的较早对话在回复之后压缩进会话的滚动摘要
+    """
     # 验证会话
-    session = db.query(ChatSession).filter(ChatSession.id == request.session_id, ChatSession.user_id == current_user.id).first()
+    session = await _get_user_session(db, request.session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
+    # 超出准入限制时在保存消息之前返回429
+    await ai_service.check_admission(current_user.id, request.model)
+    
     # 保存用户消息
     user_message = ChatMessage(
         session_id=request.session_id,
-        role="user",
+        role=RoleEnum.user,
         content=request.text
     )
     db.add(user_message)
-    db.commit()
-    
-    # 获取会话历史（最近10条消息）
-    recent_messages = db.query(ChatMessage).filter(
-        ChatMessage.session_id == request.session_id
-    ).order_by(ChatMessage.created_at.desc()).limit(10).all()
-    recent_messages.reverse()  # 按时间正序
+    await db.flush()
+    await db.run_sync(index_chat_message, user_message, current_user.id)
+    await db.commit()
     
     # 构建上下文信息
     context_info = ""
+    viewing = None
     if request.context:
         if request.context.get("type") == "note":
             note_id = request.context.get("id")
-            note = db.query(Note).filter(Note.id == note_id, Note.user_id == current_user.id).first()
+            note = (await db.execute(select(Note).where(Note.id == note_id, Note.user_id == current_user.id))).scalar_one_or_none()
             if note:
-                context_info = f"\n\n当前正在查看的笔记：\n标题：{note.title}\n内容：{note.content[:500]}..."
+                viewing = ("note", note.id)
+                content = truncate_to_tokens(note.content or "", NOTE_CONTEXT_TOKENS)
+                ellipsis = "..." if len(content) < len(note.content or "") else ""
+                context_info = f"\n\n当前正在查看的笔记：\n标题：{note.title}\n内容：{content}{ellipsis}"
         elif request.context.get("type") == "task":
             task_id = request.context.get("id")
-            task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+            task = (await db.execute(select(Task).where(Task.id == task_id, Task.user_id == current_user.id))).scalar_one_or_none()
             if task:
+                viewing = ("task", task.id)
                 context_info = f"\n\n当前正在查看的任务：\n标题：{task.title}\n描述：{task.description}\n状态：{task.status.value}\n优先级：{task.priority.value}"
     
+    # 检索与当前消息相关的笔记和任务片段（正在查看的那一条已完整附带，不重复）
+    context_info += await retrieve_snippets(db, current_user.id, request.text, exclude=viewing)
+    
     # 获取用户数据概览
-    notes_count = db.query(Note).filter(Note.user_id == current_user.id).count()
-    tasks_count = db.query(Task).filter(Task.user_id == current_user.id).count()
-    categories = db.query(Category).filter(Category.user_id == current_user.id).all()
-    category_names = [cat.name for cat in categories]
+    notes_count = await db.scalar(select(func.count()).select_from(Note).where(Note.user_id == current_user.id))
+    tasks_count = await db.scalar(select(func.count()).select_from(Task).where(Task.user_id == current_user.id))
+    category_names = list(await db.scalars(select(Category.name).where(Category.user_id == current_user.id)))
     
     # 构建系统提示
     system_prompt = f"""你是Cortex AI工作区的智能助理，专门帮助用户管理笔记和任务。
@@ -130,58 +177,65 @@ async def chat_command(request: AIChatRequest, current_user: User = Depends(get_
 
 请用友好、专业的语气与用户交流。{context_info}"""
 
-    # 构建消息历史
-    messages = [{"role": "system", "content": system_prompt}]
+    # 使用请求中指定的模型，如果没有则使用默认聊天模型
+    model = getattr(request, 'model', None) or ai_service.default_chat_model
     
-    # 添加历史消息
-    for msg in recent_messages[-5:]:  # 只取最近5条
-        messages.append({
-            "role": msg.role.value,
-            "content": msg.content
-        })
+    # 构建消息历史：系统提示 + 滚动摘要 + 预算内的最近对话
+    messages = [{"role": "system", "content": system_prompt}]
+    chat_context = await build_chat_context(db, session, model, reserved_tokens=count_message_tokens(messages))
+    messages.extend(chat_context.messages)
+    if chat_context.summarize_before:
+        background_tasks.add_task(rolling_summarizer.summarize, session.id, chat_context.summarize_before)
+    # 结束只读事务，等待模型回复期间不占用连接
+    await db.commit()
     
     # 调用AI
     try:
-        # 使用请求中指定的模型，如果没有则使用默认聊天模型
-        model = getattr(request, 'model', None) or ai_service.default_chat_model
-        ai_response = await ai_service.chat_completion(messages, model=model)
+        ai_response = await ai_service.chat_completion(messages, model=model, user_id=current_user.id)
+        ai_content = ai_response["content"]
         
         # 尝试解析为JSON
         try:
-            response_data = json.loads(ai_response)
+            response_data = json.loads(ai_content)
             response_type = response_data.get("response_type", "message")
-            content = response_data.get("content", ai_response)
+            content = response_data.get("content", ai_content)
             action_details = response_data.get("action_details")
         except json.JSONDecodeError:
             # 如果不是JSON，当作普通消息处理
             response_type = "message"
-            content = ai_response
+            content = ai_content
             action_details = None
         
         # 保存AI回复
         ai_message = ChatMessage(
             session_id=request.session_id,
-            role="ai",
+            role=RoleEnum.ai,
             content=content
         )
         db.add(ai_message)
-        db.commit()
+        await db.flush()
+        await db.run_sync(index_chat_message, ai_message, current_user.id)
+        await db.commit()
         
         return AIChatResponse(
             response_type=response_type,
             content=content,
-            action_details=action_details
+            action_details=action_details,
+            model=ai_response.get("model"),
+            usage=ai_response.get("usage")
         )
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         # 保存错误消息
         error_message = ChatMessage(
             session_id=request.session_id,
-            role="ai",
+            role=RoleEnum.ai,
             content=f"抱歉，我遇到了一些问题：{str(e)}"
         )
         db.add(error_message)
-        db.commit()
+        await db.commit()
         
         return AIChatResponse(
             response_type="message",
@@ -189,37 +243,37 @@ async def chat_command(request: AIChatRequest, current_user: User = Depends(get_
         )
 
 @router.delete("/sessions/{session_id}")
-def delete_chat_session(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_chat_session(session_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """删除对话会话"""
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
-    db.delete(session)
-    db.commit()
+    await db.delete(session)
+    await db.run_sync(remove_session_messages, session_id)
+    await db.commit()
     return {"message": "会话已删除"}
 
 @router.post("/sessions/{session_id}/save-as-note")
-def save_conversation_as_note(
+async def save_conversation_as_note(
     session_id: str, 
     folder_id: str,
     title: str = None,
-    current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async), 
+    db: AsyncSession = Depends(get_async_db)
 ):
     """将对话保存为笔记"""
     # 验证会话和文件夹
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
-    from models import Folder
-    folder = db.query(Folder).filter(Folder.id == folder_id, Folder.user_id == current_user.id).first()
+    folder = (await db.execute(select(Folder.id).where(Folder.id == folder_id, Folder.user_id == current_user.id))).first()
     if not folder:
         raise HTTPException(status_code=404, detail="文件夹不存在")
     
     # 获取会话消息
-    messages = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at).all()
+    messages = (await db.scalars(select(ChatMessage).where(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at))).all()
     
     # 构建笔记内容
     content = f"# 对话记录 - {session.title}\n\n"
@@ -235,8 +289,10 @@ def save_conversation_as_note(
         user_id=current_user.id
     )
     db.add(note)
-    db.commit()
-    db.refresh(note)
+    await db.flush()
+    await db.run_sync(index_note, note)
+    await db.commit()
+    notes_tree_cache.invalidate(current_user.id)
     
     return {"message": "对话已保存为笔记", "note_id": note.id}
 
@@ -0,0 +1,206 @@
+import os
+from typing import Dict, List, NamedTuple, Optional, Set
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import ChatSession, ChatMessage
+from ai_service import ai_service
+from pagination import encode_cursor, keyset_condition, keyset_paginate
+from retrieval import retrieval_index, best_passage
+from tokenizer import estimate_tokens, truncate_to_tokens, query_terms
+
+# 每条消息另计的角色与分隔开销（与 ai_service.count_message_tokens 一致）
+MESSAGE_OVERHEAD_TOKENS = 4
+HISTORY_PAGE_SIZE = 50
+# 需要摘要时，最近的对话保留历史预算的这一比例不做摘要，之后若干轮无需再次摘要
+SUMMARY_KEEP_RATIO = float(os.getenv("CHAT_SUMMARY_KEEP_RATIO", "0.5"))
+# 单次摘要读入的对话token上限，很长的旧会话分多轮逐步压缩
+SUMMARY_INPUT_TOKENS = int(os.getenv("CHAT_SUMMARY_INPUT_TOKENS", "6000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "600"))
+
+# 对话时从用户的笔记和任务中检索注入的相关片段：条数与总token数上限
+RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_TOKENS = int(os.getenv("CHAT_RETRIEVAL_TOKENS", "800"))
+RETRIEVAL_LABELS = {"note": "笔记", "task": "任务"}
+
+SUMMARY_SYSTEM_PROMPT = """你负责压缩对话记录。根据已有摘要和新增的对话内容，输出一份更新后的完整摘要：
+保留用户的目标、偏好、已确认的事实和决定、提到的笔记与任务以及尚未完成的事项，省略寒暄和重复内容。
+直接输出摘要正文，不超过{limit}字。"""
+
+
+class ChatContext(NamedTuple):
+    messages: List[Dict]           # 滚动摘要 + 按时间正序的历史消息，不含系统提示
+    tokens: int                    # messages 的估算token数
+    summarize_before: Optional[str]  # 需要更新摘要时，摘要到此游标之前的消息
+
+
+def to_api_role(role) -> str:
+    """数据库中的角色转换为模型接口的角色（ai 与 assistant 都对应 assistant）"""
+    return "user" if getattr(role, "value", role) == "user" else "assistant"
+
+
+def _message_tokens(row) -> int:
+    # 迁移前未回填的消息现场估算
+    tokens = row.token_count if row.token_count is not None else estimate_tokens(row.content)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def _message_query(session_id: str):
+    return select(
+        ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.token_count, ChatMessage.created_at
+    ).where(ChatMessage.session_id == session_id)
+
+
+async def build_chat_context(db: AsyncSession, session: ChatSession, model: str, reserved_tokens: int = 0) -> ChatContext:
+    """
+    按token预算组装对话历史：从最新的消息往前取，直到用完模型的历史预算，
+    更早的消息由会话的滚动摘要代替
+
+    reserved_tokens 为系统提示等其余部分的token数，历史预算不超过上下文长度扣除回复上限和这部分之后的剩余。
+    有消息超出预算且尚未摘要时返回 summarize_before，调用方在回复之后执行 rolling_summarizer.summarize
+    """
+    config = ai_service.model_config(model)
+    budget = min(ai_service.history_budget(model), config["context_window"] - config["max_output"] - reserved_tokens)
+    summary = []
+    if session.summary:
+        summary.append({"role": "system", "content": f"此前对话的摘要：\n{session.summary}"})
+        budget -= (session.summary_tokens or estimate_tokens(session.summary)) + MESSAGE_OVERHEAD_TOKENS
+    keep_budget = budget * SUMMARY_KEEP_RATIO
+
+    query = _message_query(session.id)
+    if session.summary_cursor:
+        query = query.where(keyset_condition(ChatMessage.created_at, ChatMessage.id, session.summary_cursor, descending=False))
+
+    history = []
+    used = 0
+    keep_cursor = None
+    overflow = False
+    page_cursor = None
+    while not overflow:
+        rows = (await db.execute(keyset_paginate(query, ChatMessage.created_at, ChatMessage.id, page_cursor, HISTORY_PAGE_SIZE))).all()
+        for row in rows[:HISTORY_PAGE_SIZE]:
+            tokens = _message_tokens(row)
+            content = row.content
+            if used + tokens > budget:
+                if history:
+                    overflow = True
+                    break
+                # 最新的一条消息单独就超出预算时截断保留
+                content = truncate_to_tokens(content, max(budget - MESSAGE_OVERHEAD_TOKENS, 0))
+                tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            history.append({"role": to_api_role(row.role), "content": content})
+            used += tokens
+            if keep_cursor is None or used <= keep_budget:
+                keep_cursor = encode_cursor(row.created_at, row.id)
+        if len(rows) <= HISTORY_PAGE_SIZE:
+            break
+        last = rows[HISTORY_PAGE_SIZE - 1]
+        page_cursor = encode_cursor(last.created_at, last.id)
+
+    history.reverse()
+    summary_tokens = sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in summary)
+    return ChatContext(summary + history, summary_tokens + used, keep_cursor if overflow else None)
+
+
+async def retrieve_snippets(db: AsyncSession, user_id: str, text: str, exclude: Optional[tuple] = None) -> str:
+    """
+    从用户的笔记和任务中检索与当前消息最相关的几条，各取命中最多的片段，
+    拼成附加到系统提示的文本（总长不超过 RETRIEVAL_TOKENS）；没有相关内容时返回空字符串
+    """
+    if RETRIEVAL_TOP_K <= 0:
+        return ""
+    index = await retrieval_index.ensure_async(db, user_id)
+    hits = retrieval_index.search(index, text, RETRIEVAL_TOP_K, exclude=exclude)
+    if not hits:
+        return ""
+    terms = query_terms(text)
+    per_hit = RETRIEVAL_TOKENS // len(hits)
+    lines = []
+    for doc, _ in hits:
+        passage = best_passage(doc.body, terms, per_hit - estimate_tokens(doc.title))
+        lines.append(f"- 【{RETRIEVAL_LABELS[doc.doc_type]}】{doc.title}：{passage}")
+    return "\n\n可能相关的笔记和任务（仅供参考，与问题无关时忽略）：\n" + "\n".join(lines)
+
+
+class RollingSummarizer:
+    """
+    会话的滚动摘要：把超出历史预算的较早对话连同已有摘要压缩成新的摘要，保存在会话上
+
+    在回复之后（后台任务）执行，不增加当前请求的延迟；同一会话同时只有一个摘要任务
+    """
+
+    def __init__(self):
+        self._running: Set[str] = set()
+        self.completed = 0
+
+    async def summarize(self, session_id: str, before_cursor: str):
+        if session_id in self._running:
+            return
+        self._running.add(session_id)
+        try:
+            async with AsyncSessionLocal() as db:
+                await self._summarize(db, session_id, before_cursor)
+        except Exception as e:
+            print(f"⚠️ 对话摘要更新失败: {e}")
+        finally:
+            self._running.discard(session_id)
+
+    async def _summarize(self, db: AsyncSession, session_id: str, before_cursor: str):
+        session = await db.get(ChatSession, session_id)
+        if session is None:
+            return
+        previous_cursor = session.summary_cursor
+        query = _message_query(session_id).where(
+            keyset_condition(ChatMessage.created_at, ChatMessage.id, before_cursor, descending=True)
+        )
+
+        # 从上次摘要的位置往后取，最多读入 SUMMARY_INPUT_TOKENS
+        lines = []
+        used = 0
+        last = None
+        full = False
+        page_cursor = previous_cursor
+        while not full:
+            rows = (await db.execute(keyset_paginate(query, ChatMessage.created_at, ChatMessage.id, page_cursor, HISTORY_PAGE_SIZE, descending=False))).all()
+            for row in rows[:HISTORY_PAGE_SIZE]:
+                content = truncate_to_tokens(row.content, SUMMARY_INPUT_TOKENS)
+                tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+                if last is not None and used + tokens > SUMMARY_INPUT_TOKENS:
+                    full = True
+                    break
+                speaker = "用户" if to_api_role(row.role) == "user" else "AI助手"
+                lines.append(f"{speaker}：{content}")
+                used += tokens
+                last = row
+            if len(rows) <= HISTORY_PAGE_SIZE:
+                break
+            page_cursor = encode_cursor(last.created_at, last.id)
+        # 结束只读事务，等待模型回复期间不占用连接
+        await db.commit()
+        if last is None:
+            return
+
+        prompt = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT.format(limit=SUMMARY_MAX_TOKENS // 2)},
+            {"role": "user", "content": f"已有摘要：\n{session.summary or '（无）'}\n\n新增对话：\n" + "\n".join(lines)}
+        ]
+        result = await ai_service.chat_completion(prompt, model=ai_service.default_ai_model, max_tokens=SUMMARY_MAX_TOKENS, background=True, feature="summary")
+        summary = (result.get("content") or "").strip()
+        if not summary:
+            return
+
+        # 期间其他进程已推进摘要时放弃本次结果
+        current = ChatSession.summary_cursor == previous_cursor if previous_cursor else ChatSession.summary_cursor.is_(None)
+        await db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id, current)
+            .values(summary=summary, summary_cursor=encode_cursor(last.created_at, last.id), summary_tokens=estimate_tokens(summary))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        self.completed += 1
+        print(f"📝 会话 {session_id} 的对话摘要已更新（压缩 {len(lines)} 条消息）")
+
+
+rolling_summarizer = RollingSummarizer()
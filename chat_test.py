@@ -1,86 +1,131 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 import json
 
-from database import get_db
+from database import get_async_db, AsyncSessionLocal
 from models import User, ChatSession, ChatMessage, Note, Task, Category
 from schemas import (
     ChatSession as ChatSessionSchema, ChatSessionCreate,
     ChatMessage as ChatMessageSchema, ChatMessageCreate,
     AIChatRequest, AIChatResponse
 )
-from ai_service import ai_service
+from ai_service import ai_service, count_message_tokens
+from admission import AdmissionRejected
+from chat_context import build_chat_context, retrieve_snippets, rolling_summarizer
+from sse import format_sse, SSE_HEADERS
+from search import index_chat_message, remove_session_messages
+from pagination import keyset_paginate, finish_page
 
 router = APIRouter()
 
 # 获取默认用户（用于测试）
-def get_default_user(db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == "宁宇").first()
+async def get_default_user(db: AsyncSession):
+    user = (await db.execute(select(User).where(User.username == "宁宇"))).scalar_one_or_none()
     if not user:
         # 如果没有用户，创建一个测试用户
-        from auth import get_password_hash
+        from auth import get_password_hash_async
         from datetime import datetime
         user = User(
             username="宁宇",
             email="ningyu@cortex.ai",
             full_name="宁宇",
-            hashed_password=get_password_hash("ny123456"),
+            hashed_password=await get_password_hash_async("ny123456"),
             is_active=True,
             is_superuser=True,
             created_at=datetime.utcnow()
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
     return user
 
+async def _get_user_session(db: AsyncSession, session_id: str, user_id: str) -> Optional[ChatSession]:
+    return (await db.execute(
+        select(ChatSession).where(ChatSession.id == session_id, ChatSession.user_id == user_id)
+    )).scalar_one_or_none()
+
+async def _context_messages(db: AsyncSession, session: ChatSession, text: str, model: Optional[str], background_tasks: BackgroundTasks) -> List[dict]:
+    """
+    组装发送给模型的消息：与当前消息相关的笔记/任务片段 + 滚动摘要 + 预算内的最近消息（已包含刚保存的用户消息），
+    需要时在响应之后更新摘要；返回前结束只读事务，等待模型回复期间不占用连接
+    """
+    messages = []
+    snippets = await retrieve_snippets(db, session.user_id, text)
+    if snippets:
+        messages.append({"role": "system", "content": snippets.strip()})
+    chat_context = await build_chat_context(db, session, model or ai_service.default_chat_model, reserved_tokens=count_message_tokens(messages))
+    if chat_context.summarize_before:
+        background_tasks.add_task(rolling_summarizer.summarize, session.id, chat_context.summarize_before)
+    await db.commit()
+    return messages + chat_context.messages
+
 @router.get("/sessions", response_model=List[ChatSessionSchema])
-def get_chat_sessions(db: Session = Depends(get_db)):
-    """获取用户的所有对话会话"""
-    current_user = get_default_user(db)
-    sessions = db.query(ChatSession).filter(ChatSession.user_id == current_user.id).order_by(ChatSession.created_at.desc()).all()
-    return sessions
+async def get_chat_sessions(
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取用户的对话会话（按创建时间倒序；下一页游标见响应头X-Next-Cursor）"""
+    current_user = await get_default_user(db)
+    query = select(ChatSession).where(ChatSession.user_id == current_user.id)
+    query = keyset_paginate(query, ChatSession.created_at, ChatSession.id, cursor, limit)
+    sessions = list((await db.execute(query)).scalars())
+    return finish_page(sessions, response, limit, "created_at")
 
 @router.post("/sessions", response_model=ChatSessionSchema)
-def create_chat_session(session: ChatSessionCreate, db: Session = Depends(get_db)):
+async def create_chat_session(session: ChatSessionCreate, db: AsyncSession = Depends(get_async_db)):
     """创建新的对话会话"""
-    current_user = get_default_user(db)
+    current_user = await get_default_user(db)
     db_session = ChatSession(
         title=session.title,
         user_id=current_user.id
     )
     db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    await db.commit()
+    await db.refresh(db_session)
     return db_session
 
 @router.get("/sessions/{session_id}/messages", response_model=List[ChatMessageSchema])
-def get_session_messages(session_id: str, db: Session = Depends(get_db)):
-    """获取会话的所有消息"""
-    current_user = get_default_user(db)
+async def get_session_messages(
+    session_id: str,
+    response: Response,
+    limit: int = Query(200, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    获取会话消息：每页返回最近的limit条，按时间正序排列；
+    响应头X-Next-Cursor为更早一页消息的游标
+    """
+    current_user = await get_default_user(db)
     # 验证会话属于当前用户
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
-    messages = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at).all()
+    query = select(ChatMessage).where(ChatMessage.session_id == session_id)
+    query = keyset_paginate(query, ChatMessage.created_at, ChatMessage.id, cursor, limit)
+    messages = finish_page(list((await db.execute(query)).scalars()), response, limit, "created_at")
+    messages.reverse()
     return messages
 
 @router.post("/command", response_model=AIChatResponse)
-async def chat_command(request: AIChatRequest, db: Session = Depends(get_db)):
-    """核心对话接口 - AI大脑"""
-    current_user = get_default_user(db)
+async def chat_command(request: AIChatRequest, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_async_db)):
+    """核心对话接口 - AI大脑（携带按token预算组装的对话历史与滚动摘要）"""
+    current_user = await get_default_user(db)
     
     # 验证会话
-    session = db.query(ChatSession).filter(
-        ChatSession.id == request.session_id,
-        ChatSession.user_id == current_user.id
-    ).first()
+    session = await _get_user_session(db, request.session_id, current_user.id)
     
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
+    # 超出准入限制时在保存消息之前返回429
+    await ai_service.check_admission(current_user.id, request.model)
+    
     try:
         # 保存用户消息
         user_message = ChatMessage(
@@ -89,16 +134,22 @@ async def chat_command(request: AIChatRequest, db: Session = Depends(get_db)):
             content=request.text
         )
         db.add(user_message)
-        db.commit()
+        await db.flush()
+        await db.run_sync(index_chat_message, user_message, current_user.id)
+        await db.commit()
+        
+        messages = await _context_messages(db, session, request.text, request.model, background_tasks)
         
         # 调用AI服务
         ai_response = await ai_service.chat_completion(
-            messages=[{"role": "user", "content": request.text}],
-            model=request.model
+            messages=messages,
+            model=request.model,
+            user_id=current_user.id
         )
         
         # 提取AI响应内容
         ai_content = ai_response.get("content", str(ai_response)) if isinstance(ai_response, dict) else str(ai_response)
+        usage = ai_response.get("usage") if isinstance(ai_response, dict) else None
         
         # 保存AI响应
         ai_message = ChatMessage(
@@ -107,40 +158,121 @@ async def chat_command(request: AIChatRequest, db: Session = Depends(get_db)):
             content=ai_content
         )
         db.add(ai_message)
-        db.commit()
+        await db.flush()
+        await db.run_sync(index_chat_message, ai_message, current_user.id)
+        await db.commit()
         
         return AIChatResponse(
             response_type="message",
-            content=ai_content
+            content=ai_content,
+            model=ai_response.get("model") if isinstance(ai_response, dict) else None,
+            usage=usage
         )
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI服务错误: {str(e)}")
 
+@router.post("/command/stream")
+async def chat_command_stream(request: AIChatRequest, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_async_db)):
+    """核心对话接口（流式）- 以SSE逐块返回AI回复，结束后一次性保存完整消息"""
+    current_user = await get_default_user(db)
+    
+    # 验证会话
+    session = await _get_user_session(db, request.session_id, current_user.id)
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    await ai_service.check_admission(current_user.id, request.model)
+    
+    # 保存用户消息
+    user_message = ChatMessage(
+        session_id=request.session_id,
+        role="user",
+        content=request.text
+    )
+    db.add(user_message)
+    await db.flush()
+    await db.run_sync(index_chat_message, user_message, current_user.id)
+    await db.commit()
+    
+    session_id = request.session_id
+    user_id = current_user.id
+    messages = await _context_messages(db, session, request.text, request.model, background_tasks)
+    
+    async def event_stream():
+        parts = []
+        done = None
+        try:
+            async for event in ai_service.stream_chat_completion(messages, model=request.model, user_id=user_id):
+                if event["type"] == "delta":
+                    parts.append(event["content"])
+                    yield format_sse("delta", {"content": event["content"]})
+                else:
+                    done = event
+        except AdmissionRejected as e:
+            yield format_sse("error", {"detail": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            yield format_sse("error", {"detail": f"AI服务错误: {str(e)}"})
+        
+        # 流结束后保存完整的AI响应（请求级会话此时可能已关闭，使用独立会话）
+        ai_content = "".join(parts)
+        message_id = None
+        if ai_content:
+            async with AsyncSessionLocal() as stream_db:
+                ai_message = ChatMessage(
+                    session_id=session_id,
+                    role="assistant",
+                    content=ai_content
+                )
+                stream_db.add(ai_message)
+                await stream_db.flush()
+                await stream_db.run_sync(index_chat_message, ai_message, user_id)
+                await stream_db.commit()
+                message_id = ai_message.id
+        
+        if done is not None:
+            yield format_sse("done", {
+                "response_type": "message",
+                "message_id": message_id,
+                "model": done["model"],
+                "finish_reason": done["finish_reason"],
+                "usage": done["usage"]
+            })
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @router.delete("/sessions/{session_id}")
-def delete_chat_session(session_id: str, db: Session = Depends(get_db)):
+async def delete_chat_session(session_id: str, db: AsyncSession = Depends(get_async_db)):
     """删除对话会话"""
-    current_user = get_default_user(db)
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    current_user = await get_default_user(db)
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
     # 删除会话相关的消息
-    db.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete()
+    await db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+    await db.run_sync(remove_session_messages, session_id)
     # 删除会话
-    db.delete(session)
-    db.commit()
+    await db.delete(session)
+    await db.commit()
     return {"message": "会话已删除"}
 
 @router.put("/sessions/{session_id}")
-def update_chat_session(session_id: str, session_update: ChatSessionCreate, db: Session = Depends(get_db)):
+async def update_chat_session(session_id: str, session_update: ChatSessionCreate, db: AsyncSession = Depends(get_async_db)):
     """更新会话标题"""
-    current_user = get_default_user(db)
-    session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == current_user.id).first()
+    current_user = await get_default_user(db)
+    session = await _get_user_session(db, session_id, current_user.id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
     session.title = session_update.title
-    db.commit()
-    db.refresh(session)
+    await db.commit()
+    await db.refresh(session)
     return session
\ No newline at end of file
@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.elements import TextClause
 import os
 from dotenv import load_dotenv
 
@@ -9,21 +11,194 @@ load_dotenv()
 # 数据库URL配置
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./cortex_workspace.db")
 
-# 创建数据库引擎
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        DATABASE_URL, 
-        connect_args={"check_same_thread": False}
+# SQLite生产配置（SQLITE_PROFILE=production 时启用）：WAL + 连接级PRAGMA调优，
+# 写入经由单个写连接串行执行，读取使用独立的连接池
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "default")
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),  # 负数表示KB，默认64MB
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),  # 毫秒
+    "temp_store": "MEMORY",
+}
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+# 只读语句的起始关键字，其余文本SQL一律视为写入
+READ_ONLY_KEYWORDS = ("SELECT", "WITH", "PRAGMA", "EXPLAIN")
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新建的SQLite连接都设置一遍PRAGMA（大多数PRAGMA只对当前连接生效）"""
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def create_sqlite_engines(url: str, profile: str = "default", create=create_engine):
+    """
+    创建SQLite引擎，返回 (写引擎, 读引擎)；create 传 create_async_engine 时创建异步引擎
+
+    默认配置下两者是同一个引擎；production 配置下写引擎只有一个连接，
+    同一时刻只有一个事务持有写锁，其余写入在连接池中排队而不是撞上 "database is locked"，
+    读取走单独的连接池，借助WAL与写入并发执行
+    """
+    connect_args = {"check_same_thread": False}
+    if profile != "production":
+        engine = create(url, connect_args=connect_args)
+        return engine, engine
+
+    write_engine = create(url, connect_args=connect_args, pool_size=1, max_overflow=0)
+    read_engine = create(url, connect_args=connect_args, pool_size=SQLITE_READ_POOL_SIZE, max_overflow=SQLITE_READ_POOL_SIZE)
+    for created in (write_engine, read_engine):
+        event.listen(getattr(created, "sync_engine", created), "connect", apply_sqlite_pragmas)
+    return write_engine, read_engine
+
+def _is_write(clause) -> bool:
+    if clause is None:
+        return False
+    if getattr(clause, "is_dml", False):
+        return True
+    if isinstance(clause, TextClause):
+        words = clause.text.split(None, 1)
+        return bool(words) and words[0].upper() not in READ_ONLY_KEYWORDS
+    return False
+
+class RoutingSession(Session):
+    """
+    读写分离的会话：flush和写语句使用写引擎，其余查询使用读引擎
+
+    事务中一旦写过，之后的查询也留在写连接上，保证能读到本事务尚未提交的修改；
+    事务结束（提交/回滚）后恢复为读连接
+    """
+
+    write_engine = None
+    read_engine = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writing = False
+
+    def get_bind(self, mapper=None, *, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        if self._writing or self._flushing or _is_write(clause):
+            self._writing = True
+            return self.write_engine
+        return self.read_engine
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session, transaction):
+    if transaction.parent is None:
+        session._writing = False
+
+def routing_session_class(write_engine, read_engine):
+    return type("BoundRoutingSession", (RoutingSession,), {"write_engine": write_engine, "read_engine": read_engine})
+
+def create_session_factory(write_engine, read_engine):
+    """读写是同一个引擎时使用普通会话，否则使用读写分离的会话"""
+    if write_engine is read_engine:
+        return sessionmaker(autocommit=False, autoflush=False, bind=write_engine)
+    return sessionmaker(class_=routing_session_class(write_engine, read_engine), autocommit=False, autoflush=False)
+
+def create_async_session_factory(write_engine, read_engine):
+    """
+    异步会话工厂。提交后不使对象过期：异步会话中访问过期属性会触发隐式查询而报错，
+    需要数据库生成的字段时显式 await db.refresh(obj)
+    """
+    if write_engine is read_engine:
+        return async_sessionmaker(bind=write_engine, autoflush=False, expire_on_commit=False)
+    return async_sessionmaker(
+        sync_session_class=routing_session_class(write_engine.sync_engine, read_engine.sync_engine),
+        autoflush=False,
+        expire_on_commit=False
     )
+
+def async_database_url(url: str) -> str:
+    """同步驱动的URL换成对应的异步驱动：SQLite使用aiosqlite，PostgreSQL使用asyncpg"""
+    scheme, _, rest = url.partition("://")
+    if scheme.startswith("sqlite"):
+        return f"sqlite+aiosqlite://{rest}"
+    if scheme.startswith("postgres"):
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+# 创建数据库引擎（engine 为写引擎，迁移和建表使用它）
+if DATABASE_URL.startswith("sqlite"):
+    engine, read_engine = create_sqlite_engines(DATABASE_URL, SQLITE_PROFILE)
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = read_engine = create_engine(DATABASE_URL)
 
 # 创建会话工厂
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = create_session_factory(engine, read_engine)
+
+# 异步引擎与会话：笔记/任务/对话/番茄钟路由使用，等待数据库时不占用线程池
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_database_url(DATABASE_URL))
+if ASYNC_DATABASE_URL.startswith("sqlite"):
+    async_engine, async_read_engine = create_sqlite_engines(ASYNC_DATABASE_URL, SQLITE_PROFILE, create=create_async_engine)
+else:
+    async_engine = async_read_engine = create_async_engine(ASYNC_DATABASE_URL)
+
+AsyncSessionLocal = create_async_session_factory(async_engine, async_read_engine)
 
 # 创建基础模型类
 Base = declarative_base()
 
+# 迁移配置文件位于项目根目录
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+BASELINE_REVISION = "0001"
+
+def run_migrations(bind=None):
+    """
+    将数据库升级到最新迁移版本，应用启动时调用
+
+    引入迁移之前由 create_all 建出的数据库没有 alembic_version 表：一律标记为基线版本再执行之后的迁移。
+    即使表结构已是最新也不能直接标记为最新版本，否则各迁移中的回填（统计计数、汇总、跨度分级、token数等）
+    会被跳过；迁移对已存在的表、列和索引都会跳过创建，回填按现有数据重新计算
+    """
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import inspect
+
+    bind = bind or engine
+    config = Config(ALEMBIC_INI)
+    config.set_main_option("script_location", os.path.join(os.path.dirname(ALEMBIC_INI), "migrations"))
+    config.attributes["configure_logger"] = False
+
+    with bind.begin() as connection:
+        config.attributes["connection"] = connection
+        tables = set(inspect(connection).get_table_names())
+        if "users" in tables and "alembic_version" not in tables:
+            print("🗂️ 检测到未纳入迁移管理的数据库，标记为基线版本")
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, "head")
+
+def increment_counter(db, model, keys: dict, deltas: dict):
+    """
+    原子地累加一行计数（不存在时插入），用于统计表的增量维护
+
+    keys 为主键列的值，deltas 为要累加的列及增量；SQLite/Postgres使用 ON CONFLICT DO UPDATE，
+    其他数据库退化为先UPDATE、未命中再INSERT
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(model).values(**keys, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: getattr(model, column) + getattr(stmt.excluded, column) for column in deltas}
+        )
+        db.execute(stmt)
+        return
+
+    updated = db.query(model).filter_by(**keys).update(
+        {getattr(model, column): getattr(model, column) + delta for column, delta in deltas.items()},
+        synchronize_session=False
+    )
+    if not updated:
+        db.add(model(**keys, **deltas))
+
 # 数据库依赖
 def get_db():
     db = SessionLocal()
@@ -32,3 +207,13 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def dispose_async_engines():
+    """应用关闭时关闭异步连接池"""
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
@@ -34,7 +34,7 @@ async def test_kimi_chat(request: ChatRequest):
         ]
 
         # 调用AI服务
-        result = await ai_service.chat_completion(messages, model=request.model)
+        result = await ai_service.chat_completion(messages, model=request.model, feature="test")
 
         response_time = int((time.time() - start_time) * 1000)
 
@@ -51,22 +51,24 @@ async def test_kimi_chat(request: ChatRequest):
 @router.get("/status")
 async def get_kimi_status():
     """
-    获取Kimi K2模型状态
+    获取Kimi K2模型状态（使用后台健康探测的缓存结果，不发起对话请求）
     """
-    try:
-        # 测试简单对话
-        messages = [{"role": "user", "content": "你好"}]
-        result = await ai_service.chat_completion(messages, model="kimi-k2-latest")
-
+    probe = await ai_service.router.provider_status("kimi")
+    circuit = ai_service.router.states["kimi"].state
+    if probe["status"] == "online":
         return {
             "status": "online",
-            "model": result["model"],
-            "message": "Kimi K2 模型运行正常"
+            "model": "kimi-k2-latest",
+            "message": "Kimi K2 模型运行正常",
+            "latency_ms": probe["latency_ms"],
+            "checked_at": probe["checked_at"],
+            "circuit": circuit
         }
 
-    except Exception as e:
-        return {
-            "status": "offline",
-            "error": str(e),
-            "message": "Kimi K2 模型连接失败"
-        }
\ No newline at end of file
+    return {
+        "status": "offline",
+        "error": probe.get("error", "未配置KIMI_API_KEY"),
+        "message": "Kimi K2 模型连接失败",
+        "checked_at": probe["checked_at"],
+        "circuit": circuit
+    }
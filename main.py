@@ -8,17 +8,17 @@ import uvicorn
 import os
 from dotenv import load_dotenv
 
-from database import get_db, engine, Base
-import notes, tasks, chat, chat_test, pomodoro, auth, ai, users, kimi_test
+from database import get_db, engine, run_migrations, dispose_async_engines
+import notes, tasks, chat, chat_test, pomodoro, auth, ai, users, search, kimi_test
 from models import User, Category, Note, Task, ChatSession, PomodoroLog
 from auth import create_super_user
+from ai_service import ai_service
+from admission import AdmissionRejected, admission_rejected_handler
+from usage_ledger import usage_ledger
 
 # 加载环境变量
 load_dotenv()
 
-# 创建数据库表
-Base.metadata.create_all(bind=engine)
-
 # 创建FastAPI应用
 app = FastAPI(
     title="Cortex AI Workspace API",
@@ -44,8 +44,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 前端需要读取分页游标、笔记树ETag和限流后的重试等待时间
+    expose_headers=["X-Next-Cursor", "ETag", "Retry-After"],
 )
 
+# AI请求超出限速或排队已满时返回429和Retry-After
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+
 # 安全配置
 security = HTTPBearer()
 
@@ -61,12 +66,23 @@ app.include_router(tasks.router, prefix="/api/tasks", tags=["任务"])
 app.include_router(chat_test.router, prefix="/api/chat", tags=["对话"])
 app.include_router(pomodoro.router, prefix="/api/pomodoro", tags=["番茄钟"])
 app.include_router(ai.router, prefix="/api/ai", tags=["AI服务"])
+app.include_router(search.router, prefix="/api/search", tags=["全文检索"])
 app.include_router(kimi_test.router, tags=["Kimi测试"])
 
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
+    # 创建/升级数据库表（在启动时而不是导入时执行，导入main不会改动数据库）
+    run_migrations(engine)
     db = next(get_db())
+    try:
+        # 创建全文检索索引（首次创建时回填已有数据）
+        if search.init_search_index(engine):
+            count = search.rebuild_index(db)
+            db.commit()
+            print(f"✅ 全文检索索引已创建，回填 {count} 条文档")
+    except Exception as e:
+        print(f"❌ 全文检索索引初始化失败: {e}")
     try:
         # 创建超级用户（如果不存在）
         create_super_user(db)
@@ -78,6 +94,17 @@ async def startup_event():
         print(f"❌ 超级用户初始化失败: {e}")
     finally:
         db.close()
+    # 启动AI服务商后台健康探测和AI用量后台写入
+    ai_service.router.start_prober()
+    usage_ledger.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时释放资源"""
+    await ai_service.router.stop_prober()
+    await usage_ledger.stop()
+    await ai_service.aclose()
+    await dispose_async_engines()
 
 @app.get("/api/")
 async def api_root():
@@ -0,0 +1,74 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+from database import DATABASE_URL
+import models
+
+config = context.config
+
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+if not config.get_main_option("sqlalchemy.url"):
+    config.set_main_option("sqlalchemy.url", DATABASE_URL.replace("%", "%%"))
+
+target_metadata = models.Base.metadata
+
+# 全文检索表按数据库方言单独维护（见 search.init_search_index），不参与自动生成迁移
+SEARCH_TABLES = {"search_documents", "search_fts"}
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    if type_ == "table" and (name in SEARCH_TABLES or name.startswith("search_fts_")):
+        return False
+    return True
+
+
+def run_migrations_offline():
+    """生成SQL脚本而不连接数据库：alembic upgrade head --sql"""
+    context.configure(
+        url=config.get_main_option("sqlalchemy.url"),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # 应用启动时通过 config.attributes 传入已有连接，命令行运行时自行建立连接
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        _run_with_connection(connection)
+        return
+
+    connectable = engine_from_config(
+        config.get_section(config.config_ini_section, {}),
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+    with connectable.connect() as connection:
+        _run_with_connection(connection)
+
+
+def _run_with_connection(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        # SQLite不支持大部分ALTER TABLE，使用批处理模式重建表
+        render_as_batch=connection.dialect.name == "sqlite",
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
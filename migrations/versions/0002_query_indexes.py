@@ -0,0 +1,51 @@
+"""热点查询的复合索引
+
+按各接口的实际查询条件设计：
+- 列表游标分页：(user_id, created_at, id) / (session_id, created_at, id) / (user_id, completed_at, id)
+- 任务筛选与统计：(user_id, status)、(user_id, start_time)、(user_id, category_id)
+- 单任务番茄钟统计：(task_id, completed_at)
+- 笔记树与文件夹：notes(folder_id)、folders(category_id, name)、folders(user_id)
+- 分类/标签按用户与名称查找、note_tags按标签反查
+
+使用 if_not_exists，已通过 create_all 建出部分索引的数据库可以直接升级
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_notes_user_created", "notes", ["user_id", "created_at", "id"]),
+    ("ix_notes_folder", "notes", ["folder_id"]),
+    ("ix_folders_category_name", "folders", ["category_id", "name"]),
+    ("ix_folders_user", "folders", ["user_id"]),
+    ("ix_categories_user_name", "categories", ["user_id", "name"]),
+    ("ix_tags_user_name", "tags", ["user_id", "name"]),
+    ("ix_note_tags_tag", "note_tags", ["tag_id"]),
+    ("ix_tasks_user_created", "tasks", ["user_id", "created_at", "id"]),
+    ("ix_tasks_user_status", "tasks", ["user_id", "status"]),
+    ("ix_tasks_user_start", "tasks", ["user_id", "start_time"]),
+    ("ix_tasks_user_category", "tasks", ["user_id", "category_id"]),
+    ("ix_chat_sessions_user_created", "chat_sessions", ["user_id", "created_at", "id"]),
+    ("ix_chat_messages_session_created", "chat_messages", ["session_id", "created_at", "id"]),
+    ("ix_pomodoro_logs_user_completed", "pomodoro_logs", ["user_id", "completed_at", "id"]),
+    ("ix_pomodoro_logs_task_completed", "pomodoro_logs", ["task_id", "completed_at"]),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,52 @@
+"""任务统计计数表
+
+- 新增 task_stat_counters，按 (用户, 状态, 优先级, 分类) 保存任务数，并从现有任务回填
+- (user_id, status) 索引扩展为 (user_id, status, end_time, category_id)，逾期统计只在索引内扫描未完成且已过期的任务
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def _has_table(name: str) -> bool:
+    # 引入迁移之前由 create_all 建出的数据库可能已有此表（离线生成SQL时按不存在处理）
+    return not context.is_offline_mode() and sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not _has_table('task_stat_counters'):
+        op.create_table('task_stat_counters',
+        sa.Column('user_id', sa.String(), nullable=False),
+        sa.Column('status', sa.String(length=10), nullable=False),
+        sa.Column('priority', sa.String(length=10), nullable=False),
+        sa.Column('category_id', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'status', 'priority', 'category_id')
+        )
+    # 已有的计数表可能只累计了建表之后的写入，清空后按现有任务重新计算
+    op.execute("DELETE FROM task_stat_counters")
+    op.execute(
+        "INSERT INTO task_stat_counters (user_id, status, priority, category_id, count) "
+        "SELECT user_id, COALESCE(status, ''), COALESCE(priority, ''), COALESCE(category_id, ''), COUNT(*) "
+        "FROM tasks GROUP BY user_id, COALESCE(status, ''), COALESCE(priority, ''), COALESCE(category_id, '')"
+    )
+
+    op.drop_index('ix_tasks_user_status', table_name='tasks', if_exists=True)
+    op.create_index('ix_tasks_user_status_end', 'tasks', ['user_id', 'status', 'end_time', 'category_id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_tasks_user_status_end', table_name='tasks', if_exists=True)
+    op.create_index('ix_tasks_user_status', 'tasks', ['user_id', 'status'], if_not_exists=True)
+    op.drop_table('task_stat_counters')
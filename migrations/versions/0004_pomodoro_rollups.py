@@ -0,0 +1,68 @@
+"""番茄钟按天汇总表
+
+新增 pomodoro_daily_rollups（用户/天）与 pomodoro_task_daily_rollups（用户/任务/天），
+并从现有番茄钟记录回填
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def _has_table(name: str) -> bool:
+    # 引入迁移之前由 create_all 建出的数据库可能已有此表（离线生成SQL时按不存在处理）
+    return not context.is_offline_mode() and sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not _has_table('pomodoro_daily_rollups'):
+        op.create_table('pomodoro_daily_rollups',
+        sa.Column('user_id', sa.String(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('minutes', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'day')
+        )
+    if not _has_table('pomodoro_task_daily_rollups'):
+        op.create_table('pomodoro_task_daily_rollups',
+        sa.Column('user_id', sa.String(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('task_id', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('minutes', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'day', 'task_id')
+        )
+    op.create_index('ix_pomodoro_task_rollups_task_day', 'pomodoro_task_daily_rollups', ['task_id', 'day'], if_not_exists=True)
+
+    # 已有的汇总表可能只累计了建表之后的番茄钟，清空后按现有记录重新汇总
+    op.execute("DELETE FROM pomodoro_daily_rollups")
+    op.execute("DELETE FROM pomodoro_task_daily_rollups")
+    # date() 在SQLite返回 YYYY-MM-DD 文本，在Postgres返回date，均与Date列的存储格式一致
+    op.execute(
+        "INSERT INTO pomodoro_daily_rollups (user_id, day, count, minutes) "
+        "SELECT user_id, date(completed_at), COUNT(*), SUM(duration) "
+        "FROM pomodoro_logs WHERE completed_at IS NOT NULL GROUP BY user_id, date(completed_at)"
+    )
+    op.execute(
+        "INSERT INTO pomodoro_task_daily_rollups (user_id, day, task_id, count, minutes) "
+        "SELECT user_id, date(completed_at), task_id, COUNT(*), SUM(duration) "
+        "FROM pomodoro_logs WHERE completed_at IS NOT NULL AND task_id IS NOT NULL "
+        "GROUP BY user_id, task_id, date(completed_at)"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_pomodoro_task_rollups_task_day', table_name='pomodoro_task_daily_rollups')
+    op.drop_table('pomodoro_task_daily_rollups')
+    op.drop_table('pomodoro_daily_rollups')
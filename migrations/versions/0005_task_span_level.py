@@ -0,0 +1,59 @@
+"""任务日历区间索引
+
+- tasks 新增 span_level（按开始到结束的跨度分级），并按现有任务的开始/结束时间回填
+- 新增 (user_id, span_level, start_time, end_time) 索引：日历按级别限定开始时间的回溯范围，
+  在索引内完成重叠判断
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+from models import task_span_level
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+tasks = sa.table(
+    'tasks',
+    sa.column('id', sa.String()),
+    sa.column('start_time', sa.DateTime()),
+    sa.column('end_time', sa.DateTime()),
+    sa.column('span_level', sa.Integer()),
+)
+
+
+def _has_column(table: str, column: str) -> bool:
+    # 引入迁移之前由 create_all 建出的数据库可能已有此列（离线生成SQL时按不存在处理）
+    return not context.is_offline_mode() and column in {item["name"] for item in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if not _has_column('tasks', 'span_level'):
+        with op.batch_alter_table('tasks') as batch_op:
+            batch_op.add_column(sa.Column('span_level', sa.Integer(), nullable=True))
+
+    # 跨度分级规则在Python中定义，逐条计算后按级别批量更新（离线生成SQL时无法读取数据，跳过回填）
+    if not context.is_offline_mode():
+        connection = op.get_bind()
+        levels = {}
+        rows = connection.execute(sa.select(tasks.c.id, tasks.c.start_time, tasks.c.end_time).where(tasks.c.start_time.is_not(None)))
+        for task_id, start_time, end_time in rows:
+            levels.setdefault(task_span_level(start_time, end_time), []).append(task_id)
+        for level, task_ids in levels.items():
+            for offset in range(0, len(task_ids), 500):
+                connection.execute(tasks.update().where(tasks.c.id.in_(task_ids[offset:offset + 500])).values(span_level=level))
+
+    op.create_index('ix_tasks_user_span_start', 'tasks', ['user_id', 'span_level', 'start_time', 'end_time'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_tasks_user_span_start', table_name='tasks', if_exists=True)
+    with op.batch_alter_table('tasks') as batch_op:
+        batch_op.drop_column('span_level')
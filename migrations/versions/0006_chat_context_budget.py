@@ -0,0 +1,69 @@
+"""对话上下文token预算
+
+- chat_messages 新增 token_count（估算的token数），并为现有消息回填
+- chat_sessions 新增滚动摘要：summary、summary_cursor（已摘要到的消息游标）、summary_tokens
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+from tokenizer import estimate_tokens
+
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+chat_messages = sa.table(
+    'chat_messages',
+    sa.column('id', sa.String()),
+    sa.column('content', sa.Text()),
+    sa.column('token_count', sa.Integer()),
+)
+
+
+def _has_column(table: str, column: str) -> bool:
+    # 引入迁移之前由 create_all 建出的数据库可能已有此列（离线生成SQL时按不存在处理）
+    return not context.is_offline_mode() and column in {item["name"] for item in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    session_columns = [
+        sa.Column('summary', sa.Text(), nullable=True),
+        sa.Column('summary_cursor', sa.String(length=200), nullable=True),
+        sa.Column('summary_tokens', sa.Integer(), nullable=False, server_default='0'),
+    ]
+    session_columns = [column for column in session_columns if not _has_column('chat_sessions', column.name)]
+    if session_columns:
+        with op.batch_alter_table('chat_sessions') as batch_op:
+            for column in session_columns:
+                batch_op.add_column(column)
+    if not _has_column('chat_messages', 'token_count'):
+        with op.batch_alter_table('chat_messages') as batch_op:
+            batch_op.add_column(sa.Column('token_count', sa.Integer(), nullable=True))
+
+    # token估算规则在Python中定义，逐条计算后分批更新（离线生成SQL时无法读取数据，跳过回填；
+    # 未回填的消息在组装上下文时现场估算）
+    if not context.is_offline_mode():
+        connection = op.get_bind()
+        rows = connection.execute(sa.select(chat_messages.c.id, chat_messages.c.content)).all()
+        update = chat_messages.update().where(chat_messages.c.id == sa.bindparam('message_id')).values(token_count=sa.bindparam('tokens'))
+        for offset in range(0, len(rows), 500):
+            connection.execute(update, [
+                {"message_id": message_id, "tokens": estimate_tokens(content)}
+                for message_id, content in rows[offset:offset + 500]
+            ])
+
+
+def downgrade():
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.drop_column('token_count')
+    with op.batch_alter_table('chat_sessions') as batch_op:
+        batch_op.drop_column('summary_tokens')
+        batch_op.drop_column('summary_cursor')
+        batch_op.drop_column('summary')
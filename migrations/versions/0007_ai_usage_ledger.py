@@ -0,0 +1,65 @@
+"""AI调用用量流水与按天汇总
+
+新增 ai_usage_records（每次上游请求一行）与 ai_usage_daily_rollups（用户/天/模型/调用来源）
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def _has_table(name: str) -> bool:
+    # 引入迁移之前由 create_all 建出的数据库可能已有此表（离线生成SQL时按不存在处理）
+    return not context.is_offline_mode() and sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not _has_table('ai_usage_records'):
+        op.create_table('ai_usage_records',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('user_id', sa.String(), nullable=True),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('provider', sa.String(length=20), nullable=False),
+        sa.Column('feature', sa.String(length=30), nullable=False),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=False),
+        sa.Column('completion_tokens', sa.Integer(), nullable=False),
+        sa.Column('total_tokens', sa.Integer(), nullable=False),
+        sa.Column('latency_ms', sa.Integer(), nullable=False),
+        sa.Column('success', sa.Boolean(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index('ix_ai_usage_records_user_created', 'ai_usage_records', ['user_id', 'created_at'], if_not_exists=True)
+    op.create_index('ix_ai_usage_records_created', 'ai_usage_records', ['created_at'], if_not_exists=True)
+    if not _has_table('ai_usage_daily_rollups'):
+        op.create_table('ai_usage_daily_rollups',
+        sa.Column('user_id', sa.String(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('feature', sa.String(length=30), nullable=False),
+        sa.Column('requests', sa.Integer(), nullable=False),
+        sa.Column('errors', sa.Integer(), nullable=False),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=False),
+        sa.Column('completion_tokens', sa.Integer(), nullable=False),
+        sa.Column('total_tokens', sa.Integer(), nullable=False),
+        sa.Column('latency_ms', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('user_id', 'day', 'model', 'feature')
+        )
+    op.create_index('ix_ai_usage_rollups_day', 'ai_usage_daily_rollups', ['day'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_ai_usage_rollups_day', table_name='ai_usage_daily_rollups')
+    op.drop_table('ai_usage_daily_rollups')
+    op.drop_index('ix_ai_usage_records_created', table_name='ai_usage_records')
+    op.drop_index('ix_ai_usage_records_user_created', table_name='ai_usage_records')
+    op.drop_table('ai_usage_records')
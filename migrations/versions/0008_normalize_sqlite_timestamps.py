@@ -0,0 +1,46 @@
+"""统一SQLite中的时间格式
+
+- 旧的数据库默认值 CURRENT_TIMESTAMP 以 "YYYY-MM-DD HH:MM:SS" 保存，SQLAlchemy写入的时间带6位微秒；
+  把不带微秒的值补齐为同一格式，游标分页可以直接比较原始列，使用 (所属, 时间, ID) 复合索引
+- 模型的时间默认值同时改为在Python中取UTC时间，之后写入的数据都带微秒
+- 其他数据库以原生时间类型保存，无需处理
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+# 曾使用 CURRENT_TIMESTAMP 默认值的列
+TIMESTAMP_COLUMNS = [
+    ("users", "created_at"),
+    ("categories", "created_at"),
+    ("folders", "created_at"),
+    ("notes", "created_at"),
+    ("notes", "updated_at"),
+    ("tags", "created_at"),
+    ("tasks", "created_at"),
+    ("tasks", "updated_at"),
+    ("chat_sessions", "created_at"),
+    ("chat_messages", "created_at"),
+    ("pomodoro_logs", "completed_at"),
+]
+
+
+def upgrade():
+    if op.get_context().dialect.name != "sqlite":
+        return
+    for table, column in TIMESTAMP_COLUMNS:
+        op.execute(f"UPDATE {table} SET {column} = {column} || '.000000' WHERE length({column}) = 19")
+
+
+def downgrade():
+    # 补齐的微秒全为0，保留统一后的格式不影响旧版本读取
+    pass
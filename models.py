@@ -1,22 +1,30 @@
-from sqlalchemy import Column, String, Text, DateTime, Integer, Enum, ForeignKey, JSON, Table, Boolean
+from sqlalchemy import Column, String, Text, Date, DateTime, Integer, Enum, ForeignKey, JSON, Table, Boolean, Index, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from datetime import datetime, timedelta
+from typing import Optional
 import uuid
 import enum
 
+from tokenizer import estimate_tokens
+
 Base = declarative_base()
 
 # 生成UUID的辅助函数
 def generate_uuid():
     return str(uuid.uuid4())
 
+# 时间戳默认值在Python中取UTC时间（与各处显式写入的 datetime.utcnow() 一致）：
+# SQLite按文本保存时间，数据库的 CURRENT_TIMESTAMP 不带微秒，两种格式混存时无法直接按列比较和排序
+
 # 笔记标签关联表
 note_tags = Table(
     'note_tags',
     Base.metadata,
     Column('note_id', String, ForeignKey('notes.id'), primary_key=True),
-    Column('tag_id', String, ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', String, ForeignKey('tags.id'), primary_key=True),
+    # 主键以note_id开头，按标签反查笔记需要单独的索引
+    Index('ix_note_tags_tag', 'tag_id')
 )
 
 # 枚举类型定义
@@ -54,7 +62,7 @@ class User(Base):
         "theme": "default",
         "auto_cycle": False
     })
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     categories = relationship("Category", back_populates="user", cascade="all, delete-orphan")
@@ -62,6 +70,9 @@ class User(Base):
     tasks = relationship("Task", back_populates="user", cascade="all, delete-orphan")
     chat_sessions = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan")
     pomodoro_logs = relationship("PomodoroLog", back_populates="user", cascade="all, delete-orphan")
+    task_stat_counters = relationship("TaskStatCounter", cascade="all, delete-orphan")
+    pomodoro_daily_rollups = relationship("PomodoroDailyRollup", cascade="all, delete-orphan")
+    pomodoro_task_daily_rollups = relationship("PomodoroTaskDailyRollup", cascade="all, delete-orphan")
 
 # 分类模型
 class Category(Base):
@@ -70,12 +81,17 @@ class Category(Base):
     id = Column(String, primary_key=True, default=generate_uuid)
     name = Column(String(50), nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     user = relationship("User", back_populates="categories")
     folders = relationship("Folder", back_populates="category", cascade="all, delete-orphan")
     tasks = relationship("Task", back_populates="category")
+    
+    # 索引：按用户列出分类、按名称匹配AI分类结果
+    __table_args__ = (
+        Index("ix_categories_user_name", "user_id", "name"),
+    )
 
 # 文件夹模型
 class Folder(Base):
@@ -85,12 +101,18 @@ class Folder(Base):
     name = Column(String(100), nullable=False)
     category_id = Column(String, ForeignKey("categories.id"), nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     category = relationship("Category", back_populates="folders")
     user = relationship("User")
     notes = relationship("Note", back_populates="folder", cascade="all, delete-orphan")
+    
+    # 索引：笔记树按分类连接文件夹、同分类下查重名；按用户列出文件夹
+    __table_args__ = (
+        Index("ix_folders_category_name", "category_id", "name"),
+        Index("ix_folders_user", "user_id"),
+    )
 
 # 笔记模型
 class Note(Base):
@@ -101,13 +123,19 @@ class Note(Base):
     content = Column(Text)
     folder_id = Column(String, ForeignKey("folders.id"), nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=func.now())
-    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # 关系
     folder = relationship("Folder", back_populates="notes")
     user = relationship("User", back_populates="notes")
     tags = relationship("Tag", secondary=note_tags, back_populates="notes")
+    
+    # 索引：游标分页 (user_id, created_at, id)；按文件夹列出笔记
+    __table_args__ = (
+        Index("ix_notes_user_created", "user_id", "created_at", "id"),
+        Index("ix_notes_folder", "folder_id"),
+    )
 
 # 标签模型
 class Tag(Base):
@@ -116,11 +144,16 @@ class Tag(Base):
     id = Column(String, primary_key=True, default=generate_uuid)
     name = Column(String(50), nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     user = relationship("User")
     notes = relationship("Note", secondary=note_tags, back_populates="tags")
+    
+    # 索引：按用户列出标签、按名称查找已有标签
+    __table_args__ = (
+        Index("ix_tags_user_name", "user_id", "name"),
+    )
 
 # 任务模型
 class Task(Base):
@@ -136,13 +169,59 @@ class Task(Base):
     category_id = Column(String, ForeignKey("categories.id"))
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     reminder_minutes_before = Column(Integer, default=0)
-    created_at = Column(DateTime, default=func.now())
-    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    # 时间跨度分级（见 task_span_level），日历按级别限定开始时间的回溯范围；没有开始时间的任务为空
+    span_level = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # 关系
     category = relationship("Category", back_populates="tasks")
     user = relationship("User", back_populates="tasks")
     pomodoro_logs = relationship("PomodoroLog", back_populates="task")
+    
+    # 索引：游标分页 (user_id, created_at, id)；按状态筛选及逾期统计；日期范围筛选；按分类筛选；
+    # 日历区间查询 (user_id, span_level, start_time, end_time)
+    __table_args__ = (
+        Index("ix_tasks_user_created", "user_id", "created_at", "id"),
+        Index("ix_tasks_user_status_end", "user_id", "status", "end_time", "category_id"),
+        Index("ix_tasks_user_start", "user_id", "start_time"),
+        Index("ix_tasks_user_category", "user_id", "category_id"),
+        Index("ix_tasks_user_span_start", "user_id", "span_level", "start_time", "end_time"),
+    )
+
+# 任务时间跨度分级的上限：跨度不超过1天/7天/31天/366天分别为0~3级，更长的为最后一级（不设上限）
+TASK_SPAN_BOUNDS = [timedelta(days=1), timedelta(days=7), timedelta(days=31), timedelta(days=366)]
+TASK_SPAN_UNBOUNDED = len(TASK_SPAN_BOUNDS)
+
+def task_span_level(start_time: Optional[datetime], end_time: Optional[datetime]) -> Optional[int]:
+    """
+    由开始/结束时间推导跨度级别。没有结束时间（或结束早于开始）的任务按开始时刻的单点处理，为0级
+
+    同一级别内任务跨度有上限，查询与 [ws, we] 重叠的任务时只需扫描
+    start_time 在 [ws - 上限, we] 内的索引区间，而不是该用户的全部历史任务
+    """
+    if start_time is None:
+        return None
+    span = end_time - start_time if end_time is not None else timedelta(0)
+    for level, bound in enumerate(TASK_SPAN_BOUNDS):
+        if span <= bound:
+            return level
+    return TASK_SPAN_UNBOUNDED
+
+@event.listens_for(Task, "before_insert")
+@event.listens_for(Task, "before_update")
+def _set_task_span_level(mapper, connection, task):
+    task.span_level = task_span_level(task.start_time, task.end_time)
+
+# 任务统计计数模型：按 (用户, 状态, 优先级, 分类) 维护任务数，由任务写入路径增量更新
+class TaskStatCounter(Base):
+    __tablename__ = "task_stat_counters"
+    
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    status = Column(String(10), primary_key=True)
+    priority = Column(String(10), primary_key=True)
+    category_id = Column(String, primary_key=True, default="")  # 空字符串表示未分类
+    count = Column(Integer, nullable=False, default=0)
 
 # 对话会话模型
 class ChatSession(Base):
@@ -151,11 +230,20 @@ class ChatSession(Base):
     id = Column(String, primary_key=True, default=generate_uuid)
     title = Column(String(200), nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # 滚动摘要：较早的对话压缩成摘要，summary_cursor 为已摘要的最后一条消息的分页游标
+    summary = Column(Text, nullable=True)
+    summary_cursor = Column(String(200), nullable=True)
+    summary_tokens = Column(Integer, nullable=False, default=0, server_default="0")
     
     # 关系
     user = relationship("User", back_populates="chat_sessions")
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    
+    # 索引：游标分页 (user_id, created_at, id)
+    __table_args__ = (
+        Index("ix_chat_sessions_user_created", "user_id", "created_at", "id"),
+    )
 
 # 对话消息模型
 class ChatMessage(Base):
@@ -165,10 +253,21 @@ class ChatMessage(Base):
     session_id = Column(String, ForeignKey("chat_sessions.id"), nullable=False)
     role = Column(Enum(RoleEnum), nullable=False)
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    token_count = Column(Integer, nullable=True)  # 估算的token数，写入时计算
+    created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     session = relationship("ChatSession", back_populates="messages")
+    
+    # 索引：会话消息游标分页 (session_id, created_at, id)
+    __table_args__ = (
+        Index("ix_chat_messages_session_created", "session_id", "created_at", "id"),
+    )
+
+@event.listens_for(ChatMessage, "before_insert")
+@event.listens_for(ChatMessage, "before_update")
+def _set_message_token_count(mapper, connection, message):
+    message.token_count = estimate_tokens(message.content)
 
 # 番茄钟记录模型
 class PomodoroLog(Base):
@@ -178,9 +277,79 @@ class PomodoroLog(Base):
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     task_id = Column(String, ForeignKey("tasks.id"), nullable=True)
     duration = Column(Integer, nullable=False)  # 分钟
-    completed_at = Column(DateTime, default=func.now())
+    completed_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     user = relationship("User", back_populates="pomodoro_logs")
     task = relationship("Task", back_populates="pomodoro_logs")
+    
+    # 索引：游标分页及按日期统计 (user_id, completed_at, id)；单个任务的番茄钟统计
+    __table_args__ = (
+        Index("ix_pomodoro_logs_user_completed", "user_id", "completed_at", "id"),
+        Index("ix_pomodoro_logs_task_completed", "task_id", "completed_at"),
+    )
+
+# 番茄钟按天汇总：每个用户每天的完成次数与分钟数，由记录的写入/删除增量维护
+class PomodoroDailyRollup(Base):
+    __tablename__ = "pomodoro_daily_rollups"
+    
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)
+
+# 番茄钟按任务按天汇总（不含未关联任务的记录）
+class PomodoroTaskDailyRollup(Base):
+    __tablename__ = "pomodoro_task_daily_rollups"
+    
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    task_id = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)
+    
+    # 主键 (user_id, day, task_id) 服务按天查询；索引服务单个任务的统计
+    __table_args__ = (
+        Index("ix_pomodoro_task_rollups_task_day", "task_id", "day"),
+    )
 
+# AI调用流水：每次上游请求一行（token用量、延迟、结果），由 usage_ledger 在后台批量写入
+class AIUsageRecord(Base):
+    __tablename__ = "ai_usage_records"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    user_id = Column(String, nullable=True)  # 为空表示内部调用（如对话摘要）
+    model = Column(String(100), nullable=False)
+    provider = Column(String(20), nullable=False)
+    feature = Column(String(30), nullable=False)  # 调用来源：chat、polish、categorize、parse_task等
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    total_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)
+    success = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_ai_usage_records_user_created", "user_id", "created_at"),
+        Index("ix_ai_usage_records_created", "created_at"),
+    )
+
+# AI用量按天汇总：每个用户每天每个模型、每种调用来源的请求数、token数与延迟，随流水一起写入
+class AIUsageDailyRollup(Base):
+    __tablename__ = "ai_usage_daily_rollups"
+    
+    user_id = Column(String, primary_key=True, default="")  # 空字符串表示内部调用
+    day = Column(Date, primary_key=True)
+    model = Column(String(100), primary_key=True)
+    feature = Column(String(30), primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    total_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)  # 延迟总和，除以请求数得平均值
+    
+    # 主键 (user_id, day, ...) 服务单个用户按天查询；索引服务全体用户按天汇总
+    __table_args__ = (
+        Index("ix_ai_usage_rollups_day", "day"),
+    )
@@ -0,0 +1,425 @@
+import asyncio
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import Note, note_tags
+from tokenizer import tokenize
+
+# 本地笔记分类：按用户在内存中训练多项式朴素贝叶斯（中文单字+二元组），以用户已有笔记所在的文件夹和标签为标注，
+# 推荐新笔记的分类、文件夹和标签；置信度足够高时 /api/ai/analyze-note 直接返回，不调用模型
+# 本地直接返回的推荐要达到的准确率：训练时在用户自己的笔记上留一法校准置信度门槛
+NOTE_CLASSIFIER_PRECISION = float(os.getenv("NOTE_CLASSIFIER_PRECISION", "0.95"))
+CALIBRATION_SAMPLES = 400
+MIN_CALIBRATED_HITS = 10  # 门槛以上至少要有这么多条抽样预测，否则样本太少不可信
+RECALIBRATE_GROWTH = 1.25  # 增量训练使笔记数比上次校准时增长25%后重新校准
+# 笔记太少时分类不可靠，一律交给模型
+NOTE_CLASSIFIER_MIN_NOTES = int(os.getenv("NOTE_CLASSIFIER_MIN_NOTES", "20"))
+NOTE_CLASSIFIER_MAX_USERS = int(os.getenv("NOTE_CLASSIFIER_MAX_USERS", "100"))
+# 模型的最长使用时间（秒）：多进程部署时其他进程的写入不会通知到本进程，过期后重新训练
+NOTE_CLASSIFIER_TTL = float(os.getenv("NOTE_CLASSIFIER_TTL", "300"))
+SMOOTHING = 0.1  # Lidstone加性平滑
+TITLE_WEIGHT = 3  # 标题中的词按出现3次计
+MAX_CONTENT_CHARS = 2000
+# 朴素贝叶斯把重叠的单字和二元组当作独立证据，长文本的后验概率会趋近1；
+# 证据按每 EVIDENCE_TOKENS 个词折算一份，留出置信度的区分度供校准使用
+EVIDENCE_TOKENS = 10
+MIN_FOLDER_NOTES = 3  # 推荐的文件夹至少已有这么多篇笔记
+TAG_MIN_PROBABILITY = 0.25
+MAX_SUGGESTED_TAGS = 3
+
+PENDING_CHANGES_KEY = "note_classifier_changes"
+
+
+class Suggestion(NamedTuple):
+    folder_id: str
+    category_id: str
+    tag_ids: List[str]
+    confidence: float  # 推荐文件夹的后验概率
+
+
+class _NaiveBayes:
+    """
+    一组类别上的多项式朴素贝叶斯
+
+    词频计数存放在二维数组（词 × 类别）中，按需成倍扩容；训练与撤销训练都是对相应行列的加减，
+    笔记的修改和删除可以增量更新
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, int] = {}
+        self.labels: List[str] = []
+        self.counts = np.zeros((1024, 8), dtype=np.float32)
+        self.totals = np.zeros(8, dtype=np.float64)
+        self.documents = np.zeros(8, dtype=np.float64)
+
+    def copy(self) -> "_NaiveBayes":
+        clone = _NaiveBayes()
+        clone.columns = dict(self.columns)
+        clone.labels = list(self.labels)
+        clone.counts = self.counts.copy()
+        clone.totals = self.totals.copy()
+        clone.documents = self.documents.copy()
+        return clone
+
+    def _column(self, label: str) -> int:
+        column = self.columns.get(label)
+        if column is None:
+            column = self.columns[label] = len(self.labels)
+            self.labels.append(label)
+            if column >= self.counts.shape[1]:
+                self.counts = np.pad(self.counts, ((0, 0), (0, self.counts.shape[1])))
+                self.totals = np.pad(self.totals, (0, self.totals.size))
+                self.documents = np.pad(self.documents, (0, self.documents.size))
+        return column
+
+    def reserve(self, terms: int):
+        if terms > self.counts.shape[0]:
+            self.counts = np.pad(self.counts, ((0, max(terms, 2 * self.counts.shape[0]) - self.counts.shape[0]), (0, 0)))
+
+    def train(self, term_ids: np.ndarray, weights: np.ndarray, labels: Iterable[str], sign: int = 1):
+        # 同一篇笔记的词ID不重复，可直接按下标累加
+        for label in labels:
+            column = self._column(label)
+            self.counts[term_ids, column] += sign * weights
+            self.totals[column] += sign * float(weights.sum())
+            self.documents[column] += sign
+
+    def posterior(self, term_ids: np.ndarray, weights: np.ndarray, vocabulary: int, exclude: Optional[Tuple[np.ndarray, np.ndarray, Iterable[str]]] = None) -> np.ndarray:
+        """
+        各类别的后验概率（与 labels 对齐）；exclude 为 (词ID, 权重, 标注)，
+        计算时扣除这篇笔记自身的训练数据（对已有笔记重新归档时使用）
+        """
+        size = len(self.labels)
+        counts = self.counts[term_ids, :size].astype(np.float64)
+        totals = self.totals[:size].copy()
+        documents = self.documents[:size].copy()
+        if exclude is not None:
+            excluded_ids, excluded_weights, excluded_labels = exclude
+            positions = {term_id: position for position, term_id in enumerate(term_ids.tolist())}
+            for label in excluded_labels:
+                column = self.columns.get(label)
+                if column is None:
+                    continue
+                for term_id, weight in zip(excluded_ids.tolist(), excluded_weights.tolist()):
+                    position = positions.get(term_id)
+                    if position is not None:
+                        counts[position, column] -= weight
+                totals[column] -= float(excluded_weights.sum())
+                documents[column] -= 1
+
+        alive = documents > 0
+        if not alive.any():
+            return np.zeros(size)
+        log_prior = np.log(np.where(alive, documents, 1) / documents[alive].sum())
+        log_likelihood = weights @ np.log((np.maximum(counts, 0) + SMOOTHING) / (np.maximum(totals, 0) + SMOOTHING * vocabulary))
+        scores = log_prior + log_likelihood / max(1.0, float(weights.sum()) / EVIDENCE_TOKENS)
+        scores[~alive] = -np.inf
+        scores = np.exp(scores - scores.max())
+        return scores / scores.sum()
+
+
+class UserModel:
+    """单个用户的分类模型：文件夹（单标签）和标签（多标签，同样用各标签的词分布打分）两个朴素贝叶斯"""
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.folders = _NaiveBayes()
+        self.tags = _NaiveBayes()
+        # 笔记ID → (文件夹ID, 标签ID, 词ID, 权重)，修改或删除时撤销原来的训练数据
+        self.notes: Dict[str, Tuple[str, Tuple[str, ...], np.ndarray, np.ndarray]] = {}
+        self.threshold = float("inf")  # 校准前不在本地返回
+        self.calibrated_notes = 0
+        self.created = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.notes)
+
+    def needs_calibration(self) -> bool:
+        """增量训练使笔记数比上次校准时明显增长后需要重新校准"""
+        return len(self.notes) >= max(NOTE_CLASSIFIER_MIN_NOTES, self.calibrated_notes * RECALIBRATE_GROWTH)
+
+    def snapshot(self) -> "UserModel":
+        """
+        校准用的副本：词表、文件夹模型和笔记表各复制一份，在线程中校准副本时原模型可以继续增量更新
+        （笔记的词向量不会被原地修改，直接共享；校准不使用标签模型）
+        """
+        clone = UserModel()
+        clone.vocabulary = dict(self.vocabulary)
+        clone.folders = self.folders.copy()
+        clone.notes = dict(self.notes)
+        clone.calibrated_notes = self.calibrated_notes
+        return clone
+
+    def vectorize(self, title: str, content: str, grow: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """标题和正文开头的词频向量；grow 为假时忽略训练中没出现过的词"""
+        weights = Counter(tokenize((content or "")[:MAX_CONTENT_CHARS]))
+        for term in tokenize(title or ""):
+            weights[term] += TITLE_WEIGHT
+        term_ids, values = [], []
+        for term, weight in weights.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                if not grow:
+                    continue
+                term_id = self.vocabulary[term] = len(self.vocabulary)
+            term_ids.append(term_id)
+            values.append(weight)
+        if grow:
+            self.folders.reserve(len(self.vocabulary))
+            self.tags.reserve(len(self.vocabulary))
+        return np.array(term_ids, dtype=np.int64), np.array(values, dtype=np.float32)
+
+    def upsert(self, note_id: str, folder_id: str, tag_ids: Iterable[str], title: str, content: str):
+        self.remove(note_id)
+        term_ids, weights = self.vectorize(title, content, grow=True)
+        tag_ids = tuple(tag_ids)
+        self.folders.train(term_ids, weights, [folder_id])
+        self.tags.train(term_ids, weights, tag_ids)
+        self.notes[note_id] = (folder_id, tag_ids, term_ids, weights)
+
+    def remove(self, note_id: str) -> bool:
+        previous = self.notes.pop(note_id, None)
+        if previous is None:
+            return False
+        folder_id, tag_ids, term_ids, weights = previous
+        self.folders.train(term_ids, weights, [folder_id], sign=-1)
+        self.tags.train(term_ids, weights, tag_ids, sign=-1)
+        return True
+
+    def _folder_posterior(self, term_ids: np.ndarray, weights: np.ndarray, excluded: Optional[tuple]) -> Tuple[np.ndarray, np.ndarray]:
+        """各文件夹的后验概率和（扣除excluded笔记后的）笔记数"""
+        folder_exclude = (excluded[2], excluded[3], [excluded[0]]) if excluded else None
+        probabilities = self.folders.posterior(term_ids, weights, len(self.vocabulary), folder_exclude)
+        documents = self.folders.documents[:len(probabilities)].copy()
+        if excluded:
+            documents[self.folders.columns[excluded[0]]] -= 1
+        return probabilities, documents
+
+    def calibrate(self, precision: float = NOTE_CLASSIFIER_PRECISION, samples: int = CALIBRATION_SAMPLES) -> float:
+        """
+        校准置信度门槛：抽样已有笔记，不使用其自身的训练数据预测文件夹（留一法），
+        取使置信度不低于门槛的预测准确率达到precision的最低门槛；达不到时门槛为无穷大，一律交给模型
+        """
+        self.threshold = float("inf")
+        self.calibrated_notes = len(self.notes)
+        if len(self.notes) < NOTE_CLASSIFIER_MIN_NOTES:
+            return self.threshold
+        note_ids = list(self.notes)
+        predictions = []
+        for note_id in note_ids[::max(1, len(note_ids) // samples)][:samples]:
+            excluded = self.notes[note_id]
+            probabilities, _ = self._folder_posterior(excluded[2], excluded[3], excluded)
+            if not probabilities.any():
+                continue
+            best = int(np.argmax(probabilities))
+            predictions.append((float(probabilities[best]), self.folders.labels[best] == excluded[0]))
+
+        predictions.sort(reverse=True)
+        correct = 0
+        for count, (confidence, hit) in enumerate(predictions, start=1):
+            correct += hit
+            if count >= MIN_CALIBRATED_HITS and correct >= precision * count:
+                self.threshold = confidence
+        return self.threshold
+
+    def suggest(self, title: str, content: str, folder_categories: Dict[str, str], tag_ids: Iterable[str] = (), exclude: Optional[str] = None) -> Optional[Suggestion]:
+        """
+        推荐文件夹（及其分类）和标签；folder_categories 为用户现有的文件夹ID → 分类ID，
+        tag_ids 为现有的标签ID，已删除的文件夹和标签不会被推荐。exclude 为已有笔记的ID，
+        对这篇笔记重新归档时不使用它自身的训练数据
+        """
+        excluded = self.notes.get(exclude) if exclude else None
+        if len(self.notes) - (excluded is not None) < NOTE_CLASSIFIER_MIN_NOTES:
+            return None
+        term_ids, weights = self.vectorize(title, content)
+        if not term_ids.size:
+            return None
+
+        probabilities, documents = self._folder_posterior(term_ids, weights, excluded)
+        best = None
+        for column in np.argsort(-probabilities):
+            if self.folders.labels[column] in folder_categories:
+                best = column
+                break
+        if best is None or documents[best] < MIN_FOLDER_NOTES:
+            return None
+        folder_id = self.folders.labels[best]
+
+        suggested_tags = []
+        if self.tags.labels:
+            existing = set(tag_ids)
+            tag_exclude = (excluded[2], excluded[3], excluded[1]) if excluded else None
+            tag_probabilities = self.tags.posterior(term_ids, weights, len(self.vocabulary), tag_exclude)
+            for column in np.argsort(-tag_probabilities)[:MAX_SUGGESTED_TAGS]:
+                if tag_probabilities[column] < TAG_MIN_PROBABILITY:
+                    break
+                if self.tags.labels[column] in existing:
+                    suggested_tags.append(self.tags.labels[column])
+        return Suggestion(folder_id, folder_categories[folder_id], suggested_tags, float(probabilities[best]))
+
+
+class NoteClassifier:
+    """
+    按用户缓存分类模型（LRU），首次使用时用该用户的全部笔记训练
+
+    写入路径把笔记的变更登记在数据库会话上，事务提交后才增量更新已加载的模型，回滚的修改不会进入模型
+    """
+
+    def __init__(self, max_users: int = NOTE_CLASSIFIER_MAX_USERS, ttl: float = NOTE_CLASSIFIER_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._models: "OrderedDict[str, UserModel]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.RLock()
+        self.local_hits = 0
+        self.escalations = 0
+
+    def _cached(self, user_id: str) -> Tuple[Optional[UserModel], int]:
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is not None and time.monotonic() - model.created < self.ttl:
+                self._models.move_to_end(user_id)
+                return model, self._generation
+            return None, self._generation
+
+    def _store(self, user_id: str, model: UserModel, generation: int):
+        with self._lock:
+            # 训练期间有提交的写入时只用于本次请求，不缓存
+            if generation == self._generation:
+                self._models[user_id] = model
+                self._models.move_to_end(user_id)
+                while len(self._models) > self.max_users:
+                    self._models.popitem(last=False)
+
+    @staticmethod
+    def _load(db: Session, user_id: str):
+        notes = db.execute(select(Note.id, Note.title, Note.content, Note.folder_id).where(Note.user_id == user_id)).all()
+        note_tag_rows = db.execute(
+            select(note_tags.c.note_id, note_tags.c.tag_id).join(Note, Note.id == note_tags.c.note_id).where(Note.user_id == user_id)
+        ).all()
+        return notes, note_tag_rows
+
+    @staticmethod
+    def _build(notes, note_tag_rows) -> UserModel:
+        tags_by_note: Dict[str, List[str]] = {}
+        for note_id, tag_id in note_tag_rows:
+            tags_by_note.setdefault(note_id, []).append(tag_id)
+        model = UserModel()
+        for note_id, title, content, folder_id in notes:
+            model.upsert(note_id, folder_id, tags_by_note.get(note_id, ()), title, content)
+        model.calibrate()
+        return model
+
+    def ensure(self, db: Session, user_id: str) -> UserModel:
+        """获取用户的模型，未加载或已过期时从数据库训练"""
+        model, generation = self._cached(user_id)
+        if model is None:
+            model = self._build(*self._load(db, user_id))
+            self._store(user_id, model, generation)
+        return model
+
+    async def ensure_async(self, db: Session, user_id: str) -> UserModel:
+        """异步路由使用：读取笔记后在线程中分词、训练和校准，不阻塞事件循环"""
+        model, generation = self._cached(user_id)
+        if model is None:
+            notes, note_tag_rows = self._load(db, user_id)
+            model = await asyncio.to_thread(self._build, notes, note_tag_rows)
+            self._store(user_id, model, generation)
+        return model
+
+    def _suggest(self, model: UserModel, title: str, content: str, folder_categories: Dict[str, str], tag_ids: Iterable[str], exclude: Optional[str]) -> Optional[Suggestion]:
+        with self._lock:
+            suggestion = model.suggest(title, content, folder_categories, tag_ids, exclude)
+            if suggestion is None or suggestion.confidence < model.threshold:
+                self.escalations += 1
+                return None
+            self.local_hits += 1
+        return suggestion
+
+    def suggest(self, model: UserModel, title: str, content: str, folder_categories: Dict[str, str], tag_ids: Iterable[str] = (), exclude: Optional[str] = None) -> Optional[Suggestion]:
+        """置信度达到该用户校准的门槛时返回推荐，否则返回None（由模型处理）"""
+        with self._lock:
+            if model.needs_calibration():
+                model.calibrate()
+        return self._suggest(model, title, content, folder_categories, tag_ids, exclude)
+
+    async def suggest_async(self, model: UserModel, notes: List[Tuple[str, str, Optional[str]]], folder_categories: Dict[str, str], tag_ids: Iterable[str] = ()) -> List[Optional[Suggestion]]:
+        """
+        异步路由使用：notes 为 [(标题, 正文, 排除的笔记ID)]，按顺序返回各自的推荐或None；
+        需要重新校准时在线程中校准模型副本（不持有锁，期间模型照常增量更新），推荐也在线程中计算
+        """
+        with self._lock:
+            snapshot = model.snapshot() if model.needs_calibration() else None
+            if snapshot is not None:
+                # 先记下本次校准的笔记数，并发请求不会重复校准
+                model.calibrated_notes = len(model)
+        if snapshot is not None:
+            model.threshold = await asyncio.to_thread(snapshot.calibrate)
+        tag_ids = list(tag_ids)
+        return await asyncio.to_thread(
+            lambda: [self._suggest(model, title, content, folder_categories, tag_ids, exclude) for title, content, exclude in notes]
+        )
+
+    def apply(self, changes: List[tuple]):
+        with self._lock:
+            self._generation += 1
+            for change in changes:
+                if change[0] == "upsert":
+                    _, user_id, note_id, folder_id, tag_ids, title, content = change
+                    model = self._models.get(user_id)
+                    if model is not None:
+                        model.upsert(note_id, folder_id, tag_ids, title, content)
+                elif change[0] == "remove":
+                    for model in self._models.values():
+                        if model.remove(change[1]):
+                            break
+                else:
+                    self.invalidate(change[1])
+
+    def invalidate(self, user_id: Optional[str] = None):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._models.clear()
+            else:
+                self._models.pop(user_id, None)
+
+
+note_classifier = NoteClassifier()
+
+
+def _pending(db: Session) -> list:
+    return db.info.setdefault(PENDING_CHANGES_KEY, [])
+
+
+def queue_note(db: Session, note: Note):
+    """登记笔记的新增或修改（含所在文件夹和标签），提交后训练进已加载的模型"""
+    _pending(db).append(("upsert", note.user_id, note.id, note.folder_id, [tag.id for tag in note.tags], note.title or "", note.content or ""))
+
+
+def queue_note_removal(db: Session, note_id: str):
+    _pending(db).append(("remove", note_id))
+
+
+def queue_retrain(db: Session, user_id: Optional[str] = None):
+    """提交后丢弃已加载的模型（指定用户或全部用户），下次使用时重新训练"""
+    _pending(db).append(("invalidate", user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending_changes(session, *args):
+    changes = session.info.pop(PENDING_CHANGES_KEY, None)
+    if changes:
+        note_classifier.apply(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_changes(session, *args):
+    session.info.pop(PENDING_CHANGES_KEY, None)
@@ -1,133 +1,198 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session, joinedload
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from typing import List, Optional
 
-from database import get_db
+from database import get_async_db
 from models import User, Note, Folder, Category, Tag
 from schemas import Note as NoteSchema, NoteCreate, NoteUpdate, NoteTreeItem
-from auth import get_current_user, create_default_categories_and_folders
+from auth import get_current_user_async, create_default_categories_and_folders
+from tree_cache import notes_tree_cache, etag_matches
+from search import index_note, remove_document
+from pagination import keyset_paginate, finish_page
+from retrieval import retrieval_index
+from tokenizer import truncate_to_tokens
 
 router = APIRouter()
 
-@router.get("/tree", response_model=List[NoteTreeItem])
-def get_notes_tree(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取笔记的树状结构"""
-    categories = db.query(Category).filter(Category.user_id == current_user.id).all()
+# 相关笔记返回的正文摘录长度（token）
+RELATED_SNIPPET_TOKENS = 60
+
+def build_notes_tree(db: Session, user_id: str) -> List[dict]:
+    """构建用户的笔记树：两次集合查询（分类+文件夹、笔记标题），内存中单次组装"""
+    # 分类与文件夹一次取出，只选择树需要的列
+    rows = db.query(Category.id, Category.name, Folder.id, Folder.name).outerjoin(
+        Folder, Folder.category_id == Category.id
+    ).filter(Category.user_id == user_id).all()
     
     tree = []
-    for category in categories:
-        category_item = NoteTreeItem(
-            id=category.id,
-            name=category.name,
-            type="category",
-            children=[]
-        )
-        
-        folders = db.query(Folder).filter(Folder.category_id == category.id).all()
-        for folder in folders:
-            folder_item = NoteTreeItem(
-                id=folder.id,
-                name=folder.name,
-                type="folder",
-                children=[]
-            )
-            
-            notes = db.query(Note).filter(Note.folder_id == folder.id).all()
-            for note in notes:
-                note_item = NoteTreeItem(
-                    id=note.id,
-                    name=note.title,
-                    type="note",
-                    children=[]
-                )
-                folder_item.children.append(note_item)
-            
-            category_item.children.append(folder_item)
-        
-        tree.append(category_item)
+    category_items = {}
+    folder_items = {}
+    for category_id, category_name, folder_id, folder_name in rows:
+        category_item = category_items.get(category_id)
+        if category_item is None:
+            category_item = {"id": category_id, "name": category_name, "type": "category", "children": []}
+            category_items[category_id] = category_item
+            tree.append(category_item)
+        if folder_id is not None:
+            folder_item = {"id": folder_id, "name": folder_name, "type": "folder", "children": []}
+            folder_items[folder_id] = folder_item
+            category_item["children"].append(folder_item)
+    
+    # 笔记只取标题，不加载content大字段
+    notes = db.query(Note.id, Note.title, Note.folder_id).filter(Note.user_id == user_id).all()
+    for note_id, title, folder_id in notes:
+        folder_item = folder_items.get(folder_id)
+        if folder_item is not None:
+            folder_item["children"].append({"id": note_id, "name": title, "type": "note", "children": []})
     
     return tree
 
+@router.get("/tree", response_model=List[NoteTreeItem])
+async def get_notes_tree(request: Request, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """获取笔记的树状结构（带ETag，未变化时返回304）"""
+    entry = notes_tree_cache.get(current_user.id)
+    if entry is None:
+        version = notes_tree_cache.version(current_user.id)
+        entry = notes_tree_cache.put(current_user.id, version, await db.run_sync(build_notes_tree, current_user.id))
+    
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+async def _load_note(db: AsyncSession, note_id: str, user_id: str) -> Optional[Note]:
+    """加载笔记及其标签（异步会话不能延迟加载关系，标签需要预先取出）"""
+    result = await db.execute(
+        select(Note).options(selectinload(Note.tags)).where(Note.id == note_id, Note.user_id == user_id)
+    )
+    return result.scalar_one_or_none()
+
+async def _folder_exists(db: AsyncSession, folder_id: str, user: User) -> bool:
+    folder = (await db.execute(select(Folder.id).where(Folder.id == folder_id, Folder.user_id == user.id))).first()
+    if not folder:
+        print(f"❌ 文件夹不存在 - 查找的文件夹ID: {folder_id}, 用户ID: {user.id}")
+        # 查看数据库中实际存在的文件夹
+        all_folders = (await db.execute(select(Folder.id, Folder.name).where(Folder.user_id == user.id))).all()
+        print(f"📁 用户的所有文件夹: {[(f.id, f.name) for f in all_folders]}")
+    return bool(folder)
+
+async def _user_tags(db: AsyncSession, tag_ids: List[str], user_id: str) -> List[Tag]:
+    return list((await db.execute(select(Tag).where(Tag.id.in_(tag_ids), Tag.user_id == user_id))).scalars())
+
 @router.get("/", response_model=List[NoteSchema])
-def get_notes(skip: int = 0, limit: int = 100, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取用户的所有笔记"""
-    notes = db.query(Note).options(joinedload(Note.tags)).filter(Note.user_id == current_user.id).offset(skip).limit(limit).all()
-    return notes
+async def get_notes(
+    response: Response,
+    skip: int = 0,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取用户的笔记（按创建时间倒序；下一页游标见响应头X-Next-Cursor，skip仅为兼容保留）"""
+    query = select(Note).options(selectinload(Note.tags)).where(Note.user_id == current_user.id)
+    query = keyset_paginate(query, Note.created_at, Note.id, cursor, limit)
+    if skip and not cursor:
+        query = query.offset(skip)
+    notes = list((await db.execute(query)).scalars())
+    return finish_page(notes, response, limit, "created_at")
 
 @router.get("/tags", response_model=List[dict])
-def get_tags(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_tags(current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """获取用户的所有标签"""
-    tags = db.query(Tag).filter(Tag.user_id == current_user.id).all()
+    tags = await db.execute(select(Tag.id, Tag.name).where(Tag.user_id == current_user.id))
     return [{"id": tag.id, "name": tag.name} for tag in tags]
 
 @router.get("/{note_id}", response_model=NoteSchema)
-def get_note(note_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_note(note_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """获取特定笔记"""
     print(f"🔍 获取笔记请求 - 笔记ID: {note_id}, 当前用户: {current_user.username}, 用户ID: {current_user.id}")
     
-    # 先查找笔记是否存在
-    note_exists = db.query(Note).filter(Note.id == note_id).first()
-    if not note_exists:
+    # 先查找笔记是否存在（连同标签一次取出）
+    note = (await db.execute(select(Note).options(selectinload(Note.tags)).where(Note.id == note_id))).scalar_one_or_none()
+    if not note:
         print(f"❌ 笔记不存在 - ID: {note_id}")
         raise HTTPException(status_code=404, detail="笔记不存在")
     
-    print(f"📝 找到笔记 - 标题: {note_exists.title}, 所有者ID: {note_exists.user_id}")
+    print(f"📝 找到笔记 - 标题: {note.title}, 所有者ID: {note.user_id}")
     
     # 检查权限
-    if note_exists.user_id != current_user.id:
-        print(f"🚫 权限不足 - 笔记所有者: {note_exists.user_id}, 当前用户: {current_user.id}")
+    if note.user_id != current_user.id:
+        print(f"🚫 权限不足 - 笔记所有者: {note.user_id}, 当前用户: {current_user.id}")
         raise HTTPException(status_code=403, detail="无权访问此笔记")
     
-    # 获取完整笔记信息
-    note = db.query(Note).options(joinedload(Note.tags)).filter(Note.id == note_id, Note.user_id == current_user.id).first()
     print(f"✅ 成功获取笔记 - 标题: {note.title}")
     return note
 
+@router.get("/{note_id}/related", response_model=List[dict])
+async def get_related_notes(
+    note_id: str,
+    limit: int = Query(5, ge=1, le=20),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """相关笔记：以该笔记的关键词在用户的本地检索索引中查找内容相近的笔记"""
+    exists = (await db.execute(select(Note.id).where(Note.id == note_id, Note.user_id == current_user.id))).first()
+    if not exists:
+        raise HTTPException(status_code=404, detail="笔记不存在")
+    
+    index = await retrieval_index.ensure_async(db, current_user.id)
+    hits = retrieval_index.related(index, "note", note_id, limit)
+    return [
+        {
+            "id": doc.doc_id,
+            "title": doc.title,
+            "folder_id": doc.parent_id,
+            "snippet": truncate_to_tokens(doc.body, RELATED_SNIPPET_TOKENS),
+            "score": round(score, 4)
+        }
+        for doc, score in hits
+    ]
+
 @router.post("/", response_model=NoteSchema)
-def create_note(note: NoteCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_note(note: NoteCreate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """创建笔记"""
     print(f"🔍 创建笔记请求 - 用户: {current_user.username}, 文件夹ID: {note.folder_id}")
     
     # 验证文件夹
-    folder = db.query(Folder).filter(Folder.id == note.folder_id, Folder.user_id == current_user.id).first()
-    if not folder:
-        print(f"❌ 文件夹不存在 - 查找的文件夹ID: {note.folder_id}, 用户ID: {current_user.id}")
-        # 查看数据库中实际存在的文件夹
-        all_folders = db.query(Folder).filter(Folder.user_id == current_user.id).all()
-        print(f"📁 用户的所有文件夹: {[(f.id, f.name) for f in all_folders]}")
+    if not await _folder_exists(db, note.folder_id, current_user):
         raise HTTPException(status_code=404, detail="文件夹不存在")
     
-    # 创建笔记
+    # 创建笔记（标签在加入会话前赋值，不需要加载原有集合）
     db_note = Note(
         title=note.title,
         content=note.content,
         folder_id=note.folder_id,
-        user_id=current_user.id
+        user_id=current_user.id,
+        tags=await _user_tags(db, note.tag_ids, current_user.id) if note.tag_ids else []
     )
     db.add(db_note)
-    db.commit()
-    db.refresh(db_note)
-    
-    # 添加标签
-    if note.tag_ids:
-        tags = db.query(Tag).filter(Tag.id.in_(note.tag_ids), Tag.user_id == current_user.id).all()
-        db_note.tags = tags
-        db.commit()
+    await db.flush()
+    await db.run_sync(index_note, db_note)
+    await db.commit()
     
-    return db_note
+    notes_tree_cache.invalidate(current_user.id)
+    return await _load_note(db, db_note.id, current_user.id)
 
 @router.put("/{note_id}", response_model=NoteSchema)
-def update_note(note_id: str, note_update: NoteUpdate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_note(note_id: str, note_update: NoteUpdate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """更新笔记"""
     print(f"🔍 更新笔记请求 - 笔记ID: {note_id}, 用户: {current_user.username}")
     print(f"📝 更新数据: folder_id={note_update.folder_id}, title={note_update.title is not None}")
     
-    db_note = db.query(Note).filter(Note.id == note_id, Note.user_id == current_user.id).first()
+    db_note = await _load_note(db, note_id, current_user.id)
     if not db_note:
         raise HTTPException(status_code=404, detail="笔记不存在")
     
     print(f"📄 当前笔记的文件夹ID: {db_note.folder_id}")
     
+    # 只有标题或文件夹变化才影响笔记树，单纯保存正文不使树缓存失效
+    tree_changed = (
+        (note_update.title is not None and note_update.title != db_note.title)
+        or (note_update.folder_id is not None and note_update.folder_id != db_note.folder_id)
+    )
+    
     # 更新字段
     if note_update.title is not None:
         db_note.title = note_update.title
@@ -136,82 +201,81 @@ def update_note(note_id: str, note_update: NoteUpdate, current_user: User = Depe
     if note_update.folder_id is not None and note_update.folder_id != db_note.folder_id:
         # 只有当文件夹ID确实改变时才验证
         print(f"🔄 文件夹ID发生变化: {db_note.folder_id} -> {note_update.folder_id}")
-        folder = db.query(Folder).filter(Folder.id == note_update.folder_id, Folder.user_id == current_user.id).first()
-        if not folder:
-            print(f"❌ 新文件夹不存在 - 查找的文件夹ID: {note_update.folder_id}, 用户ID: {current_user.id}")
-            # 查看数据库中实际存在的文件夹
-            all_folders = db.query(Folder).filter(Folder.user_id == current_user.id).all()
-            print(f"📁 用户的所有文件夹: {[(f.id, f.name) for f in all_folders]}")
+        if not await _folder_exists(db, note_update.folder_id, current_user):
             raise HTTPException(status_code=404, detail="文件夹不存在")
         db_note.folder_id = note_update.folder_id
     
     # 更新标签
     if note_update.tag_ids is not None:
-        tags = db.query(Tag).filter(Tag.id.in_(note_update.tag_ids), Tag.user_id == current_user.id).all()
-        db_note.tags = tags
+        db_note.tags = await _user_tags(db, note_update.tag_ids, current_user.id)
     
-    db.commit()
-    db.refresh(db_note)
+    await db.run_sync(index_note, db_note)
+    await db.commit()
+    # updated_at 由数据库在更新时生成，需重新读取
+    await db.refresh(db_note, attribute_names=["updated_at"])
+    if tree_changed:
+        notes_tree_cache.invalidate(current_user.id)
     return db_note
 
 @router.delete("/{note_id}")
-def delete_note(note_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_note(note_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """删除笔记"""
-    db_note = db.query(Note).filter(Note.id == note_id, Note.user_id == current_user.id).first()
+    db_note = (await db.execute(select(Note).where(Note.id == note_id, Note.user_id == current_user.id))).scalar_one_or_none()
     if not db_note:
         raise HTTPException(status_code=404, detail="笔记不存在")
     
-    db.delete(db_note)
-    db.commit()
+    await db.delete(db_note)
+    await db.run_sync(remove_document, "note", note_id)
+    await db.commit()
+    notes_tree_cache.invalidate(current_user.id)
     return {"message": "笔记已删除"}
 
 # 文件夹管理
 @router.post("/folders", response_model=dict)
-def create_folder(name: str, category_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_folder(name: str, category_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """创建文件夹"""
     # 验证分类
-    category = db.query(Category).filter(Category.id == category_id, Category.user_id == current_user.id).first()
+    category = (await db.execute(select(Category.id).where(Category.id == category_id, Category.user_id == current_user.id))).first()
     if not category:
         raise HTTPException(status_code=404, detail="分类不存在")
     
     # 检查文件夹名是否已存在
-    existing_folder = db.query(Folder).filter(
+    existing_folder = (await db.execute(select(Folder.id).where(
         Folder.name == name, 
         Folder.category_id == category_id,
         Folder.user_id == current_user.id
-    ).first()
+    ))).first()
     if existing_folder:
         raise HTTPException(status_code=400, detail="文件夹名已存在")
     
     folder = Folder(name=name, category_id=category_id, user_id=current_user.id)
     db.add(folder)
-    db.commit()
-    db.refresh(folder)
+    await db.commit()
+    notes_tree_cache.invalidate(current_user.id)
     
     return {"id": folder.id, "name": folder.name, "category_id": folder.category_id}
 
 # 标签管理
 @router.post("/tags", response_model=dict)
-def create_tag(name: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_tag(name: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """创建标签"""
     # 检查标签是否已存在
-    existing_tag = db.query(Tag).filter(Tag.name == name, Tag.user_id == current_user.id).first()
+    existing_tag = (await db.execute(select(Tag.id, Tag.name).where(Tag.name == name, Tag.user_id == current_user.id))).first()
     if existing_tag:
         return {"id": existing_tag.id, "name": existing_tag.name}
     
     tag = Tag(name=name, user_id=current_user.id)
     db.add(tag)
-    db.commit()
-    db.refresh(tag)
+    await db.commit()
     
     return {"id": tag.id, "name": tag.name}
 
 @router.post("/init-default-data")
-def init_default_data(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def init_default_data(current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """初始化默认分类和文件夹"""
     try:
-        create_default_categories_and_folders(db, current_user)
+        await db.run_sync(create_default_categories_and_folders, current_user)
+        notes_tree_cache.invalidate(current_user.id)
         return {"message": "默认数据初始化成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"初始化失败: {str(e)}")
-
@@ -0,0 +1,64 @@
+import json
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
+from fastapi import HTTPException, Response
+from sqlalchemy import Select, and_, or_
+from sqlalchemy.orm import Query
+
+# 下一页游标通过响应头返回，响应体保持列表格式以兼容现有客户端
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(timestamp: datetime, item_id: str) -> str:
+    """将 (时间戳, ID) 编码为不透明游标"""
+    payload = json.dumps([timestamp.isoformat(), item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, item_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(timestamp), str(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+
+def keyset_condition(timestamp_column, id_column, cursor: str, descending: bool = True):
+    """
+    游标之后的记录条件：descending 时为游标之前（更早）的记录，否则为游标之后（更晚）的记录
+
+    直接比较原始列（SQLite中时间统一以带6位微秒的文本保存，见迁移0008），可以使用 (所属, 时间, ID) 复合索引
+    """
+    timestamp, item_id = decode_cursor(cursor)
+    if descending:
+        return or_(timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < item_id))
+    return or_(timestamp_column > timestamp, and_(timestamp_column == timestamp, id_column > item_id))
+
+
+def keyset_paginate(query: Union[Query, Select], timestamp_column, id_column, cursor: Optional[str], limit: int, descending: bool = True):
+    """
+    按 (时间戳, ID) 进行游标分页：从游标之后开始取 limit + 1 条，多取的一条用于判断是否还有下一页
+
+    query 可以是会话的 Query，也可以是 select() 语句（异步会话使用）
+    """
+    if cursor:
+        query = query.filter(keyset_condition(timestamp_column, id_column, cursor, descending))
+
+    if descending:
+        query = query.order_by(timestamp_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(timestamp_column.asc(), id_column.asc())
+    return query.limit(limit + 1)
+
+
+def finish_page(items: List, response: Response, limit: int, timestamp_attr: str) -> List:
+    """
+    截断多取的一条，并在还有下一页时通过响应头返回下一页游标
+    """
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(last, timestamp_attr), last.id)
+    return items
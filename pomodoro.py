@@ -1,28 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from datetime import datetime, date, timedelta
+import calendar
 
-from database import get_db
-from models import User, PomodoroLog, Task
+from database import get_async_db
+from models import User, PomodoroLog, PomodoroTaskDailyRollup, Task
 from schemas import PomodoroLog as PomodoroLogSchema, PomodoroLogCreate, PomodoroSettings
-from auth import get_current_user
+from auth import get_current_user_async
+from principal_cache import principal_cache
+from pagination import keyset_paginate, finish_page
+from pomodoro_stats import track_log_created, track_log_deleted, daily_totals, summarize
 
 router = APIRouter()
 
+def _day_series(totals: dict, start: date, end: date) -> List[dict]:
+    """把按天汇总补齐为连续日期序列"""
+    series = []
+    current = start
+    while current <= end:
+        count, minutes = totals.get(current, (0, 0))
+        series.append({"date": current.isoformat(), "count": count, "minutes": minutes})
+        current += timedelta(days=1)
+    return series
+
 @router.get("/logs", response_model=List[PomodoroLogSchema])
-def get_pomodoro_logs(
+async def get_pomodoro_logs(
+    response: Response,
     skip: int = 0,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
     task_id: Optional[str] = None,
     date_from: Optional[date] = None,
     date_to: Optional[date] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """获取番茄钟记录"""
-    query = db.query(PomodoroLog).filter(PomodoroLog.user_id == current_user.id)
+    """获取番茄钟记录（按完成时间倒序；下一页游标见响应头X-Next-Cursor）"""
+    query = select(PomodoroLog).where(PomodoroLog.user_id == current_user.id)
     
     if task_id:
         query = query.filter(PomodoroLog.task_id == task_id)
@@ -31,15 +47,18 @@ def get_pomodoro_logs(
     if date_to:
         query = query.filter(PomodoroLog.completed_at <= datetime.combine(date_to, datetime.max.time()))
     
-    logs = query.order_by(PomodoroLog.completed_at.desc()).offset(skip).limit(limit).all()
-    return logs
+    query = keyset_paginate(query, PomodoroLog.completed_at, PomodoroLog.id, cursor, limit)
+    if skip and not cursor:
+        query = query.offset(skip)
+    logs = list((await db.execute(query)).scalars())
+    return finish_page(logs, response, limit, "completed_at")
 
 @router.post("/logs", response_model=PomodoroLogSchema)
-def create_pomodoro_log(log: PomodoroLogCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_pomodoro_log(log: PomodoroLogCreate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """记录完成的番茄钟"""
     # 验证任务（如果提供）
     if log.task_id:
-        task = db.query(Task).filter(Task.id == log.task_id, Task.user_id == current_user.id).first()
+        task = (await db.execute(select(Task.id).where(Task.id == log.task_id, Task.user_id == current_user.id))).first()
         if not task:
             raise HTTPException(status_code=404, detail="任务不存在")
     
@@ -50,12 +69,14 @@ def create_pomodoro_log(log: PomodoroLogCreate, current_user: User = Depends(get
         duration=log.duration
     )
     db.add(db_log)
-    db.commit()
-    db.refresh(db_log)
+    await db.flush()
+    await db.run_sync(track_log_created, db_log)
+    await db.commit()
+    await db.refresh(db_log)
     return db_log
 
 @router.get("/settings", response_model=PomodoroSettings)
-def get_pomodoro_settings(current_user: User = Depends(get_current_user)):
+async def get_pomodoro_settings(current_user: User = Depends(get_current_user_async)):
     """获取用户的番茄钟设置"""
     settings = current_user.pomodoro_settings or {}
     return PomodoroSettings(
@@ -67,62 +88,47 @@ def get_pomodoro_settings(current_user: User = Depends(get_current_user)):
     )
 
 @router.put("/settings", response_model=PomodoroSettings)
-def update_pomodoro_settings(settings: PomodoroSettings, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_pomodoro_settings(settings: PomodoroSettings, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """更新用户的番茄钟设置"""
     current_user.pomodoro_settings = settings.dict()
-    db.commit()
+    await db.commit()
+    principal_cache.invalidate_user(current_user.id)
     return settings
 
 @router.get("/stats/daily", response_model=dict)
-def get_daily_stats(
+async def get_daily_stats(
     date_param: Optional[date] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """获取每日番茄钟统计"""
+    """获取每日番茄钟统计（读取按天汇总表，任务标题一次连接查询取得）"""
     target_date = date_param or date.today()
-    start_time = datetime.combine(target_date, datetime.min.time())
-    end_time = datetime.combine(target_date, datetime.max.time())
-    
-    # 查询当日记录
-    logs = db.query(PomodoroLog).filter(
-        and_(
-            PomodoroLog.user_id == current_user.id,
-            PomodoroLog.completed_at >= start_time,
-            PomodoroLog.completed_at <= end_time
-        )
-    ).all()
-    
-    total_count = len(logs)
-    total_minutes = sum(log.duration for log in logs)
+    totals = await db.run_sync(daily_totals, current_user.id, target_date, target_date)
+    count, minutes = totals.get(target_date, (0, 0))
     
     # 按任务分组统计
-    task_stats = {}
-    for log in logs:
-        if log.task_id:
-            if log.task_id not in task_stats:
-                task = db.query(Task).filter(Task.id == log.task_id).first()
-                task_stats[log.task_id] = {
-                    "task_title": task.title if task else "未知任务",
-                    "count": 0,
-                    "minutes": 0
-                }
-            task_stats[log.task_id]["count"] += 1
-            task_stats[log.task_id]["minutes"] += log.duration
+    rows = await db.execute(select(Task.title, PomodoroTaskDailyRollup.count, PomodoroTaskDailyRollup.minutes).select_from(
+        PomodoroTaskDailyRollup
+    ).outerjoin(Task, Task.id == PomodoroTaskDailyRollup.task_id).where(
+        PomodoroTaskDailyRollup.user_id == current_user.id,
+        PomodoroTaskDailyRollup.day == target_date,
+        PomodoroTaskDailyRollup.count > 0
+    ))
     
     return {
         "date": target_date.isoformat(),
-        "total_pomodoros": total_count,
-        "total_minutes": total_minutes,
-        "total_hours": round(total_minutes / 60, 2),
-        "task_breakdown": list(task_stats.values())
+        **summarize(count, minutes),
+        "task_breakdown": [
+            {"task_title": title or "未知任务", "count": task_count, "minutes": task_minutes}
+            for title, task_count, task_minutes in rows
+        ]
     }
 
 @router.get("/stats/weekly", response_model=dict)
-def get_weekly_stats(
+async def get_weekly_stats(
     week_start: Optional[date] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """获取周统计"""
     if not week_start:
@@ -130,90 +136,120 @@ def get_weekly_stats(
         week_start = today - timedelta(days=today.weekday())
     
     week_end = week_start + timedelta(days=6)
-    start_time = datetime.combine(week_start, datetime.min.time())
-    end_time = datetime.combine(week_end, datetime.max.time())
-    
-    # 查询本周记录
-    logs = db.query(PomodoroLog).filter(
-        and_(
-            PomodoroLog.user_id == current_user.id,
-            PomodoroLog.completed_at >= start_time,
-            PomodoroLog.completed_at <= end_time
-        )
-    ).all()
-    
-    # 按日期分组
-    daily_stats = {}
-    for i in range(7):
-        current_date = week_start + timedelta(days=i)
-        daily_stats[current_date.isoformat()] = {
-            "date": current_date.isoformat(),
-            "count": 0,
-            "minutes": 0
-        }
-    
-    for log in logs:
-        log_date = log.completed_at.date()
-        date_key = log_date.isoformat()
-        if date_key in daily_stats:
-            daily_stats[date_key]["count"] += 1
-            daily_stats[date_key]["minutes"] += log.duration
-    
-    total_count = len(logs)
-    total_minutes = sum(log.duration for log in logs)
+    totals = await db.run_sync(daily_totals, current_user.id, week_start, week_end)
+    daily_breakdown = _day_series(totals, week_start, week_end)
     
     return {
         "week_start": week_start.isoformat(),
         "week_end": week_end.isoformat(),
-        "total_pomodoros": total_count,
-        "total_minutes": total_minutes,
-        "total_hours": round(total_minutes / 60, 2),
-        "daily_breakdown": list(daily_stats.values()),
-        "average_per_day": round(total_count / 7, 2)
+        **summarize(sum(c for c, _ in totals.values()), sum(m for _, m in totals.values()), days=7),
+        "daily_breakdown": daily_breakdown
+    }
+
+@router.get("/stats/monthly", response_model=dict)
+async def get_monthly_stats(
+    year: Optional[int] = Query(None, ge=1970, le=9999),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取月统计（默认本月），按天分布"""
+    today = date.today()
+    month_start = date(year or today.year, month or today.month, 1)
+    month_end = date(month_start.year, month_start.month, calendar.monthrange(month_start.year, month_start.month)[1])
+    totals = await db.run_sync(daily_totals, current_user.id, month_start, month_end)
+    
+    return {
+        "year": month_start.year,
+        "month": month_start.month,
+        **summarize(sum(c for c, _ in totals.values()), sum(m for _, m in totals.values()), days=month_end.day),
+        "active_days": len(totals),
+        "daily_breakdown": _day_series(totals, month_start, month_end)
+    }
+
+@router.get("/stats/yearly", response_model=dict)
+async def get_yearly_stats(
+    year: Optional[int] = Query(None, ge=1970, le=9999),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取年统计（默认今年），按月分布"""
+    year = year or date.today().year
+    totals = await db.run_sync(daily_totals, current_user.id, date(year, 1, 1), date(year, 12, 31))
+    
+    monthly = [{"month": m, "count": 0, "minutes": 0, "active_days": 0} for m in range(1, 13)]
+    for day, (count, minutes) in totals.items():
+        item = monthly[day.month - 1]
+        item["count"] += count
+        item["minutes"] += minutes
+        item["active_days"] += 1
+    
+    days_in_year = 366 if calendar.isleap(year) else 365
+    return {
+        "year": year,
+        **summarize(sum(c for c, _ in totals.values()), sum(m for _, m in totals.values()), days=days_in_year),
+        "active_days": len(totals),
+        "monthly_breakdown": monthly
+    }
+
+@router.get("/stats/heatmap", response_model=dict)
+async def get_heatmap(
+    end: Optional[date] = None,
+    days: int = Query(365, ge=1, le=366),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取热力图数据：截至end（默认今天）的最近days天，每天的次数与分钟数"""
+    end = end or date.today()
+    start = end - timedelta(days=days - 1)
+    totals = await db.run_sync(daily_totals, current_user.id, start, end)
+    
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "max_count": max((c for c, _ in totals.values()), default=0),
+        "days": _day_series(totals, start, end)
     }
 
 @router.get("/stats/task/{task_id}", response_model=dict)
-def get_task_pomodoro_stats(task_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_task_pomodoro_stats(task_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """获取特定任务的番茄钟统计"""
     # 验证任务
-    task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+    task = (await db.execute(select(Task.title).where(Task.id == task_id, Task.user_id == current_user.id))).first()
     if not task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    # 查询该任务的所有番茄钟记录
-    logs = db.query(PomodoroLog).filter(
-        PomodoroLog.task_id == task_id,
-        PomodoroLog.user_id == current_user.id
-    ).order_by(PomodoroLog.completed_at).all()
-    
-    total_count = len(logs)
-    total_minutes = sum(log.duration for log in logs)
+    # 按天汇总行数只与有记录的天数有关
+    rows = (await db.execute(select(PomodoroTaskDailyRollup.day, PomodoroTaskDailyRollup.count, PomodoroTaskDailyRollup.minutes).where(
+        PomodoroTaskDailyRollup.task_id == task_id,
+        PomodoroTaskDailyRollup.user_id == current_user.id,
+        PomodoroTaskDailyRollup.count > 0
+    ).order_by(PomodoroTaskDailyRollup.day))).all()
     
-    # 按日期分组
-    daily_counts = {}
-    for log in logs:
-        date_key = log.completed_at.date().isoformat()
-        daily_counts[date_key] = daily_counts.get(date_key, 0) + 1
+    # 首次/最近一次完成时间走 (task_id, completed_at) 索引各取一条；
+    # 任务归属已在上面校验，不再加user_id条件，避免SQLite改用 (user_id, completed_at) 索引扫描全部记录
+    logs = select(PomodoroLog.completed_at).where(PomodoroLog.task_id == task_id).limit(1)
+    first = (await db.execute(logs.order_by(PomodoroLog.completed_at))).first()
+    last = (await db.execute(logs.order_by(PomodoroLog.completed_at.desc()))).first()
     
     return {
         "task_id": task_id,
         "task_title": task.title,
-        "total_pomodoros": total_count,
-        "total_minutes": total_minutes,
-        "total_hours": round(total_minutes / 60, 2),
-        "first_session": logs[0].completed_at.isoformat() if logs else None,
-        "last_session": logs[-1].completed_at.isoformat() if logs else None,
-        "daily_counts": daily_counts
+        **summarize(sum(row.count for row in rows), sum(row.minutes for row in rows)),
+        "first_session": first[0].isoformat() if first else None,
+        "last_session": last[0].isoformat() if last else None,
+        "daily_counts": {row.day.isoformat(): row.count for row in rows}
     }
 
 @router.delete("/logs/{log_id}")
-def delete_pomodoro_log(log_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_pomodoro_log(log_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """删除番茄钟记录"""
-    log = db.query(PomodoroLog).filter(PomodoroLog.id == log_id, PomodoroLog.user_id == current_user.id).first()
+    log = (await db.execute(select(PomodoroLog).where(PomodoroLog.id == log_id, PomodoroLog.user_id == current_user.id))).scalar_one_or_none()
     if not log:
         raise HTTPException(status_code=404, detail="记录不存在")
     
-    db.delete(log)
-    db.commit()
+    await db.delete(log)
+    await db.run_sync(track_log_deleted, log)
+    await db.commit()
     return {"message": "记录已删除"}
 
@@ -0,0 +1,78 @@
+from datetime import date
+from typing import Dict, Optional, Tuple
+from sqlalchemy.orm import Session
+
+from database import increment_counter
+from models import PomodoroLog, PomodoroDailyRollup, PomodoroTaskDailyRollup
+
+
+def _adjust(db: Session, log: PomodoroLog, sign: int):
+    day = log.completed_at.date()
+    deltas = dict(count=sign, minutes=sign * log.duration)
+    increment_counter(db, PomodoroDailyRollup, dict(user_id=log.user_id, day=day), deltas)
+    if log.task_id:
+        increment_counter(db, PomodoroTaskDailyRollup, dict(user_id=log.user_id, task_id=log.task_id, day=day), deltas)
+
+
+def track_log_created(db: Session, log: PomodoroLog):
+    """记录flush之后调用（completed_at由数据库默认值生成）"""
+    _adjust(db, log, 1)
+
+
+def track_log_deleted(db: Session, log: PomodoroLog):
+    _adjust(db, log, -1)
+
+
+def rebuild_pomodoro_rollups(db: Session, user_id: str):
+    """从番茄钟记录重新汇总（迁移前的数据或汇总异常时使用）"""
+    db.flush()
+    db.query(PomodoroDailyRollup).filter(PomodoroDailyRollup.user_id == user_id).delete(synchronize_session=False)
+    db.query(PomodoroTaskDailyRollup).filter(PomodoroTaskDailyRollup.user_id == user_id).delete(synchronize_session=False)
+    
+    totals: Dict[date, list] = {}
+    per_task: Dict[Tuple[str, date], list] = {}
+    rows = db.query(PomodoroLog.task_id, PomodoroLog.completed_at, PomodoroLog.duration).filter(
+        PomodoroLog.user_id == user_id
+    ).all()
+    for task_id, completed_at, duration in rows:
+        day = completed_at.date()
+        total = totals.setdefault(day, [0, 0])
+        total[0] += 1
+        total[1] += duration
+        if task_id:
+            item = per_task.setdefault((task_id, day), [0, 0])
+            item[0] += 1
+            item[1] += duration
+    
+    db.add_all([
+        PomodoroDailyRollup(user_id=user_id, day=day, count=count, minutes=minutes)
+        for day, (count, minutes) in totals.items()
+    ])
+    db.add_all([
+        PomodoroTaskDailyRollup(user_id=user_id, task_id=task_id, day=day, count=count, minutes=minutes)
+        for (task_id, day), (count, minutes) in per_task.items()
+    ])
+    db.flush()
+
+
+def daily_totals(db: Session, user_id: str, start: date, end: date) -> Dict[date, Tuple[int, int]]:
+    """[start, end] 区间内每天的 (次数, 分钟数)，没有记录的日期不出现"""
+    rows = db.query(PomodoroDailyRollup.day, PomodoroDailyRollup.count, PomodoroDailyRollup.minutes).filter(
+        PomodoroDailyRollup.user_id == user_id,
+        PomodoroDailyRollup.day >= start,
+        PomodoroDailyRollup.day <= end,
+        PomodoroDailyRollup.count > 0
+    ).all()
+    return {day: (count, minutes) for day, count, minutes in rows}
+
+
+def summarize(count: int, minutes: int, days: Optional[int] = None) -> dict:
+    """统计接口共用的汇总字段"""
+    summary = {
+        "total_pomodoros": count,
+        "total_minutes": minutes,
+        "total_hours": round(minutes / 60, 2)
+    }
+    if days:
+        summary["average_per_day"] = round(count / days, 2)
+    return summary
@@ -0,0 +1,112 @@
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import User
+
+
+class PrincipalEntry(NamedTuple):
+    expires_at: float
+    user_id: str
+    snapshot: User
+
+
+def snapshot_user(user: User) -> User:
+    """
+    复制用户的列属性为一个脱离会话的User对象（不含关系），
+    请求中通过 db.merge(snapshot, load=False) 挂到当前会话，不产生SQL
+    """
+    values = {attr.key: copy.deepcopy(getattr(user, attr.key)) for attr in inspect(User).column_attrs}
+    snapshot = User(**values)
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+class PrincipalCache:
+    """
+    按访问令牌缓存已认证的用户，命中时跳过JWT解码和用户查询
+
+    过期时间取TTL与令牌自身过期时间中较早者；用户被修改、停用、删除或修改密码后
+    需调用 invalidate_user。失效只作用于当前进程，多进程部署时以TTL为上限
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, PrincipalEntry]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def generation(self) -> int:
+        """查询用户之前读取，写入时检测期间是否发生过失效"""
+        with self._lock:
+            return self._generation
+
+    def get(self, token: str) -> Optional[User]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return entry.snapshot
+
+    def put(self, token: str, generation: int, user: User, token_expires_at: Optional[float] = None):
+        """写入缓存。查询期间若有用户被失效（generation已变化），不缓存以免写回旧数据"""
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        entry = PrincipalEntry(expires_at=expires_at, user_id=user.id, snapshot=snapshot_user(user))
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(token)
+            self._entries[token] = entry
+            self._tokens_by_user.setdefault(entry.user_id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: str):
+        """丢弃该用户的全部令牌缓存，在修改用户的事务提交后调用"""
+        with self._lock:
+            self._generation += 1
+            for token in self._tokens_by_user.pop(user_id, set()):
+                self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_user.get(entry.user_id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_user[entry.user_id]
+
+
+# 全局认证用户缓存实例（AUTH_CACHE_TTL=0 时关闭）
+principal_cache = PrincipalCache(
+    max_entries=int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", "300"))
+)
@@ -0,0 +1,360 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from contextlib import AsyncExitStack
+from typing import AsyncContextManager, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+# 多服务商路由：按服务商统计延迟和错误、熔断不可用的服务商，并在同类模型之间按降级链切换；
+# 后台健康探测定期请求各服务商的模型列表接口（不产生token费用），状态接口使用探测的缓存结果
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))  # 连续失败达到此数时熔断
+AI_BREAKER_WINDOW = int(os.getenv("AI_BREAKER_WINDOW", "20"))  # 统计错误率的最近调用数
+AI_BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", "0.5"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))  # 秒，熔断后多久放行一次试探请求
+AI_BREAKER_MAX_COOLDOWN = float(os.getenv("AI_BREAKER_MAX_COOLDOWN", "300"))  # 试探失败时冷却时间翻倍，最长到此值
+# 成功但耗时超过此值（秒）的调用也按失败计入熔断统计
+AI_BREAKER_SLOW_SECONDS = float(os.getenv("AI_BREAKER_SLOW_SECONDS", "20"))
+AI_HEALTH_PROBE_INTERVAL = float(os.getenv("AI_HEALTH_PROBE_INTERVAL", "60"))  # 秒，0表示关闭后台探测
+AI_HEALTH_PROBE_TIMEOUT = float(os.getenv("AI_HEALTH_PROBE_TIMEOUT", "5"))
+LATENCY_SAMPLES = 200
+Gate = Callable[[str], AsyncContextManager]
+EWMA_ALPHA = 0.2
+
+# 降级链：请求的模型所在服务商不可用时依次尝试的同类模型
+DEFAULT_FALLBACK_CHAINS = {
+    "kimi-k2-latest": ["deepseek/deepseek-chat-v3.1"],
+    "moonshot-v1-8k": ["kimi-k2-latest", "deepseek/deepseek-chat-v3.1"],
+    "deepseek/deepseek-chat-v3.1": ["kimi-k2-latest"],
+    "openai/gpt-5": ["openai/gpt-4o", "kimi-k2-latest"],
+    "openai/gpt-4o": ["deepseek/deepseek-chat-v3.1", "kimi-k2-latest"],
+    "google/gemini-2.5-pro": ["google/gemini-2.5-flash", "kimi-k2-latest"],
+    "google/gemini-2.5-flash": ["deepseek/deepseek-chat-v3.1", "kimi-k2-latest"],
+    "anthropic/claude-sonnet-4": ["openai/gpt-4o", "kimi-k2-latest"],
+}
+
+
+def parse_fallback_chains(value: Optional[str]) -> Dict[str, List[str]]:
+    """
+    解析 AI_FALLBACK_CHAINS："模型>降级模型1>降级模型2;模型2>..."，为空时使用默认降级链，off 表示不降级
+    """
+    if not value:
+        return {model: list(chain) for model, chain in DEFAULT_FALLBACK_CHAINS.items()}
+    if value.strip().lower() == "off":
+        return {}
+    chains = {}
+    for item in value.split(";"):
+        models = [model.strip() for model in item.split(">") if model.strip()]
+        if len(models) > 1:
+            chains[models[0]] = models[1:]
+    return chains
+
+
+class ProviderError(Exception):
+    """
+    服务商调用失败；retryable 表示换一个服务商可能成功（超时、网络错误、5xx、限流、鉴权失败），
+    其余4xx是请求本身的问题，不切换服务商也不计入熔断
+    """
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+        self.retryable = status_code is None or status_code >= 500 or status_code in (401, 403, 408, 429)
+
+
+class ProviderUnavailable(Exception):
+    """请求的模型及其降级模型所在的服务商都处于熔断中"""
+
+
+class ProviderState:
+    """
+    单个服务商的熔断器与调用统计
+
+    closed：正常放行；连续失败或最近调用的错误率过高时转为 open，冷却期内直接拒绝；
+    冷却结束（或健康探测成功）后转为 half_open，只放行一个试探请求，成功则恢复，失败则冷却时间翻倍后重新熔断
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_until = 0.0
+        self.cooldown = AI_BREAKER_COOLDOWN
+        self.trial_in_flight = False
+        self.consecutive_failures = 0
+        self.outcomes: Deque[bool] = deque(maxlen=AI_BREAKER_WINDOW)
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.ewma_latency: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+        self.probe: Optional[Dict] = None  # 最近一次健康探测的结果
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() < self.opened_until:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open":
+            if self.trial_in_flight:
+                self.rejected += 1
+                return False
+            self.trial_in_flight = True
+        self.requests += 1
+        return True
+
+    def release(self):
+        """请求被取消、没有结果时归还试探名额"""
+        self.trial_in_flight = False
+
+    def record(self, ok: bool, latency: Optional[float] = None, error: Optional[str] = None):
+        if latency is not None:
+            self.latencies.append(latency)
+            self.ewma_latency = latency if self.ewma_latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+            if ok and latency > AI_BREAKER_SLOW_SECONDS:
+                ok, error = False, f"响应过慢（{latency:.1f}秒）"
+        self.outcomes.append(ok)
+        self.trial_in_flight = False
+        if ok:
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                print(f"✅ AI服务商 {self.name} 已恢复")
+                self.state = "closed"
+                self.cooldown = AI_BREAKER_COOLDOWN
+            return
+
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == "half_open":
+            self._open(min(self.cooldown * 2, AI_BREAKER_MAX_COOLDOWN))
+        elif self.state == "closed":
+            failed = self.outcomes.count(False)
+            if self.consecutive_failures >= AI_BREAKER_FAILURES or (
+                len(self.outcomes) >= AI_BREAKER_WINDOW // 2 and failed / len(self.outcomes) >= AI_BREAKER_ERROR_RATE
+            ):
+                self._open(AI_BREAKER_COOLDOWN)
+
+    def _open(self, cooldown: float):
+        self.state = "open"
+        self.cooldown = cooldown
+        self.opened_until = time.monotonic() + cooldown
+        print(f"⚡ AI服务商 {self.name} 熔断 {cooldown:.0f} 秒: {self.last_error}")
+
+    def probe_succeeded(self):
+        # 探测成功说明服务商已恢复，不必等冷却结束即可放行试探请求
+        if self.state == "open":
+            self.state = "half_open"
+            self.trial_in_flight = False
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def snapshot(self) -> Dict:
+        ms = lambda seconds: None if seconds is None else round(seconds * 1000)
+        return {
+            "provider": self.name,
+            "circuit": self.state,
+            "retry_in": max(round(self.opened_until - time.monotonic()), 0) if self.state == "open" else 0,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "error_rate": round(self.outcomes.count(False) / len(self.outcomes), 3) if self.outcomes else 0.0,
+            "latency_ms": {"ewma": ms(self.ewma_latency), "p50": ms(self.percentile(0.5)), "p95": ms(self.percentile(0.95))},
+            "last_error": self.last_error,
+            "probe": self.probe,
+        }
+
+
+class ProviderRouter:
+    """
+    按模型所属服务商路由请求
+
+    provider_of 返回模型所属的服务商；probe 对服务商做一次健康探测，失败时抛出异常；
+    configured 判断服务商是否已配置密钥，未配置的服务商不作为降级目标、不做探测
+    """
+
+    def __init__(
+        self,
+        providers: List[str],
+        provider_of: Callable[[str], str],
+        probe: Callable[[str], Awaitable[None]],
+        configured: Callable[[str], bool],
+        fallback_chains: Optional[Dict[str, List[str]]] = None,
+    ):
+        self.states = {name: ProviderState(name) for name in providers}
+        self.provider_of = provider_of
+        self._probe = probe
+        self.configured = configured
+        self.fallback_chains = parse_fallback_chains(os.getenv("AI_FALLBACK_CHAINS")) if fallback_chains is None else fallback_chains
+        self.fallbacks = 0
+        self._prober: Optional[asyncio.Task] = None
+
+    def chain(self, model: str) -> List[str]:
+        """请求的模型和可用的降级模型（去重，跳过未配置的服务商）"""
+        models = [model]
+        for fallback in self.fallback_chains.get(model, []):
+            if fallback not in models and self.configured(self.provider_of(fallback)):
+                models.append(fallback)
+        return models
+
+    def _unavailable(self, model: str) -> ProviderUnavailable:
+        state = self.states[self.provider_of(model)]
+        return ProviderUnavailable(f"AI服务暂时不可用（{state.name} 熔断中，约{max(round(state.opened_until - time.monotonic()), 1)}秒后重试）: {state.last_error}")
+
+    def _fell_back(self, model: str, candidate: str):
+        if candidate != model:
+            self.fallbacks += 1
+            print(f"🔀 模型 {model} 不可用，改用 {candidate}")
+
+    async def _enter(self, stack: AsyncExitStack, gate: Optional[Gate], state: "ProviderState"):
+        # 准入排队的等待不计入服务商延迟；被拒绝时归还试探名额
+        if gate is None:
+            return
+        try:
+            await stack.enter_async_context(gate(state.name))
+        except BaseException:
+            state.release()
+            raise
+
+    async def run(self, model: str, call: Callable[[str], Awaitable[Dict]], gate: Optional[Gate] = None) -> Dict:
+        """
+        按降级链依次调用 call(模型)，返回第一个成功的结果；
+        gate(服务商) 返回调用期间要进入的上下文（如并发名额），其异常直接抛出
+        """
+        last_error: Optional[Exception] = None
+        for candidate in self.chain(model):
+            state = self.states[self.provider_of(candidate)]
+            if not state.allow():
+                continue
+            async with AsyncExitStack() as stack:
+                await self._enter(stack, gate, state)
+                start = time.monotonic()
+                try:
+                    result = await call(candidate)
+                except ProviderError as e:
+                    # 请求本身有问题时服务商是正常的，直接返回错误
+                    state.record(not e.retryable, time.monotonic() - start, str(e))
+                    if not e.retryable:
+                        raise
+                    last_error = e
+                    continue
+                except asyncio.CancelledError:
+                    state.release()
+                    raise
+                except Exception as e:
+                    state.record(False, time.monotonic() - start, str(e))
+                    last_error = e
+                    continue
+                state.record(True, time.monotonic() - start)
+                self._fell_back(model, candidate)
+                return result
+        raise last_error or self._unavailable(model)
+
+    async def stream(self, model: str, open_stream: Callable[[str], AsyncIterator[Dict]], gate: Optional[Gate] = None) -> AsyncIterator[Dict]:
+        """
+        流式调用：产出第一块内容之前失败时切换到降级模型，之后的失败直接抛出；
+        以首块内容的等待时间作为延迟统计，gate 的上下文在整个流式响应期间保持
+        """
+        last_error: Optional[Exception] = None
+        for candidate in self.chain(model):
+            state = self.states[self.provider_of(candidate)]
+            if not state.allow():
+                continue
+            async with AsyncExitStack() as stack:
+                await self._enter(stack, gate, state)
+                start = time.monotonic()
+                started = False
+                try:
+                    async for event in open_stream(candidate):
+                        if not started:
+                            started = True
+                            state.record(True, time.monotonic() - start)
+                            self._fell_back(model, candidate)
+                        yield event
+                    if not started:
+                        state.record(True, time.monotonic() - start)
+                        self._fell_back(model, candidate)
+                    return
+                except (asyncio.CancelledError, GeneratorExit):
+                    state.release()
+                    raise
+                except Exception as e:
+                    retryable = getattr(e, "retryable", True)
+                    if started:
+                        if retryable:
+                            state.record(False, None, str(e))
+                        raise
+                    state.record(not retryable, time.monotonic() - start, str(e))
+                    if not retryable:
+                        raise
+                    last_error = e
+        raise last_error or self._unavailable(model)
+
+    async def probe(self, provider: str) -> Dict:
+        """探测一个服务商并缓存结果"""
+        state = self.states[provider]
+        checked_at = datetime.now().isoformat(timespec="seconds")
+        if not self.configured(provider):
+            state.probe = {"status": "unconfigured", "checked_at": checked_at}
+            return state.probe
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._probe(provider), AI_HEALTH_PROBE_TIMEOUT)
+        except Exception as e:
+            error = str(e) or "健康探测超时"
+            state.probe = {"status": "offline", "error": error, "checked_at": checked_at}
+            state.record(False, None, f"健康探测失败: {error}")
+        else:
+            state.probe = {"status": "online", "latency_ms": round((time.monotonic() - start) * 1000), "checked_at": checked_at}
+            state.probe_succeeded()
+        state.probe["_at"] = time.monotonic()  # 内部字段，用于判断结果是否过期
+        return state.probe
+
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(provider) for provider in self.states))
+
+    async def provider_status(self, provider: str, max_age: Optional[float] = None) -> Dict:
+        """服务商的缓存探测结果；没有探测过或结果过期时现场探测一次"""
+        max_age = max_age if max_age is not None else max(AI_HEALTH_PROBE_INTERVAL * 2, 60)
+        state = self.states[provider]
+        if state.probe is None or time.monotonic() - state.probe["_at"] > max_age:
+            await self.probe(provider)
+        return {key: value for key, value in state.probe.items() if not key.startswith("_")}
+
+    def snapshot(self) -> Dict:
+        providers = []
+        for state in self.states.values():
+            item = state.snapshot()
+            if item["probe"] is not None:
+                item["probe"] = {key: value for key, value in item["probe"].items() if not key.startswith("_")}
+            providers.append(item)
+        return {"providers": providers, "fallbacks": self.fallbacks, "fallback_chains": self.fallback_chains}
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"⚠️ AI服务商健康探测失败: {e}")
+            await asyncio.sleep(AI_HEALTH_PROBE_INTERVAL)
+
+    def start_prober(self):
+        """启动后台健康探测（应用启动时调用）"""
+        if AI_HEALTH_PROBE_INTERVAL > 0 and (self._prober is None or self._prober.done()):
+            self._prober = asyncio.ensure_future(self._probe_loop())
+
+    async def stop_prober(self):
+        if self._prober is not None:
+            self._prober.cancel()
+            try:
+                await self._prober
+            except asyncio.CancelledError:
+                pass
+            self._prober = None
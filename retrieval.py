@@ -0,0 +1,329 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Note, Task
+from tokenizer import tokenize, query_terms, is_cjk, truncate_to_tokens
+
+# 本地检索索引：按用户在内存中维护笔记和任务的BM25倒排索引（不依赖外部向量服务），
+# 用于对话时注入相关片段和"相关笔记"推荐；全文检索接口仍使用数据库中的检索表
+RETRIEVAL_DOC_TYPES = ("note", "task")
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 3  # 标题中的词按出现3次计
+RETRIEVAL_MAX_USERS = int(os.getenv("RETRIEVAL_MAX_USERS", "200"))
+# 索引的最长使用时间（秒）：多进程部署时其他进程的写入不会通知到本进程，过期后重新加载
+RETRIEVAL_INDEX_TTL = float(os.getenv("RETRIEVAL_INDEX_TTL", "300"))
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "1.0"))
+# "相关笔记"以笔记自身权重最高的若干个词作为查询
+RELATED_QUERY_TERMS = 40
+PASSAGE_SPLIT = re.compile(r"(?<=[。！？!?；;\n])")
+
+PENDING_CHANGES_KEY = "retrieval_changes"
+
+
+class RetrievalDoc(NamedTuple):
+    doc_type: str
+    doc_id: str
+    title: str
+    body: str
+    parent_id: Optional[str]
+
+
+def _term_weights(doc: RetrievalDoc) -> Counter:
+    weights = Counter(tokenize(doc.body))
+    for term in tokenize(doc.title):
+        weights[term] += TITLE_WEIGHT
+    return weights
+
+
+class UserIndex:
+    """
+    单个用户的BM25倒排索引
+
+    每个词的倒排表是两个可追加的类型化数组（文档行号、加权词频），打分时零拷贝转成NumPy数组做向量运算。
+    文档更新 = 旧行标记删除 + 追加新行，删除的行在过多时整体压缩
+    """
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.postings_rows: List[array] = []
+        self.postings_weights: List[array] = []
+        self.docs: List[Optional[RetrievalDoc]] = []
+        self.rows: Dict[Tuple[str, str], int] = {}
+        self.lengths = np.zeros(64, dtype=np.float32)
+        self.alive = np.zeros(64, dtype=bool)
+        self.kinds = np.zeros(64, dtype=np.int8)  # 文档类型在 RETRIEVAL_DOC_TYPES 中的序号
+        self.total_length = 0.0
+        self.created = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def upsert(self, doc: RetrievalDoc):
+        self.remove(doc.doc_type, doc.doc_id)
+        row = len(self.docs)
+        if row >= len(self.lengths):
+            self.lengths = np.resize(self.lengths, row * 2)
+            self.alive = np.resize(self.alive, row * 2)
+            self.alive[row:] = False
+            self.kinds = np.resize(self.kinds, row * 2)
+        self.docs.append(doc)
+
+        weights = _term_weights(doc)
+        for term, weight in weights.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = self.vocabulary[term] = len(self.postings_rows)
+                self.postings_rows.append(array("i"))
+                self.postings_weights.append(array("f"))
+            self.postings_rows[term_id].append(row)
+            self.postings_weights[term_id].append(weight)
+        length = sum(weights.values())
+        self.lengths[row] = length
+        self.alive[row] = True
+        self.kinds[row] = RETRIEVAL_DOC_TYPES.index(doc.doc_type)
+        self.total_length += length
+        self.rows[(doc.doc_type, doc.doc_id)] = row
+
+    def remove(self, doc_type: str, doc_id: str) -> bool:
+        row = self.rows.pop((doc_type, doc_id), None)
+        if row is None:
+            return False
+        self.alive[row] = False
+        self.docs[row] = None
+        self.total_length -= float(self.lengths[row])
+        # 删除的行超过一半时重建，避免倒排表中无效行堆积
+        if len(self.docs) > 1024 and len(self.docs) > 2 * len(self.rows):
+            self._compact()
+        return True
+
+    def _compact(self):
+        docs = [doc for doc in self.docs if doc is not None]
+        created = self.created
+        self.__init__()
+        self.created = created
+        for doc in docs:
+            self.upsert(doc)
+
+    def get(self, doc_type: str, doc_id: str) -> Optional[RetrievalDoc]:
+        row = self.rows.get((doc_type, doc_id))
+        return None if row is None else self.docs[row]
+
+    def _idf(self, document_frequency: int) -> float:
+        count = len(self.rows)
+        return math.log(1 + (count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.frombuffer(self.postings_rows[term_id], dtype=np.int32)
+        weights = np.frombuffer(self.postings_weights[term_id], dtype=np.float32)
+        live = self.alive[rows]
+        return rows[live], weights[live]
+
+    def score(self, terms: Counter) -> np.ndarray:
+        """查询词（词 → 查询中的权重）对每一行文档的BM25得分"""
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        if not self.rows:
+            return scores
+        average_length = self.total_length / len(self.rows)
+        for term, query_weight in terms.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            rows, weights = self._postings(term_id)
+            if not rows.size:
+                continue
+            norm = weights + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[rows] / average_length)
+            # 同一个词的倒排表中行号不重复，可直接按下标累加
+            scores[rows] += query_weight * self._idf(rows.size) * weights * (BM25_K1 + 1) / norm
+        return scores
+
+    def top(self, terms: Counter, limit: int, doc_types: Iterable[str] = RETRIEVAL_DOC_TYPES, exclude: Optional[Tuple[str, str]] = None, min_score: float = 0.0) -> List[Tuple[RetrievalDoc, float]]:
+        scores = self.score(terms)
+        wanted = [RETRIEVAL_DOC_TYPES.index(doc_type) for doc_type in doc_types]
+        mask = (scores > min_score) & np.isin(self.kinds[:len(scores)], wanted)
+        if exclude is not None and exclude in self.rows:
+            mask[self.rows[exclude]] = False
+        candidates = np.nonzero(mask)[0]
+        # 命中很多时先用 argpartition 取出得分最高的limit个再排序，避免对全部命中排序
+        if candidates.size > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.docs[row], float(scores[row])) for row in candidates]
+
+    def key_terms(self, doc: RetrievalDoc, limit: int = RELATED_QUERY_TERMS) -> Counter:
+        """文档中TF-IDF权重最高的词（中文只取二元组，单字区分度太低）"""
+        weighted = []
+        for term, weight in _term_weights(doc).items():
+            if is_cjk(term) and len(term) < 2:
+                continue
+            term_id = self.vocabulary.get(term)
+            document_frequency = self._postings(term_id)[0].size if term_id is not None else 1
+            weighted.append((weight * self._idf(max(document_frequency, 1)), term))
+        weighted.sort(reverse=True)
+        return Counter({term: 1 for _, term in weighted[:limit]})
+
+
+def best_passage(body: str, terms: Iterable[str], max_tokens: int) -> str:
+    """正文中命中查询词最多的句子开始，截取不超过max_tokens的片段"""
+    if not body:
+        return ""
+    sentences = [sentence for sentence in PASSAGE_SPLIT.split(body) if sentence.strip()]
+    lowered = [sentence.lower() for sentence in sentences]
+    terms = set(terms)
+    hits = [sum(1 for term in terms if term in sentence) for sentence in lowered]
+    start = max(range(len(sentences)), key=lambda index: hits[index]) if sentences else 0
+    return truncate_to_tokens("".join(sentences[start:]).strip(), max_tokens)
+
+
+class RetrievalIndex:
+    """
+    按用户缓存检索索引（LRU），首次使用时从数据库加载
+
+    写入路径把变更登记在数据库会话上，事务提交后才应用到已加载的索引，回滚的修改不会进入索引
+    """
+
+    def __init__(self, max_users: int = RETRIEVAL_MAX_USERS, ttl: float = RETRIEVAL_INDEX_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._indexes: "OrderedDict[str, UserIndex]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.RLock()
+
+    def _cached(self, user_id: str) -> Tuple[Optional[UserIndex], int]:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and time.monotonic() - index.created < self.ttl:
+                self._indexes.move_to_end(user_id)
+                return index, self._generation
+            return None, self._generation
+
+    def _store(self, user_id: str, index: UserIndex, generation: int):
+        with self._lock:
+            # 加载期间有提交的写入时只用于本次请求，不缓存
+            if generation == self._generation:
+                self._indexes[user_id] = index
+                self._indexes.move_to_end(user_id)
+                while len(self._indexes) > self.max_users:
+                    self._indexes.popitem(last=False)
+
+    @staticmethod
+    def _queries(user_id: str):
+        return (
+            select(Note.id, Note.title, Note.content, Note.folder_id).where(Note.user_id == user_id),
+            select(Task.id, Task.title, Task.description, Task.category_id).where(Task.user_id == user_id),
+        )
+
+    @staticmethod
+    def _build(notes, tasks) -> UserIndex:
+        index = UserIndex()
+        for note_id, title, content, folder_id in notes:
+            index.upsert(RetrievalDoc("note", note_id, title or "", content or "", folder_id))
+        for task_id, title, description, category_id in tasks:
+            index.upsert(RetrievalDoc("task", task_id, title or "", description or "", category_id))
+        return index
+
+    def ensure(self, db: Session, user_id: str) -> UserIndex:
+        """获取用户的索引，未加载或已过期时从数据库加载（同步会话）"""
+        index, generation = self._cached(user_id)
+        if index is None:
+            notes, tasks = (db.execute(query).all() for query in self._queries(user_id))
+            index = self._build(notes, tasks)
+            self._store(user_id, index, generation)
+        return index
+
+    async def ensure_async(self, db: AsyncSession, user_id: str) -> UserIndex:
+        """异步路由使用：异步读取数据，在线程中分词建索引，加载大量笔记时不阻塞事件循环"""
+        index, generation = self._cached(user_id)
+        if index is None:
+            notes_query, tasks_query = self._queries(user_id)
+            notes = (await db.execute(notes_query)).all()
+            tasks = (await db.execute(tasks_query)).all()
+            index = await asyncio.to_thread(self._build, notes, tasks)
+            self._store(user_id, index, generation)
+        return index
+
+    def apply(self, changes: List[tuple]):
+        with self._lock:
+            self._generation += 1
+            for change in changes:
+                if change[0] == "upsert":
+                    _, user_id, doc = change
+                    index = self._indexes.get(user_id)
+                    if index is not None:
+                        index.upsert(doc)
+                elif change[0] == "remove":
+                    _, doc_type, doc_id = change
+                    for index in self._indexes.values():
+                        if index.remove(doc_type, doc_id):
+                            break
+                else:
+                    self.invalidate(change[1])
+
+    def invalidate(self, user_id: Optional[str] = None):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(user_id, None)
+
+    def search(self, index: UserIndex, text: str, limit: int = 5, doc_types: Iterable[str] = RETRIEVAL_DOC_TYPES, exclude: Optional[Tuple[str, str]] = None, min_score: float = RETRIEVAL_MIN_SCORE) -> List[Tuple[RetrievalDoc, float]]:
+        """在用户索引中检索与text相关的文档，返回 (文档, 得分)，得分从高到低"""
+        terms = Counter(query_terms(text))
+        if not terms:
+            return []
+        with self._lock:
+            return index.top(terms, limit, doc_types, exclude, min_score)
+
+    def related(self, index: UserIndex, doc_type: str, doc_id: str, limit: int = 5, doc_types: Iterable[str] = ("note",)) -> List[Tuple[RetrievalDoc, float]]:
+        """与指定文档内容相近的文档（以该文档的关键词作为查询）"""
+        with self._lock:
+            doc = index.get(doc_type, doc_id)
+            if doc is None:
+                return []
+            return index.top(index.key_terms(doc), limit, doc_types, exclude=(doc_type, doc_id), min_score=0.0)
+
+
+retrieval_index = RetrievalIndex()
+
+
+def _pending(db: Session) -> list:
+    return db.info.setdefault(PENDING_CHANGES_KEY, [])
+
+
+def queue_upsert(db: Session, doc_type: str, doc_id: str, user_id: str, title: Optional[str], body: Optional[str], parent_id: Optional[str] = None):
+    if doc_type in RETRIEVAL_DOC_TYPES:
+        _pending(db).append(("upsert", user_id, RetrievalDoc(doc_type, doc_id, title or "", body or "", parent_id)))
+
+
+def queue_remove(db: Session, doc_type: str, doc_id: str):
+    if doc_type in RETRIEVAL_DOC_TYPES:
+        _pending(db).append(("remove", doc_type, doc_id))
+
+
+def queue_invalidate(db: Session, user_id: Optional[str] = None):
+    _pending(db).append(("invalidate", user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending_changes(session, *args):
+    changes = session.info.pop(PENDING_CHANGES_KEY, None)
+    if changes:
+        retrieval_index.apply(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_changes(session, *args):
+    session.info.pop(PENDING_CHANGES_KEY, None)
@@ -157,6 +157,36 @@ class Task(TaskBase):
     created_at: datetime
     updated_at: datetime
 
+# 任务批量操作
+class TaskBulkOpEnum(str, Enum):
+    create = "create"
+    update = "update"
+    status = "status"
+    delete = "delete"
+
+class TaskBulkOperation(BaseSchema):
+    op: TaskBulkOpEnum
+    id: Optional[str] = None  # update/status/delete 的目标任务
+    task: Optional[TaskCreate] = None  # create 的任务内容
+    changes: Optional[TaskUpdate] = None  # update 要修改的字段
+    status: Optional[StatusEnum] = None  # status 的新状态
+
+class TaskBulkRequest(BaseSchema):
+    operations: List[TaskBulkOperation]
+
+class TaskBulkResult(BaseSchema):
+    index: int  # 对应 operations 中的位置
+    op: TaskBulkOpEnum
+    ok: bool
+    id: Optional[str] = None
+    task: Optional[Task] = None  # create/update/status 成功时返回最新的任务
+    error: Optional[str] = None
+
+class TaskBulkResponse(BaseSchema):
+    succeeded: int
+    failed: int
+    results: List[TaskBulkResult]
+
 # 对话相关模式
 class ChatSessionBase(BaseSchema):
     title: str
@@ -218,6 +248,12 @@ class AIAnalyzeNoteResponse(BaseSchema):
     folder: str
     tags: List[str]
 
+class AIBatchAnalyzeNotesRequest(BaseSchema):
+    note_ids: Optional[List[str]] = None  # 指定笔记
+    folder_id: Optional[str] = None  # 指定文件夹；两者都为空时处理全部笔记
+    batch_size: Optional[int] = None  # 每次模型请求包含的笔记数
+    concurrency: Optional[int] = None  # 并行请求数
+
 class AIParseTaskRequest(BaseSchema):
     text: str
     context: Optional[dict] = None
@@ -235,6 +271,8 @@ class AIChatResponse(BaseSchema):
     response_type: str  # "message" or "action"
     content: str
     action_details: Optional[dict] = None
+    model: Optional[str] = None  # 实际回复的模型（可能是降级后的模型）
+    usage: Optional[dict] = None  # 本次回复的token用量
 
 # 认证相关模式
 class Token(BaseSchema):
@@ -0,0 +1,304 @@
+import re
+import html
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import text, bindparam, inspect
+from sqlalchemy.orm import Session
+
+from database import get_db
+from models import User, Note, Task, ChatSession, ChatMessage
+from auth import get_current_user
+from tokenizer import tokenize, query_terms, is_cjk
+from retrieval import queue_upsert, queue_remove, queue_invalidate
+from note_classifier import queue_note, queue_note_removal, queue_retrain
+
+router = APIRouter()
+
+DOC_TYPES = ("note", "task", "chat")
+
+# 全文检索索引表：SQLite使用FTS5，PostgreSQL使用tsvector + GIN
+# 文本在写入前按 tokenizer.tokenize 预先分词（中文单字+二元组），两种数据库共用同一套分词结果
+SQLITE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS search_documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        doc_type VARCHAR(20) NOT NULL,
+        doc_id VARCHAR NOT NULL,
+        user_id VARCHAR NOT NULL,
+        parent_id VARCHAR,
+        title TEXT,
+        body TEXT,
+        UNIQUE (doc_type, doc_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_parent ON search_documents (doc_type, parent_id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(title, body, owner, tokenize='unicode61')",
+]
+
+POSTGRES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS search_documents (
+        id BIGSERIAL PRIMARY KEY,
+        doc_type VARCHAR(20) NOT NULL,
+        doc_id VARCHAR NOT NULL,
+        user_id VARCHAR NOT NULL,
+        parent_id VARCHAR,
+        title TEXT,
+        body TEXT,
+        tsv TSVECTOR,
+        UNIQUE (doc_type, doc_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_parent ON search_documents (doc_type, parent_id)",
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_user ON search_documents (user_id, doc_type)",
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents USING GIN (tsv)",
+]
+
+SNIPPET_LENGTH = 120
+
+
+def _is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _owner_token(user_id: str) -> str:
+    # FTS5中按用户过滤：用户ID去掉连字符后作为owner列的单个词元
+    return "u" + user_id.replace("-", "")
+
+
+def init_search_index(engine) -> bool:
+    """
+    创建全文检索表（若不存在），返回是否为新建
+    """
+    created = not inspect(engine).has_table("search_documents")
+    ddl = POSTGRES_DDL if engine.dialect.name == "postgresql" else SQLITE_DDL
+    with engine.begin() as conn:
+        for statement in ddl:
+            conn.execute(text(statement))
+    return created
+
+
+def index_document(db: Session, doc_type: str, doc_id: str, user_id: str, title: Optional[str], body: Optional[str], parent_id: Optional[str] = None):
+    """
+    写入或更新一条检索文档（在调用方的事务中执行，随业务数据一起提交；提交后同步到本地检索索引）
+    """
+    queue_upsert(db, doc_type, doc_id, user_id, title, body, parent_id)
+    title = title or ""
+    body = body or ""
+    title_tokens = " ".join(tokenize(title))
+    body_tokens = " ".join(tokenize(body))
+    params = {
+        "doc_type": doc_type, "doc_id": doc_id, "user_id": user_id, "parent_id": parent_id,
+        "title": title, "body": body, "title_tokens": title_tokens, "body_tokens": body_tokens
+    }
+
+    if _is_postgres(db):
+        db.execute(text("""
+            INSERT INTO search_documents (doc_type, doc_id, user_id, parent_id, title, body, tsv)
+            VALUES (:doc_type, :doc_id, :user_id, :parent_id, :title, :body,
+                    setweight(to_tsvector('simple', :title_tokens), 'A') || setweight(to_tsvector('simple', :body_tokens), 'B'))
+            ON CONFLICT (doc_type, doc_id) DO UPDATE SET
+                parent_id = EXCLUDED.parent_id, title = EXCLUDED.title, body = EXCLUDED.body, tsv = EXCLUDED.tsv
+        """), params)
+        return
+
+    row = db.execute(
+        text("SELECT id FROM search_documents WHERE doc_type = :doc_type AND doc_id = :doc_id"),
+        params
+    ).first()
+    if row is None:
+        rowid = db.execute(text("""
+            INSERT INTO search_documents (doc_type, doc_id, user_id, parent_id, title, body)
+            VALUES (:doc_type, :doc_id, :user_id, :parent_id, :title, :body)
+        """), params).lastrowid
+    else:
+        rowid = row.id
+        db.execute(text("""
+            UPDATE search_documents SET parent_id = :parent_id, title = :title, body = :body WHERE id = :id
+        """), {**params, "id": rowid})
+        db.execute(text("DELETE FROM search_fts WHERE rowid = :id"), {"id": rowid})
+    db.execute(
+        text("INSERT INTO search_fts (rowid, title, body, owner) VALUES (:id, :title_tokens, :body_tokens, :owner)"),
+        {**params, "id": rowid, "owner": _owner_token(user_id)}
+    )
+
+
+def remove_document(db: Session, doc_type: str, doc_id: str):
+    """从检索索引中删除一条文档"""
+    queue_remove(db, doc_type, doc_id)
+    if doc_type == "note":
+        queue_note_removal(db, doc_id)
+    if not _is_postgres(db):
+        db.execute(text("""
+            DELETE FROM search_fts WHERE rowid IN
+            (SELECT id FROM search_documents WHERE doc_type = :doc_type AND doc_id = :doc_id)
+        """), {"doc_type": doc_type, "doc_id": doc_id})
+    db.execute(
+        text("DELETE FROM search_documents WHERE doc_type = :doc_type AND doc_id = :doc_id"),
+        {"doc_type": doc_type, "doc_id": doc_id}
+    )
+
+
+def remove_session_messages(db: Session, session_id: str):
+    """删除某个对话会话的全部消息索引"""
+    params = {"session_id": session_id}
+    if not _is_postgres(db):
+        db.execute(text("""
+            DELETE FROM search_fts WHERE rowid IN
+            (SELECT id FROM search_documents WHERE doc_type = 'chat' AND parent_id = :session_id)
+        """), params)
+    db.execute(text("DELETE FROM search_documents WHERE doc_type = 'chat' AND parent_id = :session_id"), params)
+
+
+def index_note(db: Session, note: Note):
+    queue_note(db, note)
+    index_document(db, "note", note.id, note.user_id, note.title, note.content, note.folder_id)
+
+
+def index_task(db: Session, task: Task):
+    index_document(db, "task", task.id, task.user_id, task.title, task.description, task.category_id)
+
+
+def index_chat_message(db: Session, message: ChatMessage, user_id: str):
+    index_document(db, "chat", message.id, user_id, "", message.content, message.session_id)
+
+
+def rebuild_index(db: Session, user_id: Optional[str] = None) -> int:
+    """
+    重建检索索引（指定用户或全部用户），返回索引的文档数
+    """
+    queue_invalidate(db, user_id)
+    queue_retrain(db, user_id)
+    if user_id is None:
+        if not _is_postgres(db):
+            db.execute(text("DELETE FROM search_fts"))
+        db.execute(text("DELETE FROM search_documents"))
+    else:
+        if not _is_postgres(db):
+            db.execute(text("""
+                DELETE FROM search_fts WHERE rowid IN (SELECT id FROM search_documents WHERE user_id = :user_id)
+            """), {"user_id": user_id})
+        db.execute(text("DELETE FROM search_documents WHERE user_id = :user_id"), {"user_id": user_id})
+
+    notes = db.query(Note.id, Note.user_id, Note.title, Note.content, Note.folder_id)
+    tasks = db.query(Task.id, Task.user_id, Task.title, Task.description, Task.category_id)
+    messages = db.query(ChatMessage.id, ChatSession.user_id, ChatMessage.content, ChatMessage.session_id).join(
+        ChatSession, ChatSession.id == ChatMessage.session_id
+    )
+    if user_id is not None:
+        notes = notes.filter(Note.user_id == user_id)
+        tasks = tasks.filter(Task.user_id == user_id)
+        messages = messages.filter(ChatSession.user_id == user_id)
+
+    count = 0
+    for row in notes.all():
+        index_document(db, "note", row.id, row.user_id, row.title, row.content, row.folder_id)
+        count += 1
+    for row in tasks.all():
+        index_document(db, "task", row.id, row.user_id, row.title, row.description, row.category_id)
+        count += 1
+    for row in messages.all():
+        index_document(db, "chat", row.id, row.user_id, "", row.content, row.session_id)
+        count += 1
+    return count
+
+
+def _build_snippet(body: str, raw_terms: List[str]) -> str:
+    """在正文中定位第一个命中的检索词，截取前后文并用<mark>高亮"""
+    if not body:
+        return ""
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(set(raw_terms), key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(body)
+    start = max(first.start() - SNIPPET_LENGTH // 4, 0) if first else 0
+    fragment = body[start:start + SNIPPET_LENGTH]
+
+    parts = []
+    last = 0
+    for match in pattern.finditer(fragment):
+        parts.append(html.escape(fragment[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        last = match.end()
+    parts.append(html.escape(fragment[last:]))
+
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + SNIPPET_LENGTH < len(body) else ""
+    return prefix + "".join(parts) + suffix
+
+
+def search_documents(db: Session, user_id: str, q: str, types: Optional[List[str]] = None, limit: int = 20, offset: int = 0) -> List[dict]:
+    """
+    在用户的笔记、任务和对话消息中全文检索，按相关度排序
+    """
+    terms = query_terms(q)
+    if not terms:
+        return []
+    # 最后一个拉丁词按前缀匹配，支持边输入边搜索
+    prefix_last = not is_cjk(terms[-1])
+    types = [t for t in (types or DOC_TYPES) if t in DOC_TYPES]
+    params = {"user_id": user_id, "types": types, "limit": limit, "offset": offset}
+
+    if _is_postgres(db):
+        parts = [f"'{term}'" for term in terms]
+        if prefix_last:
+            parts[-1] += ":*"
+        params["tsquery"] = " & ".join(parts)
+        statement = text("""
+            SELECT d.doc_type, d.doc_id, d.parent_id, d.title, d.body, ts_rank(d.tsv, q) AS score
+            FROM search_documents d, to_tsquery('simple', :tsquery) q
+            WHERE d.user_id = :user_id AND d.doc_type IN :types AND d.tsv @@ q
+            ORDER BY score DESC
+            LIMIT :limit OFFSET :offset
+        """)
+    else:
+        parts = [f'"{term}"' for term in terms]
+        if prefix_last:
+            parts[-1] += "*"
+        params["match"] = f'owner:"{_owner_token(user_id)}" AND {{title body}}: ({" AND ".join(parts)})'
+        # bm25越小越相关，标题权重高于正文
+        statement = text("""
+            SELECT d.doc_type, d.doc_id, d.parent_id, d.title, d.body, -bm25(search_fts, 10.0, 1.0, 0.0) AS score
+            FROM search_fts JOIN search_documents d ON d.id = search_fts.rowid
+            WHERE search_fts MATCH :match AND d.doc_type IN :types
+            ORDER BY bm25(search_fts, 10.0, 1.0, 0.0)
+            LIMIT :limit OFFSET :offset
+        """)
+    statement = statement.bindparams(bindparam("types", expanding=True))
+
+    raw_terms = [word for word in q.split() if word]
+    results = []
+    for row in db.execute(statement, params):
+        results.append({
+            "type": row.doc_type,
+            "id": row.doc_id,
+            "parent_id": row.parent_id,
+            "title": row.title,
+            "snippet": _build_snippet(row.body, raw_terms + terms),
+            "score": round(float(row.score), 4)
+        })
+    return results
+
+
+@router.get("/", response_model=List[dict])
+def search(
+    q: str = Query(..., min_length=1, description="检索关键词"),
+    types: Optional[str] = Query(None, description="逗号分隔的类型：note,task,chat"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """全文检索笔记、任务和对话消息"""
+    type_list = [t.strip() for t in types.split(",")] if types else None
+    return search_documents(db, current_user.id, q, type_list, limit, offset)
+
+
+@router.post("/reindex")
+def reindex(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """重建当前用户的检索索引"""
+    try:
+        count = rebuild_index(db, current_user.id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"重建索引失败: {str(e)}")
+    return {"message": "检索索引已重建", "documents": count}
@@ -0,0 +1,11 @@
+import json
+
+# 流式响应头：禁用缓存，并关闭nginx缓冲以保证逐块推送
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+def format_sse(event: str, data: dict) -> str:
+    """格式化一条Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
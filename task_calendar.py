@@ -0,0 +1,80 @@
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import and_, func, or_
+
+from models import Task, TASK_SPAN_BOUNDS, TASK_SPAN_UNBOUNDED
+
+# 日历事件颜色按优先级区分
+PRIORITY_COLORS = {
+    "high": "#ff4757",
+    "medium": "#ffa502",
+    "low": "#2ed573"
+}
+DEFAULT_COLOR = "#3742fa"
+
+
+def window_bounds(start: date, end: date) -> Tuple[datetime, datetime]:
+    """日期区间 [start, end]（含两端）对应的时间范围"""
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.max.time())
+
+
+def overlap_filter(user_id: str, window_start: datetime, window_end: datetime):
+    """
+    与 [window_start, window_end] 有重叠的任务：start_time <= window_end 且 结束时间 >= window_start
+    （没有结束时间的任务按开始时刻的单点处理）
+
+    每个跨度级别的任务跨度有上限，开始时间只需回溯该上限，各级别分别走
+    (user_id, span_level, start_time, end_time) 索引的一段区间；重叠判断在索引列上完成。
+    user_id 条件写进每个分支，SQLite才会对各分支分别使用索引（MULTI-INDEX OR）
+    """
+    by_level = [
+        and_(Task.user_id == user_id, Task.span_level == level, Task.start_time >= window_start - bound, Task.start_time <= window_end)
+        for level, bound in enumerate(TASK_SPAN_BOUNDS)
+    ]
+    by_level.append(and_(Task.user_id == user_id, Task.span_level == TASK_SPAN_UNBOUNDED, Task.start_time <= window_end))
+    return and_(
+        or_(*by_level),
+        func.coalesce(Task.end_time, Task.start_time) >= window_start
+    )
+
+
+def calendar_event(task: Task) -> dict:
+    priority = getattr(task.priority, "value", task.priority)
+    color = PRIORITY_COLORS.get(priority, DEFAULT_COLOR)
+    return {
+        "id": task.id,
+        "title": task.title,
+        "start": task.start_time.isoformat() if task.start_time else None,
+        "end": task.end_time.isoformat() if task.end_time else None,
+        "backgroundColor": color,
+        "borderColor": color,
+        "extendedProps": {
+            "description": task.description,
+            "priority": priority,
+            "status": getattr(task.status, "value", task.status),
+            "category_id": task.category_id
+        }
+    }
+
+
+def day_counts(intervals: Iterable[Tuple[datetime, Optional[datetime]]], start: date, end: date) -> List[dict]:
+    """
+    统计 [start, end] 内每天有多少个任务（跨天任务在覆盖的每一天都计数）
+
+    差分数组：任务覆盖的第一天 +1、最后一天的次日 -1，再做前缀和，耗时与任务数+天数成正比
+    """
+    days = (end - start).days + 1
+    diff = [0] * (days + 1)
+    for start_time, end_time in intervals:
+        first = max((start_time.date() - start).days, 0)
+        last = min(((end_time or start_time).date() - start).days, days - 1)
+        if first <= last:
+            diff[first] += 1
+            diff[last + 1] -= 1
+
+    series = []
+    running = 0
+    for offset in range(days):
+        running += diff[offset]
+        series.append({"date": (start + timedelta(days=offset)).isoformat(), "count": running})
+    return series
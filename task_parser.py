@@ -0,0 +1,551 @@
+import re
+import os
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# 本地任务解析：识别中英文的日期、时间段、期限、优先级和分类，按列表分隔拆分多个任务，
+# 并给出置信度；置信度足够高时 AIService.parse_task 直接返回结果，不调用模型
+LOCAL_PARSE_CONFIDENCE = float(os.getenv("PARSE_TASK_LOCAL_CONFIDENCE", "0.8"))
+DEFAULT_DURATION = timedelta(hours=1)
+MAX_TITLE_LENGTH = 30
+
+CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+NUM = r"(?:\d{1,4}|[零〇一二两三四五六七八九十]{1,3})"
+WEEKDAYS_CN = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6, "1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6}
+WEEKDAYS_EN = {
+    "monday": 0, "mon": 0, "tuesday": 1, "tue": 1, "tues": 1, "wednesday": 2, "wed": 2,
+    "thursday": 3, "thu": 3, "thur": 3, "thurs": 3, "friday": 4, "fri": 4, "saturday": 5, "sat": 5, "sunday": 6, "sun": 6
+}
+RELATIVE_DAYS = {
+    "大后天": 3, "后天": 2, "明天": 1, "明日": 1, "明早": 1, "明晚": 1, "今天": 0, "今日": 0, "今早": 0, "今晚": 0, "今夜": 0,
+    "day after tomorrow": 2, "tomorrow": 1, "today": 0, "tonight": 0
+}
+# 时段词 → (小时是否按下午换算, 只有时段没有具体时间时的默认开始时间)
+PERIODS = {
+    "凌晨": (False, 5), "清晨": (False, 7), "早上": (False, 8), "早晨": (False, 8), "今早": (False, 8), "明早": (False, 8), "上午": (False, 9),
+    "中午": (True, 12), "午饭后": (True, 13), "下午": (True, 14), "傍晚": (True, 18), "下班后": (True, 18), "下班": (True, 18),
+    "晚上": (True, 19), "今晚": (True, 19), "明晚": (True, 19), "夜里": (True, 21),
+    "morning": (False, 9), "noon": (True, 12), "afternoon": (True, 14), "evening": (True, 19), "tonight": (True, 19)
+}
+# 这些时段的"12点"指午夜，即次日0点
+NIGHT_PERIODS = {"晚上", "今晚", "明晚", "夜里", "evening", "tonight"}
+UNIT_DAYS = {"天": 1, "日": 1, "周": 7, "星期": 7, "个星期": 7, "礼拜": 7, "个礼拜": 7, "月": 30, "个月": 30,
+             "day": 1, "days": 1, "week": 7, "weeks": 7, "month": 30, "months": 30}
+
+PRIORITY_KEYWORDS = {
+    "low": ["不着急", "不急", "有空再", "有空", "有时间再", "低优先级", "可选", "随便", "low priority", "whenever", "someday", "optional"],
+    "high": ["非常紧急", "十万火急", "紧急", "很急", "加急", "急", "重要", "尽快", "马上", "立刻", "立即", "优先", "高优先级",
+             "asap", "urgent", "important", "high priority", "critical"],
+}
+CATEGORY_KEYWORDS = {
+    "工作": ["会议", "开会", "汇报", "报告", "项目", "客户", "需求", "上线", "周报", "日报", "邮件", "PPT", "方案", "合同", "面试", "加班", "老板", "评审", "代码", "bug",
+            "meeting", "report", "project", "client", "email", "deploy", "review"],
+    "学习": ["学习", "复习", "预习", "课程", "上课", "作业", "考试", "读书", "看书", "论文", "练习", "背单词", "教程", "study", "learn", "course", "homework", "exam"],
+    "健康": ["健身", "跑步", "运动", "锻炼", "瑜伽", "体检", "医院", "看病", "吃药", "游泳", "gym", "run", "workout", "doctor", "dentist"],
+    "财务": ["理财", "预算", "报销", "还款", "信用卡", "缴费", "交费", "记账", "工资", "交税", "房租", "bill", "budget", "invoice", "rent"],
+    "生活": ["买", "购物", "做饭", "打扫", "洗衣", "快递", "超市", "淘宝", "聚餐", "电影", "旅行", "家务", "抖音", "烤鸭", "grocery", "groceries", "shopping", "clean", "cook", "laundry"],
+}
+# 这些动词开头的片段才按"和/以及/and"拆成独立任务，避免把"买牛奶和面包"拆开
+ACTION_VERBS = ("去", "买", "写", "做", "看", "学", "打", "给", "联系", "准备", "整理", "完成", "提交", "发", "复习", "跑", "读", "参加", "预约", "订", "交", "还", "取", "洗", "打扫", "约", "回复",
+                "call", "buy", "write", "email", "send", "finish", "prepare", "read", "review", "book", "pay", "clean", "fix", "submit")
+
+_DUE = r"(?P<due>\s*(?:之前|以前|前|截止|为止|之内|以内|内))?"
+_DATE_ISO = re.compile(r"(?P<y>\d{4})[-/.年](?P<m>\d{1,2})[-/.月](?P<d>\d{1,2})[日号]?" + _DUE)
+_DATE_CN = re.compile(rf"(?P<m>{NUM})月(?P<d>{NUM})[日号]" + _DUE)
+_DATE_SLASH = re.compile(r"(?<![\d:])(?P<m>1[0-2]|0?[1-9])/(?P<d>3[01]|[12]\d|0?[1-9])(?![\d/])" + _DUE)
+_DAY_OF_MONTH = re.compile(rf"(?<![月\d])(?P<d>{NUM})[号]" + _DUE)
+_WEEKDAY_CN = re.compile(r"(?P<rel>下下个?|下个?|这个?|本|上个?)?(?:周|星期|礼拜)(?P<w>[一二三四五六日天1-7])" + _DUE)
+_WEEKDAY_EN = re.compile(r"\b(?P<by>by|before|due|until)?\s*(?P<rel>next|this)?\s*(?P<w>" + "|".join(sorted(WEEKDAYS_EN, key=len, reverse=True)) + r")\b", re.IGNORECASE)
+_WEEK_CN = re.compile(r"(?P<rel>下下个?|下个?|这个?|本)(?:周|星期|礼拜)(?:内|之内|末)?|周末")
+_WEEK_EN = re.compile(r"\b(?:by\s+)?(?:the\s+)?(?P<rel>next|this)\s+(?P<unit>week(?:end)?)\b|\b(?:this\s+)?weekend\b", re.IGNORECASE)
+_MONTH_END = re.compile(r"(?:(?:本|这个?)?月底|月末|年底)(?:之前|以前|前)?|\b(?:by\s+)?(?:the\s+)?end of (?:the )?(?:month|year)\b", re.IGNORECASE)
+_WITHIN_CN = re.compile(rf"(?P<n>{NUM}|半)(?P<unit>天|日|个?星期|周|个?礼拜|个?月)(?:之内|以内|内)")
+_WITHIN_EN = re.compile(r"\bwithin\s+(?P<n>\d+)\s+(?P<unit>days?|weeks?|months?)\b", re.IGNORECASE)
+_AFTER_CN = re.compile(rf"(?P<n>{NUM}|半)(?P<unit>天|日|个?星期|周|个?礼拜|个?月|个?小时|个?钟头|分钟)(?:之后|以后|后)")
+_AFTER_EN = re.compile(r"\bin\s+(?P<n>\d+|an?|half an?)\s+(?P<unit>days?|weeks?|months?|hours?|minutes?|mins?)\b", re.IGNORECASE)
+_RELATIVE_DAY = re.compile("(?P<word>" + "|".join(sorted(RELATIVE_DAYS, key=len, reverse=True)) + ")" + _DUE, re.IGNORECASE)
+_DURATION_CN = re.compile(rf"(?P<n>{NUM})?(?P<half>个半|半)?(?:个)?(?P<unit>小时|钟头|分钟)")
+_DURATION_EN = re.compile(r"\bfor\s+(?P<n>\d+(?:\.\d+)?|an?|half an?)\s+(?P<unit>hours?|hrs?|minutes?|mins?)\b", re.IGNORECASE)
+
+
+def _time_pattern(suffix: str, bare: bool = False) -> str:
+    """时间点的正则（命名分组带后缀，便于在时间段中出现两次）：下午3点半 / 15:30 / 3pm / 3:30 pm"""
+    periods = "|".join(sorted(PERIODS, key=len, reverse=True))
+    alternatives = [
+        rf"(?P<hour{suffix}>{NUM})\s*(?:点钟|点|时)(?:\s*(?P<half{suffix}>半|一刻|三刻)|\s*(?P<minute{suffix}>{NUM})\s*分?)?",
+        rf"(?P<hh{suffix}>\d{{1,2}})[:：](?P<mm{suffix}>\d{{2}})(?:\s*(?P<ampm2{suffix}>am|pm|a\.m\.|p\.m\.))?",
+        rf"(?P<eh{suffix}>\d{{1,2}})\s*(?P<ampm{suffix}>am|pm|a\.m\.|p\.m\.)",
+    ]
+    if bare:
+        alternatives.append(rf"(?P<bare{suffix}>\d{{1,2}})")
+    return rf"(?:(?P<period{suffix}>{periods})\s*)?(?:at\s+)?(?:{'|'.join(alternatives)})"
+
+
+_TIME_RANGE = re.compile(
+    _time_pattern("1", bare=True) + r"\s*(?:到|至|-|–|—|~|～|to|until)\s*" + _time_pattern("2"),
+    re.IGNORECASE
+)
+_TIME_POINT = re.compile(_time_pattern("1") + _DUE, re.IGNORECASE)
+_PERIOD_ONLY = re.compile("(?P<period>" + "|".join(sorted(PERIODS, key=len, reverse=True)) + ")" + _DUE, re.IGNORECASE)
+
+_SEPARATORS = re.compile(r"[，,、；;。！!\n]+|然后|\s+then\s+", re.IGNORECASE)
+_CONJUNCTION = re.compile(r"(?:和|以及|并且|\s+and\s+)(?=\s*(?:" + "|".join(ACTION_VERBS) + r"))", re.IGNORECASE)
+_SUBTASK_MARKER = re.compile(r"包括|包含|分为|步骤[:：]?")
+_MODIFIER = re.compile(r"^(?:和|跟|与|同|with\s)\s*\S{1,10}?一起|^with\s+\w+", re.IGNORECASE)
+_LEADING_FILLER = re.compile(r"^(?:提醒我|记得|别忘了|请|帮我|我要|我得|我想|需要|要|得|在|的|于|on|at|remember to|remind me to|please)\s*", re.IGNORECASE)
+_TRAILING_FILLER = re.compile(r"\s*(?:吧|了|一下|啊|呀|哦|哈|的)$")
+_CONTEXT_ONLY = re.compile(r"^(?:之前|以前|前)?(?:搞定|完成|做完|弄完|处理完|处理|结束|开始|done|finish(?:ed)?|start)?$", re.IGNORECASE)
+# 出现这些表达时本地解析不可靠：重复规则、含糊的时间、条件与选择、疑问
+_VAGUE = re.compile(r"每天|每周|每月|每晚|每隔|大概|可能|也许|或者|还是|看情况|如果|要是|过几天|改天|回头|最近|晚点|晚些|月初|上旬|中旬|下旬|年初|有机会|[吗？?]|\b(?:every|daily|weekly|maybe|perhaps|or|if|sometime|later|soon)\b", re.IGNORECASE)
+# 去掉已识别的部分后仍残留的数字/时间单位，说明有没能识别的时间表达
+_TITLE_CHARS = re.compile(r"\w")
+_LEFTOVER_TIME = re.compile(rf"\d|{NUM}\s*(?:点|号|日|天|周|月|年|小时|分钟)|\b(?:am|pm|next|this|last|week|month|day|days|hour|hours)\b", re.IGNORECASE)
+
+
+class ParseResult(NamedTuple):
+    tasks: List[Dict]
+    confidence: float
+
+
+def cn_number(text: str) -> int:
+    """阿拉伯数字或中文数字（最多到九十九）转整数"""
+    if text.isdigit():
+        return int(text)
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        return (CN_DIGITS.get(tens, 1) if tens else 1) * 10 + (CN_DIGITS.get(ones, 0) if ones else 0)
+    value = 0
+    for char in text:
+        value = value * 10 + CN_DIGITS.get(char, 0)
+    return value
+
+
+class _Slots:
+    """一个片段中识别出的时间信息"""
+
+    def __init__(self):
+        self.day: Optional[date] = None
+        self.deadline: Optional[date] = None
+        self.deadline_time: Optional[time] = None
+        self.start: Optional[time] = None
+        self.end: Optional[time] = None
+        self.start_at: Optional[datetime] = None  # "2小时后"这类直接确定到时刻的表达
+        self.duration: Optional[timedelta] = None
+        self.period: Optional[str] = None
+        self.overnight = False  # 开始/截止时间是"晚上12点"，落在所写日期的次日0点
+        self.ambiguous = 0
+
+    def set_day(self, value: date, due: bool):
+        if due:
+            self.deadline = value
+        else:
+            self.day = value
+
+    def merged(self, context: "_Slots") -> "_Slots":
+        """片段自身没有的时间信息从共享的上下文片段（如"3天内搞定"）继承"""
+        merged = _Slots()
+        for name, value in vars(self).items():
+            setattr(merged, name, value if value not in (None, 0) else getattr(context, name))
+        return merged
+
+
+def _adjust_hour(hour: int, period: Optional[str], ampm: Optional[str], slots: _Slots) -> int:
+    if ampm:
+        ampm = ampm.lower().replace(".", "")
+        if ampm == "pm" and hour < 12:
+            return hour + 12
+        if ampm == "am" and hour == 12:
+            return 0
+        return hour
+    if period:
+        afternoon, _ = PERIODS[period.lower()]
+        if hour == 12 and period.lower() in NIGHT_PERIODS:
+            slots.overnight = True
+            return 0
+        if afternoon and hour < 12 and not (period == "中午" and hour >= 11):
+            return hour + 12
+        return hour
+    # 没有时段的1~6点按下午理解（"3点开会"），并降低置信度
+    if 1 <= hour <= 6:
+        slots.ambiguous += 1
+        return hour + 12
+    return hour
+
+
+def _match_time(match, suffix: str, slots: _Slots, inherit_period: Optional[str] = None, inherit_ampm: Optional[str] = None) -> Optional[time]:
+    group = lambda name: match.group(name + suffix)
+    period = group("period") or inherit_period
+    minute = 0
+    if group("hour"):
+        hour = cn_number(group("hour"))
+        half = group("half")
+        if half:
+            minute = {"半": 30, "一刻": 15, "三刻": 45}[half]
+        elif group("minute"):
+            minute = cn_number(group("minute"))
+        ampm = inherit_ampm
+    elif group("hh"):
+        hour, minute = int(group("hh")), int(group("mm"))
+        ampm = group("ampm2") or inherit_ampm
+        # 24小时制的时间不按时段换算
+        if hour > 12:
+            period = None
+    elif group("eh"):
+        hour, ampm = int(group("eh")), group("ampm")
+    else:
+        hour, ampm = int(group("bare")), inherit_ampm
+    hour = _adjust_hour(hour, period, ampm, slots)
+    if hour > 23 or minute > 59:
+        return None
+    return time(hour, minute)
+
+
+def _ampm(match, suffix: str) -> Optional[str]:
+    return match.group("ampm" + suffix) or match.group("ampm2" + suffix)
+
+
+def _next_weekday(today: date, weekday: int, weeks_ahead: int) -> date:
+    """weeks_ahead=0 表示本周（已过去则取下周），1 表示下周，2 表示下下周"""
+    monday = today - timedelta(days=today.weekday())
+    target = monday + timedelta(days=7 * weeks_ahead + weekday)
+    if weeks_ahead == 0 and target < today:
+        target += timedelta(days=7)
+    return target
+
+
+def _week_offset(rel: Optional[str]) -> int:
+    if not rel:
+        return 0
+    rel = rel.lower()
+    if rel.startswith("下下"):
+        return 2
+    if rel.startswith("下") or rel == "next":
+        return 1
+    if rel.startswith("上"):
+        return -1
+    return 0
+
+
+def _units(n: str) -> float:
+    if n == "半" or n.lower().startswith("half"):
+        return 0.5
+    if n.lower() in ("a", "an"):
+        return 1
+    return float(n) if re.fullmatch(r"\d+(?:\.\d+)?", n) else cn_number(n)
+
+
+def _extract_slots(text: str, now: datetime, slots: _Slots) -> str:
+    """依次识别各类时间表达，记录到slots并从文本中移除，返回剩余文本"""
+    today = now.date()
+
+    def consume(pattern, handler):
+        nonlocal text
+        text = pattern.sub(lambda match: handler(match) or " ", text)
+
+    # 不存在的日期（"2月30日"）不识别，留在文本中由残留时间检查降低置信度，交给模型处理
+    def iso_date(match):
+        try:
+            value = date(int(match.group("y")), int(match.group("m")), int(match.group("d")))
+        except ValueError:
+            return match.group()
+        slots.set_day(value, bool(match.group("due")))
+
+    def month_day(match):
+        month, day = cn_number(match.group("m")), cn_number(match.group("d"))
+        try:
+            value = date(today.year, month, day)
+            if value < today - timedelta(days=30):
+                value = value.replace(year=today.year + 1)
+        except ValueError:
+            return match.group()
+        slots.set_day(value, bool(match.group("due")))
+
+    def day_of_month(match):
+        day = cn_number(match.group("d"))
+        if not 1 <= day <= 31:
+            return match.group()
+        year, month = today.year, today.month
+        if day < today.day:
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        try:
+            slots.set_day(date(year, month, day), bool(match.group("due")))
+        except ValueError:
+            return match.group()
+
+    def weekday_cn(match):
+        slots.set_day(_next_weekday(today, WEEKDAYS_CN[match.group("w")], _week_offset(match.group("rel"))), bool(match.group("due")))
+
+    def weekday_en(match):
+        slots.set_day(_next_weekday(today, WEEKDAYS_EN[match.group("w").lower()], _week_offset(match.group("rel"))), bool(match.group("by")))
+
+    def week(match):
+        whole = match.group().lower()
+        if whole.endswith("末") or "weekend" in whole:
+            slots.set_day(_next_weekday(today, 5, _week_offset(match.group("rel"))), False)
+        else:
+            # "下周""本周内"按该周周日截止
+            slots.deadline = _next_weekday(today, 6, _week_offset(match.group("rel")))
+
+    def month_end(match):
+        whole = match.group()
+        if "年" in whole or "year" in whole.lower():
+            slots.deadline = date(today.year, 12, 31)
+        else:
+            next_month = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+            slots.deadline = next_month - timedelta(days=1)
+
+    def within(match):
+        slots.deadline = today + timedelta(days=round(_units(match.group("n")) * UNIT_DAYS[match.group("unit").lower().lstrip("个")]))
+
+    def after(match):
+        amount = _units(match.group("n"))
+        unit = match.group("unit").lower().lstrip("个")
+        if unit in ("小时", "钟头") or unit.startswith("hour"):
+            slots.start_at = now + timedelta(hours=amount)
+        elif unit in ("分钟",) or unit.startswith("min"):
+            slots.start_at = now + timedelta(minutes=amount)
+        else:
+            slots.day = today + timedelta(days=round(amount * UNIT_DAYS[unit]))
+
+    def relative_day(match):
+        word = match.group("word").lower()
+        slots.set_day(today + timedelta(days=RELATIVE_DAYS[word]), bool(match.group("due")))
+        if word in PERIODS:
+            slots.period = word
+
+    def time_range(match):
+        end = _match_time(match, "2", slots, inherit_period=match.group("period1") if not match.group("period2") else None)
+        # 结束时间为午夜时由 _resolve 顺延到次日，overnight 只描述开始时间
+        end_minutes = end.hour * 60 + end.minute + (24 * 60 if slots.overnight else 0) if end else None
+        slots.overnight = False
+        inherit_period = match.group("period2") if not match.group("period1") else None
+        inherit_ampm = None if _ampm(match, "1") else _ampm(match, "2")
+        start = _match_time(match, "1", slots, inherit_period=inherit_period, inherit_ampm=inherit_ampm)
+        if start is not None and end is not None and (inherit_period or inherit_ampm) and start.hour * 60 + start.minute > end_minutes:
+            # "9点到下午6点"：沿用结束时间的时段后开始晚于结束，说明开始时间不在该时段内
+            slots.overnight = False
+            start = _match_time(match, "1", slots)
+        if start is None or end is None:
+            return match.group()
+        slots.start, slots.end = start, end
+        slots.period = slots.period or match.group("period1")
+
+    def time_point(match):
+        value = _match_time(match, "1", slots, inherit_period=slots.period)
+        if value is None:
+            return match.group()
+        if match.group("due"):
+            slots.deadline_time = value
+        else:
+            slots.start = value
+
+    def period_only(match):
+        period = match.group("period").lower()
+        if match.group("due"):
+            # "下班前提交"：以时段的默认时间为截止时间
+            slots.deadline_time = time(PERIODS[period][1])
+        else:
+            slots.period = period
+
+    def duration(match):
+        unit = match.group("unit").lower()
+        n = match.group("n")
+        amount = _units(n) if n else (0.5 if match.group("half") == "半" else 1)
+        if match.group("half") == "个半":
+            amount += 0.5
+        minutes = amount if unit in ("分钟",) or unit.startswith("min") else amount * 60
+        slots.duration = timedelta(minutes=minutes)
+
+    consume(_DATE_ISO, iso_date)
+    consume(_DATE_CN, month_day)
+    consume(_DATE_SLASH, month_day)
+    consume(_WEEKDAY_CN, weekday_cn)
+    consume(_WEEKDAY_EN, weekday_en)
+    consume(_WEEK_CN, week)
+    consume(_WEEK_EN, week)
+    consume(_MONTH_END, month_end)
+    consume(_WITHIN_CN, within)
+    consume(_WITHIN_EN, within)
+    consume(_AFTER_CN, after)
+    consume(_AFTER_EN, after)
+    consume(_RELATIVE_DAY, relative_day)
+    consume(_DAY_OF_MONTH, day_of_month)
+    consume(_TIME_RANGE, time_range)
+    consume(_DURATION_EN, duration)
+    consume(_TIME_POINT, time_point)
+    consume(_DURATION_CN, duration)
+    # 时段词（上午/晚上）只在已有的时间之后识别，避免吞掉"下午3点"中的时段
+    consume(_PERIOD_ONLY, period_only)
+    return text
+
+
+def _extract_priority(text: str) -> Tuple[str, Optional[str]]:
+    lowered = text.lower()
+    for priority in ("low", "high"):
+        for keyword in PRIORITY_KEYWORDS[priority]:
+            position = lowered.find(keyword)
+            if position >= 0:
+                return text[:position] + " " + text[position + len(keyword):], priority
+    return text, None
+
+
+def _category(text: str) -> Tuple[Optional[str], List[str]]:
+    lowered = text.lower()
+    scores = Counter()
+    tags = []
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        for keyword in keywords:
+            if keyword.lower() in lowered:
+                scores[category] += 1
+                if len(keyword) > 1 and keyword not in tags:
+                    tags.append(keyword)
+    if not scores:
+        return None, []
+    return scores.most_common(1)[0][0], tags[:3]
+
+
+def _clean_title(text: str) -> str:
+    title = re.sub(r"\s+", " ", text).strip(" ，,、。；;:：-！!")
+    for _ in range(3):
+        cleaned = _TRAILING_FILLER.sub("", _LEADING_FILLER.sub("", title)).strip(" ，,、。；;:：-！!")
+        if cleaned == title:
+            break
+        title = cleaned
+    return title
+
+
+def _resolve(slots: _Slots, now: datetime) -> Dict:
+    """把识别出的时间信息换算成任务的 start_time / end_time / due_date / time_range"""
+    start = end = None
+    day = slots.day
+    start_time = slots.start
+    if slots.overnight and day is not None:
+        # "明天晚上12点"是后天0点；没写日期时今天0点已过，下面自然取明天
+        day += timedelta(days=1)
+    if start_time is None and slots.period and slots.start_at is None:
+        start_time = time(PERIODS[slots.period][1])
+    if slots.start_at is not None:
+        start = slots.start_at.replace(second=0, microsecond=0)
+    elif start_time is not None:
+        if day is None:
+            # 只有时间没有日期：今天还没到的时间取今天，否则取明天
+            day = now.date() if datetime.combine(now.date(), start_time) > now else now.date() + timedelta(days=1)
+        start = datetime.combine(day, start_time)
+    if start is not None:
+        if slots.end is not None:
+            end = datetime.combine(start.date(), slots.end)
+            if end <= start:
+                end += timedelta(hours=12) if slots.end.hour < 12 and end + timedelta(hours=12) > start else timedelta(days=1)
+        else:
+            end = start + (slots.duration or DEFAULT_DURATION)
+
+    deadline = slots.deadline
+    if deadline is None and slots.deadline_time is not None:
+        deadline = slots.day or now.date()
+    if deadline is None and start is None and day is not None:
+        deadline = day
+    if deadline is not None and start is None and slots.deadline_time is not None:
+        end = datetime.combine(deadline, slots.deadline_time)
+        if slots.overnight:
+            # "今晚12点前"：截止到当天结束，即次日0点
+            end += timedelta(days=1)
+
+    return {
+        "start_time": start.isoformat() if start else None,
+        "end_time": end.isoformat() if end else None,
+        "due_date": deadline.isoformat() if deadline else None,
+        "time_range": "specific" if start else ("deadline" if deadline else "flexible"),
+    }
+
+
+def _split(text: str) -> List[List[str]]:
+    """按分隔符拆成片段，每个片段再按连接词拆开；同一片段内按连接词拆出的任务共享时间（"call mom and pay rent tonight"）"""
+    groups = []
+    for part in _SEPARATORS.split(text):
+        pieces = [piece.strip() for piece in _CONJUNCTION.split(part) if piece and piece.strip()]
+        if pieces:
+            groups.append(pieces)
+    return groups
+
+
+def parse_task_text(text: str, now: Optional[datetime] = None) -> ParseResult:
+    """
+    本地解析任务描述，返回与模型解析相同格式的任务列表和0~1的置信度
+
+    逗号/顿号/分号分隔的片段各自成为一个任务；只含时间或期限的片段（"3天内搞定"）、
+    "和同事一起"这类修饰片段作用于所有任务；"包括"之后的列表作为子任务
+    """
+    now = now or datetime.now()
+    text = (text or "").strip()
+    confidence = 1.0
+    if not text:
+        return ParseResult([], 0.0)
+    if _VAGUE.search(text):
+        confidence -= 0.35
+
+    subtasks = []
+    marker = _SUBTASK_MARKER.search(text)
+    if marker:
+        subtasks = [_clean_title(item) for item in re.split(r"[，,、和；;]", text[marker.end():]) if _clean_title(item)]
+        groups = [[text[:marker.start()]]]
+    else:
+        groups = _split(text)
+
+    context = _Slots()
+    shared_priority = None
+    modifiers = []
+    items = []
+    for pieces in groups:
+        if _MODIFIER.match(pieces[0]):
+            modifiers.append("".join(pieces))
+            continue
+        group = []
+        for piece in pieces:
+            slots = _Slots()
+            rest, priority = _extract_priority(piece)
+            rest = _extract_slots(rest, now, slots)
+            title = _clean_title(rest)
+            if _CONTEXT_ONLY.match(title):
+                # 只有时间/优先级的片段作为所有任务的共享信息
+                context = slots.merged(context)
+                shared_priority = shared_priority or priority
+                continue
+            group.append((title, slots, priority))
+        for title, slots, priority in group:
+            for _, sibling, _ in group:
+                slots = slots.merged(sibling)
+            items.append((title, slots, priority))
+
+    if not items:
+        return ParseResult([], 0.0)
+    if len(items) > 6:
+        confidence -= 0.2
+
+    tasks = []
+    last_day = None
+    for title, slots, priority in items:
+        slots = slots.merged(context)
+        # "明天上午开会，下午见客户"：只有时间的任务沿用前一个任务的日期
+        if slots.day is None and (slots.start or slots.period):
+            slots.day = last_day
+        last_day = slots.day or last_day
+        if len(title) < 2 or not _TITLE_CHARS.search(title):
+            confidence -= 0.5
+        if len(title) > MAX_TITLE_LENGTH:
+            confidence -= 0.3
+        if _LEFTOVER_TIME.search(title):
+            confidence -= 0.4
+        confidence -= 0.1 * slots.ambiguous
+        category, tags = _category(" ".join([title, *modifiers, *subtasks]))
+        timing = _resolve(slots, now)
+        tasks.append({
+            "title": title[:MAX_TITLE_LENGTH],
+            "description": text,
+            "priority": priority or shared_priority or "medium",
+            **timing,
+            "category": category,
+            "tags": tags,
+            "subtasks": subtasks,
+        })
+    return ParseResult(tasks, round(max(confidence, 0.0), 2))
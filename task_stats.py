@@ -0,0 +1,147 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import increment_counter
+from models import Task, Category, TaskStatCounter, StatusEnum, PriorityEnum
+
+CounterKey = Tuple[str, str, str]
+
+
+def _value(value) -> str:
+    # 路由层使用 schemas 中的枚举，模型层使用 models 中的枚举，统一按值保存
+    return getattr(value, "value", value) or ""
+
+
+def counter_key(task: Task) -> CounterKey:
+    """任务在计数表中对应的 (状态, 优先级, 分类)，更新任务前先记下旧值"""
+    return _value(task.status), _value(task.priority), task.category_id or ""
+
+
+def adjust_task_counter(db: Session, user_id: str, key: CounterKey, delta: int):
+    """增减一组计数，与任务写入在同一事务中提交"""
+    status, priority, category_id = key
+    increment_counter(
+        db, TaskStatCounter,
+        dict(user_id=user_id, status=status, priority=priority, category_id=category_id),
+        dict(count=delta)
+    )
+
+
+def track_task_created(db: Session, task: Task):
+    """任务flush之后调用（此时默认的状态/优先级已生效）"""
+    adjust_task_counter(db, task.user_id, counter_key(task), 1)
+
+
+def track_task_deleted(db: Session, task: Task):
+    adjust_task_counter(db, task.user_id, counter_key(task), -1)
+
+
+def track_task_changed(db: Session, task: Task, old_key: CounterKey):
+    new_key = counter_key(task)
+    if new_key != old_key:
+        adjust_task_counter(db, task.user_id, old_key, -1)
+        adjust_task_counter(db, task.user_id, new_key, 1)
+
+
+def rebuild_task_counters(db: Session, user_id: str):
+    """从任务表重新汇总计数（迁移前的数据或计数异常时使用）"""
+    db.flush()
+    db.query(TaskStatCounter).filter(TaskStatCounter.user_id == user_id).delete(synchronize_session=False)
+    rows = db.query(Task.status, Task.priority, Task.category_id, func.count(Task.id)).filter(
+        Task.user_id == user_id
+    ).group_by(Task.status, Task.priority, Task.category_id).all()
+    for status, priority, category_id, count in rows:
+        db.add(TaskStatCounter(
+            user_id=user_id,
+            status=_value(status),
+            priority=_value(priority),
+            category_id=category_id or "",
+            count=count
+        ))
+    db.flush()
+
+
+def compute_task_stats(db: Session, user_id: str, weeks: int = 8, now: Optional[datetime] = None) -> dict:
+    """
+    任务统计
+
+    状态/优先级/分类分布读取计数表，行数只与分组数有关；
+    逾期数走 (user_id, status, end_time) 索引，只扫描未完成且已过截止时间的任务；
+    每周趋势只扫描最近若干周内创建的任务
+    """
+    now = now or datetime.now()
+    counters = db.query(
+        TaskStatCounter.status, TaskStatCounter.priority, TaskStatCounter.category_id, TaskStatCounter.count
+    ).filter(TaskStatCounter.user_id == user_id, TaskStatCounter.count != 0).all()
+    if not counters and db.query(Task.id).filter(Task.user_id == user_id).first():
+        rebuild_task_counters(db, user_id)
+        db.commit()
+        return compute_task_stats(db, user_id, weeks, now)
+    
+    by_status = {status.value: 0 for status in StatusEnum}
+    by_priority = {priority.value: 0 for priority in PriorityEnum}
+    by_category = {}
+    total = 0
+    for status, priority, category_id, count in counters:
+        total += count
+        if status in by_status:
+            by_status[status] += count
+        if priority in by_priority:
+            by_priority[priority] += count
+        item = by_category.setdefault(category_id, {"category_id": category_id or None, "total": 0, "done": 0, "overdue": 0})
+        item["total"] += count
+        if status == StatusEnum.done.value:
+            item["done"] += count
+    
+    open_statuses = [status for status in StatusEnum if status != StatusEnum.done]
+    # 不在SQL中GROUP BY：分组会让SQLite改用 (user_id, category_id) 索引扫描该用户全部任务
+    overdue_rows = Counter(category_id for category_id, in db.query(Task.category_id).filter(
+        Task.user_id == user_id,
+        Task.status.in_(open_statuses),
+        Task.end_time < now
+    ))
+    overdue = 0
+    for category_id, count in overdue_rows.items():
+        overdue += count
+        item = by_category.setdefault(category_id or "", {"category_id": category_id, "total": 0, "done": 0, "overdue": 0})
+        item["overdue"] += count
+    
+    names = dict(db.query(Category.id, Category.name).filter(Category.user_id == user_id).all())
+    for item in by_category.values():
+        item["name"] = names.get(item["category_id"], "未分类")
+    
+    # 最近若干周（周一开始）的新建/已完成趋势：按天分组后在内存中折叠为周
+    week_start = now.date() - timedelta(days=now.weekday() + 7 * (weeks - 1))
+    day = func.date(Task.created_at)
+    daily = db.query(day, Task.status, func.count(Task.id)).filter(
+        Task.user_id == user_id,
+        Task.created_at >= datetime.combine(week_start, datetime.min.time())
+    ).group_by(day, Task.status).all()
+    
+    weekly = [
+        {"week_start": (week_start + timedelta(weeks=i)).isoformat(), "created": 0, "done": 0}
+        for i in range(weeks)
+    ]
+    for created_day, status, count in daily:
+        index = (datetime.fromisoformat(str(created_day)[:10]).date() - week_start).days // 7
+        if 0 <= index < weeks:
+            weekly[index]["created"] += count
+            if status == StatusEnum.done:
+                weekly[index]["done"] += count
+    
+    return {
+        "total": total,
+        "todo": by_status["todo"],
+        "doing": by_status["doing"],
+        "done": by_status["done"],
+        "high_priority": by_priority["high"],
+        "completion_rate": round((by_status["done"] / total * 100) if total > 0 else 0, 2),
+        "overdue": overdue,
+        "by_status": by_status,
+        "by_priority": by_priority,
+        "by_category": sorted(by_category.values(), key=lambda item: item["total"], reverse=True),
+        "weekly": weekly
+    }
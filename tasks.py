@@ -1,29 +1,64 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
+from collections import Counter
 from datetime import datetime, date
+import calendar
+import os
 
-from database import get_db
+from database import get_async_db
 from models import User, Task, Category
-from schemas import Task as TaskSchema, TaskCreate, TaskUpdate, StatusEnum, PriorityEnum
-from auth import get_current_user
+from schemas import (
+    Task as TaskSchema, TaskCreate, TaskUpdate, StatusEnum, PriorityEnum,
+    TaskBulkOpEnum, TaskBulkRequest, TaskBulkResponse
+)
+from auth import get_current_user_async
+from search import index_task, remove_document
+from pagination import keyset_paginate, finish_page
+from task_calendar import window_bounds, overlap_filter, calendar_event, day_counts
+from task_stats import compute_task_stats, counter_key, adjust_task_counter, track_task_created, track_task_deleted, track_task_changed
 
 router = APIRouter()
 
+# 单次批量操作的数量上限
+TASK_BULK_MAX_OPERATIONS = int(os.getenv("TASK_BULK_MAX_OPERATIONS", "500"))
+
+async def _get_user_task(db: AsyncSession, task_id: str, user_id: str) -> Optional[Task]:
+    return (await db.execute(select(Task).where(Task.id == task_id, Task.user_id == user_id))).scalar_one_or_none()
+
+def _new_task(task: TaskCreate, user_id: str) -> Task:
+    return Task(
+        title=task.title,
+        description=task.description,
+        start_time=task.start_time,
+        end_time=task.end_time,
+        priority=task.priority,
+        status=task.status,
+        category_id=task.category_id,
+        user_id=user_id,
+        reminder_minutes_before=task.reminder_minutes_before
+    )
+
+async def _category_exists(db: AsyncSession, category_id: str, user_id: str) -> bool:
+    return (await db.execute(select(Category.id).where(Category.id == category_id, Category.user_id == user_id))).first() is not None
+
 @router.get("/", response_model=List[TaskSchema])
-def get_tasks(
+async def get_tasks(
+    response: Response,
     skip: int = 0, 
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
     status: Optional[StatusEnum] = None,
     priority: Optional[PriorityEnum] = None,
     category_id: Optional[str] = None,
     date_from: Optional[date] = None,
     date_to: Optional[date] = None,
-    current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async), 
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """获取任务列表，支持多种筛选条件"""
-    query = db.query(Task).filter(Task.user_id == current_user.id)
+    """获取任务列表，支持多种筛选条件（按创建时间倒序；下一页游标见响应头X-Next-Cursor）"""
+    query = select(Task).where(Task.user_id == current_user.id)
     
     if status:
         query = query.filter(Task.status == status)
@@ -36,146 +71,245 @@ def get_tasks(
     if date_to:
         query = query.filter(Task.end_time <= datetime.combine(date_to, datetime.max.time()))
     
-    tasks = query.offset(skip).limit(limit).all()
-    return tasks
+    query = keyset_paginate(query, Task.created_at, Task.id, cursor, limit)
+    if skip and not cursor:
+        query = query.offset(skip)
+    tasks = list((await db.execute(query)).scalars())
+    return finish_page(tasks, response, limit, "created_at")
 
 @router.get("/{task_id}", response_model=TaskSchema)
-def get_task(task_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_task(task_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """获取特定任务"""
-    task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+    task = await _get_user_task(db, task_id, current_user.id)
     if not task:
         raise HTTPException(status_code=404, detail="任务不存在")
     return task
 
 @router.post("/", response_model=TaskSchema)
-def create_task(task: TaskCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_task(task: TaskCreate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """创建新任务"""
     # 验证分类（如果提供）
     if task.category_id:
-        category = db.query(Category).filter(Category.id == task.category_id, Category.user_id == current_user.id).first()
-        if not category:
+        if not await _category_exists(db, task.category_id, current_user.id):
             raise HTTPException(status_code=404, detail="分类不存在")
     
     # 创建任务
-    db_task = Task(
-        title=task.title,
-        description=task.description,
-        start_time=task.start_time,
-        end_time=task.end_time,
-        priority=task.priority,
-        status=task.status,
-        category_id=task.category_id,
-        user_id=current_user.id,
-        reminder_minutes_before=task.reminder_minutes_before
-    )
+    db_task = _new_task(task, current_user.id)
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
+    await db.flush()
+    await db.run_sync(index_task, db_task)
+    await db.run_sync(track_task_created, db_task)
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
+@router.post("/bulk", response_model=TaskBulkResponse)
+async def bulk_tasks(request: TaskBulkRequest, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    """
+    批量创建/更新/修改状态/删除任务（看板拖拽、AI解析出的多个任务一次保存）
+
+    引用的分类一次查询校验，目标任务一次查询加载；校验失败的操作在结果中标记错误并跳过，
+    其余操作在同一事务中执行，新建任务随一次flush批量插入
+    """
+    operations = request.operations
+    if not operations:
+        raise HTTPException(status_code=400, detail="没有要执行的操作")
+    if len(operations) > TASK_BULK_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"一次最多提交{TASK_BULK_MAX_OPERATIONS}个操作")
+    
+    user_id = current_user.id
+    category_ids = {op.task.category_id for op in operations if op.op == TaskBulkOpEnum.create and op.task and op.task.category_id}
+    category_ids |= {op.changes.category_id for op in operations if op.op == TaskBulkOpEnum.update and op.changes and op.changes.category_id}
+    valid_categories = set()
+    if category_ids:
+        valid_categories = set(await db.scalars(select(Category.id).where(Category.id.in_(category_ids), Category.user_id == user_id)))
+    task_ids = {op.id for op in operations if op.op != TaskBulkOpEnum.create and op.id}
+    tasks = {}
+    if task_ids:
+        tasks = {task.id: task for task in await db.scalars(select(Task).where(Task.id.in_(task_ids), Task.user_id == user_id))}
+    
+    results = []
+    created, deleted = [], []
+    reindexed = {}
+    counter_deltas = Counter()
+    for index, op in enumerate(operations):
+        result = {"index": index, "op": op.op, "ok": False, "id": op.id}
+        results.append(result)
+        if op.op == TaskBulkOpEnum.create:
+            if op.task is None:
+                result["error"] = "缺少任务内容"
+            elif op.task.category_id and op.task.category_id not in valid_categories:
+                result["error"] = "分类不存在"
+            else:
+                created.append((result, _new_task(op.task, user_id)))
+            continue
+        
+        # 同一批中已删除的任务对后续操作视为不存在
+        task = tasks.get(op.id) if op.id else None
+        if task is None:
+            result["error"] = "任务不存在"
+            continue
+        old_key = counter_key(task)
+        if op.op == TaskBulkOpEnum.delete:
+            del tasks[task.id]
+            reindexed.pop(task.id, None)
+            deleted.append(task)
+            counter_deltas[old_key] -= 1
+            result["ok"] = True
+            continue
+        if op.op == TaskBulkOpEnum.status:
+            if op.status is None:
+                result["error"] = "缺少新状态"
+                continue
+            task.status = op.status
+        else:
+            if op.changes is None:
+                result["error"] = "缺少要修改的字段"
+                continue
+            update_data = op.changes.dict(exclude_unset=True)
+            if update_data.get("category_id") and update_data["category_id"] not in valid_categories:
+                result["error"] = "分类不存在"
+                continue
+            for field, value in update_data.items():
+                setattr(task, field, value)
+            if {"title", "description", "category_id"} & update_data.keys():
+                reindexed[task.id] = task
+        counter_deltas[old_key] -= 1
+        counter_deltas[counter_key(task)] += 1
+        result["ok"] = True
+    
+    db.add_all([task for _, task in created])
+    for task in deleted:
+        await db.delete(task)
+    await db.flush()
+    for result, task in created:
+        result.update(ok=True, id=task.id)
+        reindexed[task.id] = task
+        counter_deltas[counter_key(task)] += 1
+    
+    def apply_side_effects(session):
+        # 检索索引与统计计数与任务写入在同一事务中提交；计数按 (状态, 优先级, 分类) 合并后各更新一次
+        for task in reindexed.values():
+            index_task(session, task)
+        for task in deleted:
+            remove_document(session, "task", task.id)
+        for key, delta in counter_deltas.items():
+            if delta:
+                adjust_task_counter(session, user_id, key, delta)
+    
+    await db.run_sync(apply_side_effects)
+    await db.commit()
+    
+    # 一次查询取回新建/修改后的任务（含数据库生成的时间字段）
+    returned_ids = {result["id"] for result in results if result["ok"] and result["op"] != TaskBulkOpEnum.delete}
+    if returned_ids:
+        fresh = {task.id: task for task in await db.scalars(
+            select(Task).where(Task.id.in_(returned_ids)).execution_options(populate_existing=True)
+        )}
+        for result in results:
+            if result["ok"] and result["id"] in fresh:
+                result["task"] = fresh[result["id"]]
+    
+    succeeded = sum(1 for result in results if result["ok"])
+    return {"succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
 @router.put("/{task_id}", response_model=TaskSchema)
-def update_task(task_id: str, task_update: TaskUpdate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_task(task_id: str, task_update: TaskUpdate, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """更新任务"""
-    db_task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+    db_task = await _get_user_task(db, task_id, current_user.id)
     if not db_task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
     # 更新字段
+    old_key = counter_key(db_task)
     update_data = task_update.dict(exclude_unset=True)
     for field, value in update_data.items():
         if field == "category_id" and value:
             # 验证分类
-            category = db.query(Category).filter(Category.id == value, Category.user_id == current_user.id).first()
-            if not category:
+            if not await _category_exists(db, value, current_user.id):
                 raise HTTPException(status_code=404, detail="分类不存在")
         setattr(db_task, field, value)
     
-    db.commit()
-    db.refresh(db_task)
+    if {"title", "description", "category_id"} & update_data.keys():
+        await db.run_sync(index_task, db_task)
+    await db.run_sync(track_task_changed, db_task, old_key)
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
 @router.delete("/{task_id}")
-def delete_task(task_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_task(task_id: str, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """删除任务"""
-    db_task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+    db_task = await _get_user_task(db, task_id, current_user.id)
     if not db_task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    db.delete(db_task)
-    db.commit()
+    await db.delete(db_task)
+    await db.run_sync(remove_document, "task", task_id)
+    await db.run_sync(track_task_deleted, db_task)
+    await db.commit()
     return {"message": "任务已删除"}
 
 @router.patch("/{task_id}/status")
-def update_task_status(task_id: str, status: StatusEnum, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_task_status(task_id: str, status: StatusEnum, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     """更新任务状态（用于看板拖拽）"""
-    db_task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+    db_task = await _get_user_task(db, task_id, current_user.id)
     if not db_task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
+    old_key = counter_key(db_task)
     db_task.status = status
-    db.commit()
+    await db.run_sync(track_task_changed, db_task, old_key)
+    await db.commit()
     return {"message": "任务状态已更新", "status": status}
 
 @router.get("/calendar/events", response_model=List[dict])
-def get_calendar_events(
+async def get_calendar_events(
     start: date = Query(..., description="开始日期"),
     end: date = Query(..., description="结束日期"),
-    current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async), 
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """获取日历事件格式的任务数据"""
-    start_datetime = datetime.combine(start, datetime.min.time())
-    end_datetime = datetime.combine(end, datetime.max.time())
-    
-    tasks = db.query(Task).filter(
-        Task.user_id == current_user.id,
-        Task.start_time >= start_datetime,
-        Task.end_time <= end_datetime
-    ).all()
-    
-    events = []
-    for task in tasks:
-        # 根据优先级设置颜色
-        color_map = {
-            "high": "#ff4757",
-            "medium": "#ffa502", 
-            "low": "#2ed573"
-        }
-        
-        event = {
-            "id": task.id,
-            "title": task.title,
-            "start": task.start_time.isoformat() if task.start_time else None,
-            "end": task.end_time.isoformat() if task.end_time else None,
-            "backgroundColor": color_map.get(task.priority.value, "#3742fa"),
-            "borderColor": color_map.get(task.priority.value, "#3742fa"),
-            "extendedProps": {
-                "description": task.description,
-                "priority": task.priority.value,
-                "status": task.status.value,
-                "category_id": task.category_id
-            }
-        }
-        events.append(event)
-    
-    return events
+    """获取日历事件格式的任务数据（与 [start, end] 有重叠的任务，包括跨越区间边界的多日任务）"""
+    if end < start:
+        raise HTTPException(status_code=400, detail="结束日期不能早于开始日期")
+    window_start, window_end = window_bounds(start, end)
+    tasks = await db.scalars(
+        select(Task).where(overlap_filter(current_user.id, window_start, window_end)).order_by(Task.start_time)
+    )
+    return [calendar_event(task) for task in tasks]
 
-@router.get("/stats/summary", response_model=dict)
-def get_task_stats(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取任务统计信息"""
-    total_tasks = db.query(Task).filter(Task.user_id == current_user.id).count()
-    todo_tasks = db.query(Task).filter(Task.user_id == current_user.id, Task.status == StatusEnum.todo).count()
-    doing_tasks = db.query(Task).filter(Task.user_id == current_user.id, Task.status == StatusEnum.doing).count()
-    done_tasks = db.query(Task).filter(Task.user_id == current_user.id, Task.status == StatusEnum.done).count()
-    
-    high_priority = db.query(Task).filter(Task.user_id == current_user.id, Task.priority == PriorityEnum.high).count()
+@router.get("/calendar/month", response_model=dict)
+async def get_calendar_month(
+    year: Optional[int] = Query(None, ge=1970, le=9999),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """月视图概览（默认本月）：每天的任务数，只读取索引中的起止时间，不加载任务内容"""
+    today = date.today()
+    month_start = date(year or today.year, month or today.month, 1)
+    month_end = date(month_start.year, month_start.month, calendar.monthrange(month_start.year, month_start.month)[1])
+    window_start, window_end = window_bounds(month_start, month_end)
+    intervals = (await db.execute(
+        select(Task.start_time, Task.end_time).where(overlap_filter(current_user.id, window_start, window_end))
+    )).all()
+    days = day_counts(intervals, month_start, month_end)
     
     return {
-        "total": total_tasks,
-        "todo": todo_tasks,
-        "doing": doing_tasks,
-        "done": done_tasks,
-        "high_priority": high_priority,
-        "completion_rate": round((done_tasks / total_tasks * 100) if total_tasks > 0 else 0, 2)
+        "year": month_start.year,
+        "month": month_start.month,
+        "total": len(intervals),
+        "max_count": max((day["count"] for day in days), default=0),
+        "days": days
     }
 
+@router.get("/stats/summary", response_model=dict)
+async def get_task_stats(
+    weeks: int = Query(8, ge=1, le=52),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取任务统计信息（状态/优先级/分类分布、逾期数、每周趋势）"""
+    return await db.run_sync(compute_task_stats, current_user.id, weeks)
+
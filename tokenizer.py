@@ -0,0 +1,81 @@
+import re
+from typing import List
+
+# 中日韩文字（汉字、假名、谚文）连续片段，或拉丁字母/数字组成的单词
+CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+TOKEN_PATTERN = re.compile(f"[{CJK_RANGES}]+|[0-9a-zA-Z\u00c0-\u024f]+")
+CJK_PATTERN = re.compile(f"[{CJK_RANGES}]")
+
+
+def is_cjk(text: str) -> bool:
+    return bool(CJK_PATTERN.match(text))
+
+
+def tokenize(text: str, ngram: int = 2) -> List[str]:
+    """
+    CJK感知的分词
+
+    中文等没有空格分隔的文字按单字 + 相邻n字（默认二元组）切分，
+    拉丁文字按单词切分并转为小写。例如 "学习Python笔记" →
+    ["学", "习", "学习", "python", "笔", "记", "笔记"]
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text or ""):
+        run = match.group()
+        if is_cjk(run):
+            tokens.extend(run)
+            for size in range(2, ngram + 1):
+                tokens.extend(run[i:i + size] for i in range(len(run) - size + 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def query_terms(text: str) -> List[str]:
+    """
+    查询分词：中文片段只取最长的n元组（单字片段取单字），避免单字匹配带来的噪声
+    """
+    terms = []
+    for match in TOKEN_PATTERN.finditer(text or ""):
+        run = match.group()
+        if is_cjk(run) and len(run) > 1:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif is_cjk(run):
+            terms.append(run)
+        else:
+            terms.append(run.lower())
+    return terms
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的模型token数（不依赖具体模型的分词器）
+
+    中日韩文字按每字1个token，拉丁单词按每4个字符1个token，其余非空白字符（标点等）每个1个token；
+    对中文略微高估，用于上下文预算时偏保守
+    """
+    if not text:
+        return 0
+    tokens = 0
+    matched = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        run = match.group()
+        matched += len(run)
+        tokens += len(run) if is_cjk(run) else (len(run) + 3) // 4
+    others = len(text) - matched - sum(1 for char in text if char.isspace())
+    return tokens + max(others, 0)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截取文本开头，使估算的token数不超过max_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分查找最长的满足预算的前缀
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
@@ -0,0 +1,86 @@
+import os
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+
+class TreeCacheEntry(NamedTuple):
+    version: int
+    etag: str
+    body: bytes
+    created: float
+
+
+class NotesTreeCache:
+    """
+    按用户缓存序列化后的笔记树
+
+    每个用户维护一个版本号，笔记/文件夹写入时递增并丢弃缓存；
+    ETag取自树内容的哈希，多进程部署下同样内容得到同样的ETag。
+    失效只作用于当前进程，多进程部署时其他进程的写入在缓存过期（ttl秒）后可见
+    """
+
+    def __init__(self, max_users: int = 1000, ttl: float = 60):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, TreeCacheEntry]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id: str) -> int:
+        """当前版本号，构建树之前读取，用于写入时检测并发修改"""
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def get(self, user_id: str) -> Optional[TreeCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created >= self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id: str, version: int, tree: List[dict]) -> TreeCacheEntry:
+        """
+        写入缓存。构建期间若发生过写入（版本号已变化），只返回结果而不缓存
+        """
+        body = json.dumps(tree, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        entry = TreeCacheEntry(version=version, etag=etag, body=body, created=time.monotonic())
+        with self._lock:
+            if self._versions.get(user_id, 0) == version:
+                self._entries[user_id] = entry
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: str):
+        """用户的笔记或文件夹发生变化后调用"""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断If-None-Match请求头是否命中当前ETag（支持多个值和弱校验）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+# 全局笔记树缓存实例
+notes_tree_cache = NotesTreeCache(
+    max_users=int(os.getenv("NOTES_TREE_CACHE_USERS", "1000")),
+    ttl=float(os.getenv("NOTES_TREE_CACHE_TTL", "60"))
+)
@@ -0,0 +1,269 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from admission import AdmissionRejected
+from database import AsyncSessionLocal, increment_counter
+from models import AIUsageRecord, AIUsageDailyRollup, generate_uuid
+
+# AI用量流水：请求路径上只把记录追加到内存缓冲区，后台任务定期（或攒够一批时）批量写入流水表并累加按天汇总；
+# 配额按用户每天的token数和请求数在调用模型之前检查
+AI_USAGE_FLUSH_INTERVAL = float(os.getenv("AI_USAGE_FLUSH_INTERVAL", "5"))  # 秒
+AI_USAGE_BATCH_SIZE = int(os.getenv("AI_USAGE_BATCH_SIZE", "200"))  # 缓冲区达到此数时立即写入
+AI_USAGE_MAX_BUFFER = int(os.getenv("AI_USAGE_MAX_BUFFER", "10000"))  # 数据库不可用时最多积压的记录数
+AI_USAGE_MAX_RETRIES = int(os.getenv("AI_USAGE_MAX_RETRIES", "5"))  # 同一条记录最多写入失败的次数，超过后丢弃
+AI_USAGE_RETENTION_DAYS = int(os.getenv("AI_USAGE_RETENTION_DAYS", "90"))  # 流水保留天数（按天汇总不清理），0表示不清理
+AI_DAILY_TOKEN_QUOTA = int(os.getenv("AI_DAILY_TOKEN_QUOTA", "0"))  # 每个用户每天的token上限，0表示不限制
+AI_DAILY_REQUEST_QUOTA = int(os.getenv("AI_DAILY_REQUEST_QUOTA", "0"))
+AI_QUOTA_CACHE_TTL = float(os.getenv("AI_QUOTA_CACHE_TTL", "60"))  # 秒，多进程部署时其他进程的用量在过期重载后计入
+PRUNE_INTERVAL = 3600
+MAX_QUOTA_USERS = 10000
+
+
+class QuotaExceeded(AdmissionRejected):
+    """用户当天的AI用量已达配额，到次日（UTC）零点恢复"""
+
+
+def usage_day(moment: Optional[datetime] = None) -> date:
+    """
+    用量所属的日期。流水时间与其他Python端时间一样按UTC记录，
+    按天汇总、每日配额和配额恢复都以UTC零点为界
+    """
+    return (moment or datetime.utcnow()).date()
+
+
+def _seconds_until_tomorrow() -> float:
+    now = datetime.utcnow()
+    return (datetime.combine(usage_day(now) + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+def write_usage_batch(db: Session, records: List[Dict]):
+    """写入一批流水，并把同一 (用户, 天, 模型, 来源) 的记录合并后累加到按天汇总"""
+    db.execute(insert(AIUsageRecord), records)
+    rollups: Dict[Tuple, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for record in records:
+        key = (record["user_id"] or "", usage_day(record["created_at"]), record["model"], record["feature"])
+        deltas = rollups[key]
+        deltas["requests"] += 1
+        deltas["errors"] += 0 if record["success"] else 1
+        for column in ("prompt_tokens", "completion_tokens", "total_tokens", "latency_ms"):
+            deltas[column] += record[column]
+    for (user_id, day, model, feature), deltas in rollups.items():
+        increment_counter(db, AIUsageDailyRollup, dict(user_id=user_id, day=day, model=model, feature=feature), dict(deltas))
+
+
+class UsageLedger:
+    def __init__(self):
+        self.buffer: List[Dict] = []
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        # 写入失败过的记录：记录id -> 已失败次数
+        self.attempts: Dict[str, int] = {}
+        # 配额用：用户 -> [日期, 请求数, token数, 加载时间]
+        self.today: Dict[str, list] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._pruned_at = 0.0
+
+    def record(
+        self,
+        user_id: Optional[str],
+        model: str,
+        provider: str,
+        feature: str,
+        usage: Optional[Dict],
+        latency: float,
+        success: bool = True
+    ):
+        """记录一次上游请求（只追加到内存，不访问数据库）"""
+        usage = usage or {}
+        prompt = int(usage.get("prompt_tokens") or 0)
+        completion = int(usage.get("completion_tokens") or 0)
+        total = int(usage.get("total_tokens") or prompt + completion)
+        now = datetime.utcnow()
+        self.buffer.append({
+            "id": generate_uuid(),
+            "user_id": user_id,
+            "model": model,
+            "provider": provider,
+            "feature": feature,
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": total,
+            "latency_ms": round(latency * 1000),
+            "success": success,
+            "created_at": now,
+        })
+        if len(self.buffer) > AI_USAGE_MAX_BUFFER:
+            # 长时间写不进数据库时丢弃最早的记录，避免内存无限增长
+            overflow = len(self.buffer) - AI_USAGE_MAX_BUFFER
+            for old in self.buffer[:overflow]:
+                self.attempts.pop(old["id"], None)
+            del self.buffer[:overflow]
+            self.dropped += overflow
+
+        entry = self.today.get(user_id) if user_id is not None else None
+        if entry is not None and entry[0] == usage_day(now):
+            entry[1] += 1
+            entry[2] += total
+        if len(self.buffer) >= AI_USAGE_BATCH_SIZE and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        """
+        把缓冲区写入数据库；写入失败时记录放回缓冲区下次重试，
+        同一条记录失败 AI_USAGE_MAX_RETRIES 次后丢弃（避免无法写入的数据一直重试）
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.buffer:
+                return
+            batch, self.buffer = self.buffer, []
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.run_sync(write_usage_batch, batch)
+                    await db.commit()
+            except Exception as e:
+                retry = []
+                for record in batch:
+                    failures = self.attempts.get(record["id"], 0) + 1
+                    if failures >= AI_USAGE_MAX_RETRIES:
+                        self.attempts.pop(record["id"], None)
+                    else:
+                        self.attempts[record["id"]] = failures
+                        retry.append(record)
+                given_up = len(batch) - len(retry)
+                self.buffer[:0] = retry
+                self.dropped += given_up
+                if given_up:
+                    print(f"❌ AI用量写入连续失败 {AI_USAGE_MAX_RETRIES} 次，丢弃 {given_up} 条记录: {e}")
+                if retry:
+                    print(f"⚠️ AI用量写入失败，{len(self.buffer)} 条记录等待重试: {e}")
+                return
+            for record in batch:
+                self.attempts.pop(record["id"], None)
+            self.written += len(batch)
+            self.flushes += 1
+
+    async def _prune(self):
+        if AI_USAGE_RETENTION_DAYS <= 0 or time.monotonic() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(days=AI_USAGE_RETENTION_DAYS)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(AIUsageRecord.__table__.delete().where(AIUsageRecord.created_at < cutoff))
+            await db.commit()
+        if result.rowcount:
+            print(f"🧹 已清理 {result.rowcount} 条 {AI_USAGE_RETENTION_DAYS} 天前的AI用量流水")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), AI_USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                await self._prune()
+            except Exception as e:
+                print(f"⚠️ AI用量后台写入失败: {e}")
+
+    def start(self):
+        """启动后台写入（应用启动时调用）"""
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def stop(self):
+        """停止后台写入并写入剩余记录（应用关闭时调用）"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def _usage_today(self, user_id: str) -> list:
+        today = usage_day()
+        entry = self.today.get(user_id)
+        if entry is not None and entry[0] == today and time.monotonic() - entry[3] < AI_QUOTA_CACHE_TTL:
+            return entry
+        async with AsyncSessionLocal() as db:
+            row = (await db.execute(
+                select(func.coalesce(func.sum(AIUsageDailyRollup.requests), 0), func.coalesce(func.sum(AIUsageDailyRollup.total_tokens), 0))
+                .where(AIUsageDailyRollup.user_id == user_id, AIUsageDailyRollup.day == today)
+            )).one()
+        # 已记录但还没写入数据库的部分
+        pending = [record for record in self.buffer if record["user_id"] == user_id and usage_day(record["created_at"]) == today]
+        entry = [today, row[0] + len(pending), row[1] + sum(record["total_tokens"] for record in pending), time.monotonic()]
+        if len(self.today) > MAX_QUOTA_USERS:
+            self.today = {key: value for key, value in self.today.items() if value[0] == today}
+        self.today[user_id] = entry
+        return entry
+
+    async def check_quota(self, user_id: Optional[str]):
+        """用户当天的用量达到配额时抛出 QuotaExceeded"""
+        if user_id is None or (AI_DAILY_TOKEN_QUOTA <= 0 and AI_DAILY_REQUEST_QUOTA <= 0):
+            return
+        _, requests, tokens, _ = await self._usage_today(user_id)
+        if AI_DAILY_TOKEN_QUOTA > 0 and tokens >= AI_DAILY_TOKEN_QUOTA:
+            raise QuotaExceeded(f"今日AI用量已达上限（{AI_DAILY_TOKEN_QUOTA} tokens），明天再试", _seconds_until_tomorrow(), "quota")
+        if AI_DAILY_REQUEST_QUOTA > 0 and requests >= AI_DAILY_REQUEST_QUOTA:
+            raise QuotaExceeded(f"今日AI请求次数已达上限（{AI_DAILY_REQUEST_QUOTA} 次），明天再试", _seconds_until_tomorrow(), "quota")
+
+    async def quota_status(self, user_id: str) -> Dict:
+        _, requests, tokens, _ = await self._usage_today(user_id)
+        return {
+            "daily_tokens": AI_DAILY_TOKEN_QUOTA or None,
+            "daily_requests": AI_DAILY_REQUEST_QUOTA or None,
+            "used_tokens": tokens,
+            "used_requests": requests,
+        }
+
+    def stats(self) -> Dict:
+        return {"pending": len(self.buffer), "written": self.written, "flushes": self.flushes, "dropped": self.dropped}
+
+
+def usage_rows(db: Session, start: date, end: date, user_id: Optional[str] = None, by_user: bool = False) -> List[Dict]:
+    """
+    [start, end] 区间的按天汇总；指定 user_id 时按 (天, 模型, 来源) 返回该用户的数据，
+    by_user 时按 (用户, 模型) 返回全体用户的合计
+    """
+    sums = [
+        func.sum(AIUsageDailyRollup.requests).label("requests"),
+        func.sum(AIUsageDailyRollup.errors).label("errors"),
+        func.sum(AIUsageDailyRollup.prompt_tokens).label("prompt_tokens"),
+        func.sum(AIUsageDailyRollup.completion_tokens).label("completion_tokens"),
+        func.sum(AIUsageDailyRollup.total_tokens).label("total_tokens"),
+        func.sum(AIUsageDailyRollup.latency_ms).label("latency_ms"),
+    ]
+    keys = [AIUsageDailyRollup.user_id, AIUsageDailyRollup.model] if by_user else [AIUsageDailyRollup.day, AIUsageDailyRollup.model, AIUsageDailyRollup.feature]
+    query = db.query(*keys, *sums).filter(AIUsageDailyRollup.day >= start, AIUsageDailyRollup.day <= end)
+    if user_id is not None:
+        query = query.filter(AIUsageDailyRollup.user_id == user_id)
+    rows = []
+    for row in query.group_by(*keys).all():
+        item = dict(row._mapping)
+        latency = item.pop("latency_ms")
+        item["avg_latency_ms"] = round(latency / item["requests"]) if item["requests"] else None
+        if "day" in item:
+            item["day"] = item["day"].isoformat()
+        rows.append(item)
+    rows.sort(key=lambda item: (item.get("day", ""), -item["total_tokens"]))
+    return rows
+
+
+usage_ledger = UsageLedger()
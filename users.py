@@ -6,22 +6,23 @@ from database import get_db
 from models import User
 from schemas import User as UserSchema, UserCreate, UserUpdate, UserLogin, Token, UserChangePassword
 from auth import (
-    authenticate_user, 
+    authenticate_user_async, 
     create_access_token, 
-    get_password_hash, 
+    get_password_hash_async, 
     get_current_active_user, 
     get_current_super_user,
-    verify_password,
+    verify_password_async,
     create_super_user,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from principal_cache import principal_cache
 
 router = APIRouter(prefix="/api/users", tags=["users"])
 
 @router.post("/login", response_model=Token)
 async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
     """用户登录"""
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+    user = await authenticate_user_async(db, user_credentials.username, user_credentials.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -32,6 +33,7 @@ async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
     # 更新最后登录时间
     user.last_login = datetime.utcnow()
     db.commit()
+    principal_cache.invalidate_user(user.id)
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -72,6 +74,7 @@ async def update_users_me(
         setattr(current_user, field, value)
     
     db.commit()
+    principal_cache.invalidate_user(current_user.id)
     db.refresh(current_user)
     return current_user
 
@@ -82,14 +85,15 @@ async def change_password(
     db: Session = Depends(get_db)
 ):
     """修改当前用户密码"""
-    if not verify_password(password_data.current_password, current_user.hashed_password):
+    if not await verify_password_async(password_data.current_password, current_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="当前密码错误"
         )
     
-    current_user.hashed_password = get_password_hash(password_data.new_password)
+    current_user.hashed_password = await get_password_hash_async(password_data.new_password)
     db.commit()
+    principal_cache.invalidate_user(current_user.id)
     return {"message": "密码修改成功"}
 
 @router.get("/", response_model=List[UserSchema])
@@ -127,7 +131,7 @@ async def create_user(
         )
     
     # 创建新用户
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     db_user = User(
         username=user.username,
         email=user.email,
@@ -176,6 +180,7 @@ async def update_user(
         setattr(user, field, value)
     
     db.commit()
+    principal_cache.invalidate_user(user.id)
     db.refresh(user)
     return user
 
@@ -202,5 +207,6 @@ async def delete_user(
     
     db.delete(user)
     db.commit()
+    principal_cache.invalidate_user(user_id)
     return {"message": "用户删除成功"}
 